@@ -31,16 +31,20 @@ BACKEND_OUTPUT_DIR=fpga_build
 #time=/usr/bin/time -f 'command took %E m:s and %M KB'
 time=/usr/bin/time
 
-.PHONY: codecheck test synth clock-gen pnr program clean
+.PHONY: codecheck asmcheck test synth clock-gen pnr program clean
 
 # if invoked with no explicit target, print out a help message
 .DEFAULT: help
 help:
-	@echo -e "Valid targets are: codecheck test synth pnr zip program boot clean"
+	@echo -e "Valid targets are: codecheck asmcheck test synth pnr zip program boot clean"
 
 codecheck:
 	python3 codecheck.py
 
+# check that our built-in assembler encodes the testbenches' inline code exactly as GNU as does
+asmcheck:
+	python3 ../common/python/riscv_assembler.py
+
 test:
 	@echo You can run just specific tests via:
 	@echo "     MAKEFLAGS=-j4 pytest --exitfirst --capture=no -k runCocotbTests_ADD_TEST_COLLECTION_HERE testbench.py --tests TEST1,TEST2,..."
@@ -98,4 +102,4 @@ zip: $(ZIP_SOURCES)
 
 # remove build files
 clean:
-	rm -rf points.json sim_build/ $(BACKEND_OUTPUT_DIR)/ slpp_all/
+	rm -rf points.json sim_build/ sim_build_*/ $(BACKEND_OUTPUT_DIR)/ slpp_all/
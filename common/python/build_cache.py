@@ -0,0 +1,174 @@
+"""A content-hashed cache of Verilator-built simulators, shared by every runner of every homework. Each simulator is
+keyed by a hash of everything that goes into building it: the contents of the Verilog sources and of every file they
+`include, the build args (VERILATOR_FLAGS and defines such as -DDIVIDER_STAGES), the toplevel module, whether
+waveforms are enabled, and the versions of Verilator, cocotb and Python. File paths are not part of the key, so a
+fresh checkout, or switching back to a branch that was built before, reuses the simulator built then and skips
+Verilator entirely.
+
+Simulators are cached under CIS5710_CACHE_DIR (default ~/.cache/cis5710) in sim/KEY/, and only the most recently used
+BUILD_CACHE_ENTRIES are kept. Set RV_BUILD_CACHE=0 to always run Verilator. Builds also get the options that
+build_tuner.py found to be fastest for their design and build profile, if any.
+"""
+
+from pathlib import Path
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import cocotb
+import cocotb.config
+
+import build_tuner
+import cocotb_utils as cu
+
+BUILD_CACHE = os.environ.get('RV_BUILD_CACHE', '1') != '0'
+BUILD_CACHE_DIR = Path(os.environ.get('CIS5710_CACHE_DIR', Path.home() / '.cache' / 'cis5710')) / 'sim'
+
+# bump this to invalidate all cached simulators, e.g., if buildKey() changes
+BUILD_CACHE_VERSION = 2
+
+# number of simulators to keep, each is a few MB
+BUILD_CACHE_ENTRIES = 32
+
+# other runr.build() arguments we accept: those that change the simulator, and so are part of its key, and those
+# that don't
+KEYED_BUILD_ARGS = ['hdl_library', 'defines', 'parameters', 'timescale']
+UNKEYED_BUILD_ARGS = ['verbose', 'log_file']
+
+# on a cache hit we set the runner state that runr.build() would have, which is internal to cocotb's runner
+COCOTB_RUNNER_VERSION = '1.9.'
+
+_INCLUDE = re.compile(r'^\s*`include\s+"([^"]+)"', re.MULTILINE)
+
+_verilatorVersion = None
+
+def verilatorVersion():
+    """Returns the output of `verilator --version`, or None if Verilator isn't installed"""
+    global _verilatorVersion
+    if _verilatorVersion is None:
+        try:
+            _verilatorVersion = subprocess.run(['verilator', '--version'], capture_output=True, text=True,
+                                               check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        pass
+    return _verilatorVersion
+
+def sourceClosure(sources, includes):
+    """Returns (name, path) for each of the given sources and, transitively, each file they `include. Included files
+    are looked for next to the file including them and then in the include directories, like Verilator does. The path
+    is None for an included file that can't be found."""
+    closure = []
+    seen = set()
+    pending = [(Path(s).name, Path(s)) for s in sources]
+    while len(pending) > 0:
+        name, path = pending.pop(0)
+        if path is not None:
+            path = path.resolve()
+            pass
+        if (name, path) in seen:
+            continue
+        seen.add((name, path))
+        closure.append((name, path))
+        if path is None:
+            continue
+        for included in _INCLUDE.findall(path.read_text()):
+            candidates = [path.parent / included] + [Path(d) / included for d in includes]
+            pending.append((included, next((c for c in candidates if c.is_file()), None)))
+            pass
+        pass
+    return closure
+
+def buildKey(verilog_sources, hdl_toplevel, includes=[], build_args=[], waves=False, **kwargs):
+    """Returns the cache key of the simulator built from the given runr.build() arguments, of which kwargs may hold
+    any of KEYED_BUILD_ARGS"""
+    h = hashlib.sha256()
+    def add(*fields):
+        for field in fields:
+            h.update(str(field).encode())
+            h.update(b'\0')
+            pass
+        pass
+    add(BUILD_CACHE_VERSION, verilatorVersion(), cocotb.__version__, cocotb.config.libs_dir, sys.version)
+    add(hdl_toplevel, bool(waves), *[str(arg) for arg in build_args])
+    for name in KEYED_BUILD_ARGS:
+        value = kwargs.get(name)
+        add(name, sorted(value.items()) if isinstance(value, dict) else value)
+        pass
+    for name, path in sourceClosure(verilog_sources, includes):
+        add(name, 'missing' if path is None else hashlib.sha256(path.read_bytes()).hexdigest())
+        pass
+    return h.hexdigest()
+
+def _prune():
+    """Remove all but the most recently used cache entries"""
+    entries = sorted((e for e in BUILD_CACHE_DIR.iterdir() if e.is_dir() and not e.name.startswith('.')),
+                     key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in entries[BUILD_CACHE_ENTRIES:]:
+        shutil.rmtree(entry, ignore_errors=True)
+        pass
+    pass
+
+def build(runr, verilog_sources, hdl_toplevel, build_dir, includes=[], build_args=[], waves=False, build_profile=None,
+          **kwargs):
+    """Like runr.build(), but copies the simulator from the cache instead of running Verilator if it was built before.
+    build_profile is the build profile that build_args are for (default: the current one), whose tuned options are
+    added. Returns True on a cache hit, and False otherwise. Only Verilog designs are handled, and kwargs may only hold
+    KEYED_BUILD_ARGS and UNKEYED_BUILD_ARGS."""
+    unsupported = set(kwargs) - set(KEYED_BUILD_ARGS) - set(UNKEYED_BUILD_ARGS) - {'vhdl_sources'}
+    if len(unsupported) > 0:
+        raise TypeError(f'build_cache.build() does not support {", ".join(sorted(unsupported))}')
+    if len(kwargs.get('vhdl_sources', [])) > 0:
+        raise TypeError('build_cache.build() does not support VHDL sources')
+    # remembered so that debug_rerun.py can rebuild the same design under another build profile
+    runr.cacheBuildArgs = dict(verilog_sources=verilog_sources, hdl_toplevel=hdl_toplevel, build_dir=build_dir,
+                               includes=includes, build_args=build_args, waves=waves, **kwargs)
+    # the fastest options for this design and profile, if we have tuned them
+    build_args = list(build_args) + build_tuner.buildOptions(hdl_toplevel, build_profile or cu.BUILD_PROFILE)
+    if not BUILD_CACHE or verilatorVersion() is None:
+        runr.build(verilog_sources=verilog_sources, hdl_toplevel=hdl_toplevel, build_dir=build_dir,
+                   includes=includes, build_args=build_args, waves=waves, **kwargs)
+        return False
+
+    keyed = {name: kwargs[name] for name in KEYED_BUILD_ARGS if name in kwargs}
+    entry = BUILD_CACHE_DIR / buildKey(verilog_sources, hdl_toplevel, includes, build_args, waves, **keyed)
+    cached = entry / hdl_toplevel
+    simulator = Path(build_dir).resolve() / hdl_toplevel
+    if cached.is_file():
+        print(f'[build_cache.py] reusing simulator {entry.name[:12]} from {BUILD_CACHE_DIR}')
+        simulator.parent.mkdir(parents=True, exist_ok=True)
+        tmpFile = simulator.with_name(f'.{hdl_toplevel}.{os.getpid()}.tmp')
+        shutil.copy2(cached, tmpFile)
+        os.replace(tmpFile, simulator)
+        os.utime(entry) # mark as recently used
+        # runr.test() needs the state that runr.build() would have set. These are cocotb's runner internals (see
+        # Simulator.build() in cocotb/runner.py), so check them again when upgrading cocotb.
+        assert cocotb.__version__.startswith(COCOTB_RUNNER_VERSION), \
+            f'build_cache.py sets the internals of the cocotb {COCOTB_RUNNER_VERSION}x runner, not {cocotb.__version__}'
+        runr.build_dir = simulator.parent
+        runr.verilog_sources = [Path(s).resolve() for s in verilog_sources]
+        runr.vhdl_sources = []
+        runr.sources = []
+        runr.hdl_toplevel = hdl_toplevel
+        return True
+
+    runr.build(verilog_sources=verilog_sources, hdl_toplevel=hdl_toplevel, build_dir=build_dir,
+               includes=includes, build_args=build_args, waves=waves, **kwargs)
+    try:
+        # populate the entry in a temporary directory and then rename it, in case several runners miss at once
+        BUILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmpEntry = BUILD_CACHE_DIR / f'.{entry.name}.{os.getpid()}.tmp'
+        tmpEntry.mkdir(exist_ok=True)
+        shutil.copy2(simulator, tmpEntry / hdl_toplevel)
+        try:
+            os.replace(tmpEntry, entry)
+        except OSError:
+            shutil.rmtree(tmpEntry, ignore_errors=True) # another runner got there first
+            pass
+        _prune()
+    except OSError:
+        pass # the cache is just an optimization
+    return False
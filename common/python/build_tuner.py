@@ -0,0 +1,138 @@
+"""Tune the Verilator options we build each design with. The best options differ between designs, e.g., the small
+hw2 combinational blocks don't benefit from threads while the hw5/hw6 pipelines might. For each combination of
+options in a matrix (thread count and output splitting), the tuner does a clean build of the design under a build
+profile (default: 'fast') and runs a fixed workload, recording the compile time and the simulation speed: cycles/sec
+if the workload reports it (see cocotb_utils.runUntilHalt()), and otherwise the tests' wall-clock time. The
+optimization level is left to the profile. The best options for each design and profile go in build-tuning.json in
+the homework directory, and build_cache.build() adds them to every build of that design under that profile from then
+on, so, e.g., debug builds are unaffected by tuning the fast profile. Delete that file to go back to the default
+options.
+
+Usage, from a homework directory (this removes the tuned profile's build directory, e.g., sim_build_fast, before
+each build, so that compile times are comparable):
+    python3 ../common/python/build_tuner.py                  # tune the processor, on dhrystone
+    python3 ../common/python/build_tuner.py --runner runCocotbTestsDivider --design DividerUnsignedPipelined --tests ''
+"""
+
+from pathlib import Path
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import telemetry
+
+TUNING_FILE = 'build-tuning.json'
+# options being tried by the tuner, which take the place of the tuned ones for the profile being tuned
+BUILD_OPTIONS_ENV = 'RV_BUILD_OPTIONS'
+
+THREADS = [1, 2, 4]
+OUTPUT_SPLITS = [0, 20000]
+
+def tuningPath():
+    return Path.cwd() / TUNING_FILE
+
+def loadTuning():
+    try:
+        with open(tuningPath()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def buildOptions(hdl_toplevel, profile):
+    """Returns the extra Verilator options to build the given design with under the given build profile: those being
+    tried by the tuner, or else the best ones it found for this design and profile"""
+    import cocotb_utils as cu
+    if BUILD_OPTIONS_ENV in os.environ and profile == os.environ.get(cu.BUILD_PROFILE_ENV):
+        return os.environ[BUILD_OPTIONS_ENV].split()
+    tuned = loadTuning().get(hdl_toplevel, {}).get(profile)
+    return tuned['options'] if tuned is not None else []
+
+def optionsMatrix(threads=THREADS, outputSplits=OUTPUT_SPLITS):
+    """Returns the list of options for each combination to try"""
+    threads = [t for t in threads if t <= os.cpu_count()]
+    return [['--threads', str(t), '--output-split', str(split)]
+            for t, split in itertools.product(threads, outputSplits)]
+
+def measure(records, runner):
+    """Returns the compile time and simulation speed of one tuning run, from its telemetry records"""
+    runnerSeconds = sum(r['seconds'] for r in records if r['kind'] == 'runner' and r['test'] == runner)
+    testSeconds = sum(r['seconds'] for r in records if r['kind'] == 'test')
+    runs = [r for r in records if r['kind'] == 'phase' and r.get('phase') == 'run']
+    cycles = sum(r['cycles'] for r in runs)
+    runSeconds = sum(r['seconds'] for r in runs)
+    return {
+        'build_seconds': round(runnerSeconds - testSeconds, 3),
+        'test_seconds': round(testSeconds, 3),
+        'cycles_per_sec': round(cycles / runSeconds, 1) if runSeconds > 0 else None,
+    }
+
+def score(result):
+    """Higher is better: cycles/sec if we have it, and otherwise tests per second"""
+    if result['cycles_per_sec'] is not None:
+        return result['cycles_per_sec']
+    return 1 / result['test_seconds'] if result['test_seconds'] > 0 else 0
+
+def tune(runner, design, tests, matrix, profile='fast'):
+    """Build and run the given design under the given build profile with each set of options in the matrix, save the
+    best and return all results"""
+    import cocotb_utils as cu
+    if not telemetry.enabled():
+        raise SystemExit('the tuner measures runs via telemetry, unset RV_TELEMETRY=0')
+    results = []
+    for options in matrix:
+        print(f'INFO: building {design} with {" ".join(options)}')
+        shutil.rmtree(cu.simBuildDir(profile), ignore_errors=True)
+        env = dict(os.environ, **{
+            cu.BUILD_PROFILE_ENV: profile,
+            BUILD_OPTIONS_ENV: ' '.join(options),
+            'RV_BUILD_CACHE': '0', # measure the real compile time
+            'RV_RERUN_FAILURES': '0',
+        })
+        start = time.time()
+        proc = subprocess.run([sys.executable, '-m', 'pytest', '-q', f'testbench.py::{runner}', '--tests', tests],
+                              env=env)
+        if proc.returncode != 0:
+            print(f'WARNING: tests failed with {" ".join(options)}, skipping these options')
+            continue
+        records = [r for r in telemetry.readRecords([telemetry.telemetryPath()]) if r['timestamp'] >= start]
+        results.append(dict(options=options, **measure(records, runner)))
+        pass
+    if len(results) == 0:
+        raise SystemExit('ERROR: no options worked, see the pytest output above')
+
+    tuning = loadTuning()
+    tuning.setdefault(design, {})[profile] = dict(max(results, key=score), runner=runner, tests=tests, results=results)
+    with open(tuningPath(), 'w') as f:
+        json.dump(tuning, f, indent=2)
+        pass
+    return results
+
+def table(results):
+    best = max(results, key=score)
+    lines = [f'{"options":<40} {"build sec":>9} {"test sec":>9} {"cycles/sec":>11}']
+    for r in results:
+        rate = f'{r["cycles_per_sec"]:>11.0f}' if r['cycles_per_sec'] is not None else f'{"":>11}'
+        marker = ' <= best' if r is best else ''
+        lines.append(f'{" ".join(r["options"]):<40} {r["build_seconds"]:>9.2f} {r["test_seconds"]:>9.2f} {rate}{marker}')
+        pass
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the fastest Verilator options for a design')
+    parser.add_argument('--runner', default='runCocotbTestsProcessor', help='pytest runner function to tune with')
+    parser.add_argument('--design', default='Processor', help='toplevel module that the runner builds')
+    parser.add_argument('--tests', default='dhrystone', help="cocotb tests to run, or '' for all of the runner's tests")
+    parser.add_argument('--threads', default=','.join(map(str, THREADS)))
+    parser.add_argument('--profile', default='fast', help='build profile to tune')
+    parser.add_argument('--output-splits', default=','.join(map(str, OUTPUT_SPLITS)))
+    args = parser.parse_args()
+    matrix = optionsMatrix([int(t) for t in args.threads.split(',')], [int(s) for s in args.output_splits.split(',')])
+    results = tune(args.runner, args.design, args.tests, matrix, args.profile)
+    print(table(results))
+    print(f'wrote the best options for {args.design} under the {args.profile} profile to {tuningPath()}')
+    pass
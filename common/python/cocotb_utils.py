@@ -1,24 +1,68 @@
 """This file has code used across several testbenches."""
 
 from pathlib import Path
-import os, re
+from array import array
+import os, sys
+from cocotb.triggers import RisingEdge, First, Timer
+from cocotb.utils import get_sim_time
+import time
+import trace_utils
+import cycle_accounting
+import sv_constants
+import telemetry
 
 # Use half the available cores for Verilator's parallel build
 os.environ['MAKEFLAGS'] = '-j%d' % int(os.cpu_count()/2)
 
-VERILATOR_FLAGS = [
+VERILATOR_BASE_FLAGS = [
     '--assert',
     '-Wall',
     '-Wno-DECLFILENAME',
-    '--trace',
-    '--trace-fst',
-    '--trace-structs',
-    # NB: --trace-max-array must be ≥ size of the memory (in 4B words) for memory to appear in the waveforms
-    '--trace-max-array',str(2**18)
     ]
 
+# Verilator flags for each build profile. 'debug' compiles in FST tracing so that waveforms can be dumped, while
+# 'fast' leaves out all tracing code and optimizes for simulation speed instead.
+BUILD_PROFILES = {
+    'debug': VERILATOR_BASE_FLAGS + [
+        '--trace',
+        '--trace-fst',
+        '--trace-structs',
+        # NB: --trace-max-array must be ≥ size of the memory (in 4B words) for memory to appear in the waveforms
+        '--trace-max-array',str(2**18)
+    ],
+    'fast': VERILATOR_BASE_FLAGS + [
+        '-O3',
+        '--x-assign','fast',
+        '--x-initial','fast',
+    ],
+}
+BUILD_PROFILE_ENV = 'RV_BUILD_PROFILE'
+
+def insideAutograder():
+    return os.path.isdir('/autograder/submission')
+
+def buildProfile():
+    """Returns the build profile named by RV_BUILD_PROFILE (set by pytest's `--build-profile` flag), or else 'fast'.
+    Failing tests are rerun under 'debug' to get their waveforms, see debug_rerun.py."""
+    profile = os.environ.get(BUILD_PROFILE_ENV) or 'fast'
+    if profile not in BUILD_PROFILES:
+        raise ValueError(f'unknown build profile {profile}, expected one of {", ".join(BUILD_PROFILES)}')
+    return profile
+
+BUILD_PROFILE = buildProfile()
+# so that the simulator process, and telemetry, see the same profile
+os.environ[BUILD_PROFILE_ENV] = BUILD_PROFILE
+
+VERILATOR_FLAGS = BUILD_PROFILES[BUILD_PROFILE]
+
+def simBuildDir(profile=None):
+    """Returns the directory where the simulator for the given build profile (default: the current one) is built.
+    Each build profile has its own, so switching between them doesn't rebuild the simulator every time."""
+    profile = profile or BUILD_PROFILE
+    return "sim_build" if profile == 'debug' else f"sim_build_{profile}"
+
 # directory where our simulator will compile our tests + code
-SIM_BUILD_DIR = "sim_build"
+SIM_BUILD_DIR = simBuildDir()
 
 # simulator to use
 SIM = "verilator"
@@ -29,6 +73,15 @@ RISCV_BENCHMARKS_PATH = Path('../../riscv-tests/benchmarks')
 
 POINTS_FILE = 'points.json'
 
+# tracing mode for the riscv-tests that don't otherwise check a trace, e.g., 'cosim' to check every one of them
+# against our RV32IM golden model (see riscv_iss.py)
+RISCV_TESTS_TRACING_MODE = os.environ.get('RV_TESTS_TRACING_MODE')
+
+# build the processor with a TraceCapture buffer (see common/sv/TraceCapture.sv), so that handleTrace() can read the
+# trace in bulk rather than sampling it every cycle
+TRACE_CAPTURE = os.environ.get('RV_TRACE_CAPTURE', '0') != '0'
+TRACE_CAPTURE_SV = Path(__file__).resolve().parent / '..' / 'sv' / 'TraceCapture.sv'
+
 def assertEquals(expected, actual, msg=''):
     """Wrapper around regular assert, with automatic formatting of values in hex"""
     if expected != actual:
@@ -43,14 +96,21 @@ def assertEquals(expected, actual, msg=''):
         pass
     pass
 
-def shouldGenerateWaveforms():
-    """Returns True if simulator should generate waveforms, and False otherwise. Disable waveforms (only) when running autograder, for faster execution."""
-    insideAutograder = os.path.isdir('/autograder/submission')
-    if insideAutograder:
-        print('[cocotb_utils.py] autograder run detected, waveform generation disabled')
+def shouldGenerateWaveforms(profile=None):
+    """Returns True if simulator should generate waveforms, and False otherwise. Waveforms need the 'debug' build
+    profile, which we don't use in the autograder, for faster execution."""
+    if (profile or BUILD_PROFILE) != 'debug':
+        if insideAutograder():
+            print('[cocotb_utils.py] autograder run detected, waveform generation disabled')
+            pass
         return False
     return True
 
+def resultsFileName():
+    """The name of the results file that cocotb's runner writes under pytest"""
+    testName = os.environ['PYTEST_CURRENT_TEST'].split(':')[-1].split(' ')[0]
+    return f'{testName}.None'
+
 def aggregateTestResults(*results):
     """Aggregates total/failed counts from all arguments, where each argument is a call to cocotb.runner.get_results()"""
     total_tests = sum([r[0] for r in results])
@@ -62,21 +122,8 @@ def aggregateTestResults(*results):
         }
 
 def extractSVEnum(file_path, enum_name):
-    """Parse a SystemVerilog enum into a dictionary mapping int to string values"""
-    with open(file_path, 'r') as file:
-        content = file.read()
-
-        pattern = re.compile(rf'typedef\s+enum\s+\{{(.*?)\}}\s+{enum_name};', re.DOTALL)
-        match = pattern.search(content)
-        
-        if not match:
-            raise ValueError(f"Enum {enum_name} not found in the file.")
-
-        enum_body = match.group(1)
-        enum_constants = re.findall(r'(\w+)\s*=\s*(\d+)', enum_body)
-        
-        return {name: int(value) for name, value in enum_constants}
-    pass
+    """Parse a SystemVerilog enum into a dictionary mapping names to int values (see sv_constants.py)"""
+    return sv_constants.svEnum(file_path, enum_name)
 
 def intToEnumString(value, enum_dict):
     result = []
@@ -97,27 +144,348 @@ def enumStringToInt(enum_string, enum_dict):
         pass
     return value
 
+# NB: relative to this file, so that it works from any directory
+CYCLE_STATUS_FILE = Path(__file__).resolve().parent / '..' / '..' / 'hw3-singlecycle' / 'cycle_status.sv'
+
 _CYCLE_STATUS_ENUM = None
 
-def handleTrace(dut, trace, traceIdx, tracingMode):
+def cycleStatusEnum():
+    """Returns the cycle_status_e enum as a dictionary mapping names to int values"""
     global _CYCLE_STATUS_ENUM
     if _CYCLE_STATUS_ENUM is None:
-        _CYCLE_STATUS_ENUM = extractSVEnum('../../hw3-singlecycle/cycle_status.sv', 'cycle_status_e')
+        _CYCLE_STATUS_ENUM = extractSVEnum(CYCLE_STATUS_FILE, 'cycle_status_e')
+        pass
+    return _CYCLE_STATUS_ENUM
+
+def loadTrace(testName):
+    """Load the expected trace for the given test, from either trace-TESTNAME.rvtrace or trace-TESTNAME.json. Must be
+    called from the sim_build directory. JSON traces are converted to binary (in sim_build) the first time they are used."""
+    # use ../ since we run from the sim_build directory
+    return trace_utils.loadTrace('..', testName, cycleStatusEnum(), cacheDir='.')
+
+def traceWriter(testName):
+    """Returns a TraceWriter for generating the trace of the given test, to trace-TESTNAME.json in the current
+    (sim_build) directory. Records are written out as the test runs, but the trace file only appears once close() is
+    called, which tests do when they pass."""
+    return trace_utils.TraceWriter(f'trace-{testName}.json', cycleStatusEnum())
+
+class TraceProbe:
+    """Samples a processor's trace signals. The signal handles are looked up once, when the probe is created,
+    rather than by name on every cycle, and samples are plain ints: cycle status is decoded into enum names
+    only when reporting a trace mismatch."""
+
+    def __init__(self, dut):
+        self.dut = dut
+        self.cycles = dut.datapath.cycles_current
+        self.pc = dut.datapath.trace_completed_pc
+        self.insn = dut.datapath.trace_completed_insn
+        self.status = dut.datapath.trace_completed_cycle_status
+        # looked up on first use, since only cosim needs it
+        self.regs = None
+        pass
+
+    def sample(self):
+        """Returns the current (cycle, pc, insn, status)"""
+        return (self.cycles.value.integer, self.pc.value.integer, self.insn.value.integer, self.status.value.integer)
+
+    def sampleCompleted(self):
+        """Returns the (pc, insn, status) of the insn completing in the current cycle"""
+        return (self.pc.value.integer, self.insn.value.integer, self.status.value.integer)
+
+    def readRegister(self, r):
+        """Returns the current value of register r"""
+        if self.regs is None:
+            self.regs = self.dut.datapath.rf.regs
+            pass
+        return self.regs[r].value.integer
+
+_TRACE_PROBE = None
+
+def traceProbe(dut):
+    """Returns a TraceProbe for the given dut, reusing it across cycles and tests"""
+    global _TRACE_PROBE
+    if _TRACE_PROBE is None or _TRACE_PROBE.dut is not dut:
+        _TRACE_PROBE = TraceProbe(dut)
+        pass
+    return _TRACE_PROBE
+
+def traceCaptureBuild(clock, negedge=False):
+    """Returns the extra (verilog_sources, build_args) for building a Processor with a TraceCapture buffer, which
+    samples the trace on the given edge of the given clock. These are empty unless TRACE_CAPTURE is set."""
+    if not TRACE_CAPTURE:
+        return [], []
+    return [TRACE_CAPTURE_SV], [f'-DTRACE_CAPTURE_CLOCK={clock}', f'-DTRACE_CAPTURE_NEGEDGE={int(negedge)}']
+
+MEMORY_BACKDOOR_SV = Path(__file__).resolve().parent / '..' / 'sv' / 'MemoryBackdoor.sv'
+
+def memoryBackdoorBuild(clock, negedge=False, axil=False):
+    """Returns the extra (verilog_sources, build_args) for building a Processor whose memory has a MemoryBackdoor,
+    which riscv_binary_utils uses to load programs and to track stores. The memory writes on the given edge of the
+    given clock, and is a MemorySingleCycle, or an EasyAxilMemory if axil is set."""
+    args = [f'-DMEMORY_BACKDOOR_CLOCK={clock}', f'-DMEMORY_BACKDOOR_NEGEDGE={int(negedge)}']
+    return [MEMORY_BACKDOOR_SV], args + (['-DMEMORY_BACKDOOR_AXIL'] if axil else [])
+
+class TraceCapture:
+    """Reads the trace from a processor's TraceCapture buffer in bulk, and either appends it to a TraceWriter
+    (tracingMode == 'generate') or checks it against the expected trace (tracingMode == 'compare'). Must be created
+    right after the test's setup, before the processor runs any cycles."""
+
+    RECORD_WORDS = 4
+
+    def __init__(self, dut, trace, tracingMode):
+        self.trace = trace
+        self.tracingMode = tracingMode
+        self.capture = dut.trace_capture
+        self.count = self.capture.count
+        self.records = self.capture.records
+        self.depth = self.records.value.n_bits // (32 * TraceCapture.RECORD_WORDS)
+        # read the buffer once half of it has filled up, so that it never overflows between reads
+        self.drainCycles = self.depth // 2
+        self.consumed = self.count.value.integer
+        # the buffer may or may not have captured the current cycle yet, cocotb never samples it
+        self.skipCycle = dut.datapath.cycles_current.value.integer
+        self.traceIdx = 0
+        # a CycleAccounting to add each record to, see runUntilHalt()
+        self.accounting = None
+        self.flushed = False
+        pass
+
+    def cycle(self, cycles):
+        """Called by handleTrace() every cycle, reads the buffer every drainCycles cycles"""
+        if cycles % self.drainCycles == self.drainCycles - 1:
+            self.drain()
+            pass
+        pass
+
+    def drain(self):
+        """Handle all records captured since the last drain()"""
+        count = self.count.value.integer
+        pending = count - self.consumed
+        if pending == 0:
+            return
+        assert pending <= self.depth, f'trace capture buffer overflowed, {pending} records pending'
+        words = array('I', self.records.value.integer.to_bytes(self.depth * 4 * TraceCapture.RECORD_WORDS, 'little'))
+        if sys.byteorder == 'big':
+            words.byteswap()
+            pass
+        for i in range(self.consumed, count):
+            w = (i % self.depth) * TraceCapture.RECORD_WORDS
+            record = (words[w], words[w+1], words[w+2], words[w+3])
+            if self.skipCycle is not None:
+                skip = record[0] == self.skipCycle
+                self.skipCycle = None
+                if skip:
+                    continue
+                pass
+            if self.accounting is not None:
+                self.accounting.add(record[3])
+                pass
+            if self.tracingMode == 'generate':
+                self.trace.append(*record)
+            else:
+                expected = self.trace[self.traceIdx]
+                if not trace_utils.recordsMatch(expected[1:], record[1:], self.trace.statusMask):
+                    _reportTraceMismatch(expected, record[1:])
+                    pass
+                pass
+            self.traceIdx += 1
+            pass
+        self.consumed = count
         pass
+
+    async def flush(self):
+        """Wait for the buffer to capture the current cycle, then handle all remaining records. Only the first call
+        does anything, as the processor is done by then."""
+        if self.flushed:
+            return
+        self.flushed = True
+        await RisingEdge(self.capture.sample_edge)
+        self.drain()
+        pass
+
+    def close(self):
+        self.trace.close()
+        pass
+
+def traceCapture(dut, trace, tracingMode):
+    """Returns a TraceCapture wrapping the given trace if the processor was built with one (see traceCaptureBuild())
+    and tracingMode is 'generate' or 'compare', and the trace itself otherwise"""
+    if tracingMode not in ('generate', 'compare'):
+        return trace
+    try:
+        dut.trace_capture
+    except AttributeError:
+        return trace
+    return TraceCapture(dut, trace, tracingMode)
+
+async def finishTrace(dut, clock, trace, tracingMode):
+    """Handle any trace records that handleTrace() has not checked yet, when a test halts or times out. clock is the
+    processor clock, as for runUntilHalt()."""
+    if isinstance(trace, TraceCapture):
+        await trace.flush()
+    elif tracingMode == 'record':
+        trace.close()
+    elif tracingMode == 'cosim' and trace.pendingWrite is not None:
+        # the last insn's register write lands on the next clock edge
+        await RisingEdge(clock)
+        probe = traceProbe(dut)
+        trace.checkPendingWrite(probe.cycles.value.integer, probe.readRegister)
+        pass
+    pass
+
+def traceRecorder(testName):
+    """Returns a TraceRecorder that records the trace of the given test, and compares it against the expected
+    trace (see loadTrace()) when closed"""
+    return trace_utils.TraceRecorder(loadTrace(testName))
+
+def cosim(binaryPath):
+    """Returns a riscv_iss.Cosim for checking a processor running the given binary against our golden model"""
+    import riscv_iss, riscv_binary_utils
+    return riscv_iss.Cosim(riscv_binary_utils.MemoryImage.fromBinary(binaryPath), cycleStatusEnum()['CYCLE_NO_STALL'])
+
+def makeTrace(binaryPath, tracingMode):
+    """Returns the trace for handleTrace() to use while running the given binary under the given tracingMode"""
+    if tracingMode == 'compare':
+        return loadTrace(binaryPath.name)
     if tracingMode == 'generate':
-        traceElem = {}
-        traceElem['cycle'] = dut.datapath.cycles_current.value.integer
-        traceElem['trace_completed_pc'] = f'0x{dut.datapath.trace_completed_pc.value.integer:x}'
-        traceElem['trace_completed_insn'] = f'0x{dut.datapath.trace_completed_insn.value.integer:08x}'
-        status_int = dut.datapath.trace_completed_cycle_status.value.integer
-        traceElem['trace_completed_cycle_status'] = intToEnumString(status_int, _CYCLE_STATUS_ENUM)
-        trace.append(traceElem)
+        return traceWriter(binaryPath.name)
+    if tracingMode == 'record':
+        return traceRecorder(binaryPath.name)
+    if tracingMode == 'cosim':
+        return cosim(binaryPath)
+    return []
+
+def handleTrace(dut, trace, traceIdx, tracingMode):
+    """Handle one cycle of tracing. With tracingMode == 'generate', trace is a TraceWriter (see traceWriter()) that
+    we append this cycle to. With tracingMode == 'compare', trace is the expected trace (see loadTrace()) and we
+    check this cycle against its traceIdx-th record. With tracingMode == 'record', trace is a TraceRecorder (see
+    traceRecorder()) that records this cycle, to be checked all at once when the test ends. With
+    tracingMode == 'cosim', trace is a Cosim (see cosim()) that checks this cycle against the golden model.
+    With generate or compare, trace may also be a TraceCapture (see traceCapture()), which handles the
+    records captured by the processor every few hundred cycles instead."""
+    if isinstance(trace, TraceCapture):
+        trace.cycle(traceIdx)
+    elif tracingMode == 'generate':
+        if isinstance(trace, trace_utils.TraceWriter):
+            trace.append(*traceProbe(dut).sample())
+        else:
+            # a list of trace-*.json records
+            trace.append(trace_utils.intsToJsonRecord(traceProbe(dut).sample(), cycleStatusEnum()))
+            pass
     elif tracingMode == 'compare':
-        traceElem = trace[traceIdx]
-        msg = f'trace validation error at cycle {traceElem["cycle"]}'
-        assertEquals(int(traceElem['trace_completed_pc'],16), dut.datapath.trace_completed_pc.value.integer, msg)
-        assertEquals(int(traceElem['trace_completed_insn'],16), dut.datapath.trace_completed_insn.value.integer, msg)
-        actual_status = intToEnumString(dut.datapath.trace_completed_cycle_status.value.integer, _CYCLE_STATUS_ENUM)
-        assertEquals(traceElem['trace_completed_cycle_status'], actual_status, msg)
+        if isinstance(trace, trace_utils.Trace):
+            expected, mask = trace[traceIdx], trace.statusMask
+        else:
+            # a list of trace-*.json records
+            expected = trace_utils.jsonRecordToInts(trace[traceIdx], cycleStatusEnum())
+            mask = trace_utils.statusMask(cycleStatusEnum())
+            pass
+        actual = traceProbe(dut).sampleCompleted()
+        if not trace_utils.recordsMatch(expected[1:], actual, mask):
+            _reportTraceMismatch(expected, actual)
+            pass
+    elif tracingMode == 'record':
+        trace.append(*traceProbe(dut).sample())
+    elif tracingMode == 'cosim':
+        probe = traceProbe(dut)
+        trace.check(*probe.sample(), probe.readRegister)
         pass
     return
+
+def _reportTraceMismatch(expected, actual):
+    expectedCycle, expectedPc, expectedInsn, expectedStatus = expected
+    actualPc, actualInsn, actualStatus = actual
+    msg = f'trace validation error at cycle {expectedCycle}'
+    assertEquals(expectedPc, actualPc, msg)
+    assertEquals(expectedInsn, actualInsn, msg)
+    assertEquals(intToEnumString(expectedStatus, cycleStatusEnum()), intToEnumString(actualStatus, cycleStatusEnum()), msg)
+    pass
+
+def cycleAccounting(binaryName):
+    """Returns a CycleAccounting for runUntilHalt() to tally the cycles of the given binary in, if cycle accounting
+    is enabled (see cycle_accounting.py), and None otherwise"""
+    if not cycle_accounting.CYCLE_ACCOUNTING:
+        return None
+    return cycle_accounting.CycleAccounting(binaryName, cycleStatusEnum())
+
+def _needsEveryCycle(trace, tracingMode, accounting):
+    """Returns True if we must sample the processor every cycle"""
+    if isinstance(trace, TraceCapture):
+        return False
+    return tracingMode is not None or accounting is not None
+
+async def runUntilHalt(dut, clock, maxCycles, trace=None, tracingMode=None, progressCycles=None, accounting=None):
+    """Run the processor until dut.halt is set, for at most maxCycles rising edges of clock. Returns the number of
+    cycles run before the one where halt was seen (i.e., the index of that cycle, counting from 0), or None if
+    the processor did not halt in time.
+
+    With a tracingMode that needs every cycle (see handleTrace()), this wakes up on every rising edge of the clock.
+    Otherwise it waits for halt to rise or for a timer to expire, so that Python runs only when the processor halts,
+    when a TraceCapture needs reading, or every progressCycles cycles to log how far along we are.
+
+    If accounting is a CycleAccounting (see cycleAccounting()), every cycle's status is added to it, and its report
+    is logged and written out when the run ends."""
+    everyCycle = _needsEveryCycle(trace, tracingMode, accounting)
+    probe = traceProbe(dut) if accounting is not None else None
+    wakeCycles = maxCycles
+    if isinstance(trace, TraceCapture):
+        wakeCycles = trace.drainCycles
+        trace.accounting = accounting
+        pass
+    if progressCycles is not None:
+        wakeCycles = min(wakeCycles, progressCycles)
+        pass
+
+    wallStart = time.perf_counter()
+    simStart = get_sim_time('ns')
+    start = None
+    period = None
+    # index of the next rising edge, counting from 0
+    cycles = 0
+    while cycles < maxCycles:
+        # number of edges to run for, so that we land on the next multiple of wakeCycles
+        edges = min(-(-cycles // wakeCycles) * wakeCycles - cycles + 1, maxCycles - cycles)
+        if everyCycle or period is None or edges == 1:
+            await RisingEdge(clock)
+        else:
+            # stop half a cycle early, so that we always resume on the clock edge itself
+            timeout = Timer(period * edges - period // 2, 'step')
+            fired = await First(RisingEdge(dut.halt), timeout)
+            if fired is timeout or (get_sim_time() - start) % period != 0:
+                await RisingEdge(clock)
+                pass
+            pass
+
+        now = get_sim_time()
+        if start is None:
+            start = now
+        elif period is None:
+            period = now - start
+            pass
+        cycles = (now - start) // period if period is not None else 0
+
+        if everyCycle:
+            handleTrace(dut, trace, cycles, tracingMode)
+            if accounting is not None:
+                accounting.add(probe.status.value.integer)
+                pass
+        elif isinstance(trace, TraceCapture):
+            trace.drain()
+            pass
+        if progressCycles is not None and cycles > 0 and 0 == cycles % progressCycles:
+            dut._log.info(f'ran {int(cycles/1000)}k cycles...')
+            pass
+        if dut.halt.value == 1:
+            break
+        cycles += 1
+        pass
+    telemetry.recordRun(time.perf_counter() - wallStart, min(cycles + 1, maxCycles), get_sim_time('ns') - simStart,
+                        tracing_mode=tracingMode)
+    if accounting is not None:
+        if isinstance(trace, TraceCapture):
+            await trace.flush()
+            pass
+        dut._log.info('cycle accounting\n' + accounting.table())
+        accounting.write()
+        pass
+    return cycles if cycles < maxCycles else None
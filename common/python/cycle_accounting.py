@@ -0,0 +1,116 @@
+"""Cycle accounting: where does a processor spend its cycles? Every cycle is classified by its cycle status (see
+cycle_status.sv), and a CycleAccounting tallies these to report the CPI and how many cycles each kind of stall
+costs. A cycle may have several stall reasons at once, so the per-status counts can add up to more than the total.
+
+Accounting runs during riscvTest and dhrystone when RV_CYCLE_ACCOUNTING=1 is set (see cocotb_utils.runUntilHalt()),
+writing cycles-BINARY.json to the sim_build directory and logging a table. It can also be run on existing traces:
+    python3 cycle_accounting.py trace-dhrystone.riscv.json [...]
+"""
+
+from pathlib import Path
+import json
+import os
+import sys
+
+import trace_utils
+
+CYCLE_ACCOUNTING = os.environ.get('RV_CYCLE_ACCOUNTING', '0') != '0'
+
+NO_STALL = 'CYCLE_NO_STALL'
+INVALID = 'CYCLE_INVALID'
+
+class CycleAccounting:
+    """Tallies the cycle status of each cycle of one binary's run"""
+
+    def __init__(self, name, statusEnum):
+        self.name = name
+        self.statusEnum = statusEnum
+        # cycle status value => number of cycles with that status. Combinations of stall reasons are split into
+        # their individual reasons only when reporting, to keep add() cheap.
+        self.counts = {}
+        pass
+
+    def add(self, status):
+        """Account for one cycle with the given status"""
+        self.counts[status] = self.counts.get(status, 0) + 1
+        pass
+
+    def addTrace(self, records):
+        """Account for each (cycle, pc, insn, status) record"""
+        for record in records:
+            self.add(record[3])
+            pass
+        pass
+
+    def cycles(self):
+        return sum(self.counts.values())
+
+    def statusCycles(self):
+        """Returns a dict mapping each cycle status name to the number of cycles that had it, in enum order"""
+        result = {}
+        for name, value in sorted(self.statusEnum.items(), key=lambda item: item[1]):
+            if value == 0:
+                result[name] = self.counts.get(0, 0)
+            else:
+                result[name] = sum(count for status, count in self.counts.items() if status & value)
+                pass
+            pass
+        return result
+
+    def summary(self):
+        """Returns the cycles, insns, CPI and per-status cycle counts"""
+        cycles = self.cycles()
+        statusCycles = self.statusCycles()
+        insns = statusCycles.get(NO_STALL, 0)
+        return {
+            'binary': self.name,
+            'cycles': cycles,
+            'insns': insns,
+            'cpi': cycles / insns if insns > 0 else None,
+            'stall_cycles': cycles - insns,
+            'status_cycles': statusCycles,
+        }
+
+    def table(self):
+        """Returns the summary as a table, listing only the statuses that occurred"""
+        s = self.summary()
+        cpi = f'{s["cpi"]:.3f}' if s['cpi'] is not None else 'n/a'
+        lines = [f'{self.name}: {s["cycles"]} cycles, {s["insns"]} insns, CPI {cpi}',
+                 f'{"cycle status":<20} {"cycles":>8} {"% cycles":>8} {"CPI adder":>9}']
+        for name, count in s['status_cycles'].items():
+            if count == 0:
+                continue
+            # the CPI contribution of each kind of stall, the no-stall cycles contribute exactly 1
+            adder = f'{count / s["insns"]:9.3f}' if s['insns'] > 0 else f'{"n/a":>9}'
+            lines.append(f'{name:<20} {count:>8} {100 * count / s["cycles"]:>7.1f}% {adder}')
+            pass
+        return '\n'.join(lines)
+
+    def write(self, outputDir='.'):
+        """Write the summary to cycles-NAME.json in outputDir, and return its path"""
+        outputPath = Path(outputDir) / f'cycles-{self.name}.json'
+        with open(outputPath, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            pass
+        return outputPath
+
+def fromTrace(tracePath, statusEnum):
+    """Returns the CycleAccounting for an existing JSON or binary trace file"""
+    tracePath = Path(tracePath)
+    name = tracePath.stem[len('trace-'):] if tracePath.stem.startswith('trace-') else tracePath.stem
+    accounting = CycleAccounting(name, statusEnum)
+    accounting.addTrace(trace_utils.iterTrace(tracePath, statusEnum))
+    return accounting
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'usage: {sys.argv[0]} TRACE_FILE...')
+        sys.exit(1)
+    import cocotb_utils
+    for tracePath in sys.argv[1:]:
+        accounting = fromTrace(tracePath, cocotb_utils.cycleStatusEnum())
+        print(accounting.table())
+        print(f'wrote {accounting.write(Path(tracePath).parent)}')
+        print()
+        pass
+    pass
@@ -0,0 +1,141 @@
+"""Rerun failing tests with waveforms. Tests normally run under the 'fast' build profile, without any waveforms (see
+cocotb_utils.BUILD_PROFILES). When some fail, we build (or reuse, via build_cache.py) the same design under the
+'debug' profile and rerun just the failing tests there, leaving their waveforms in the sim_build directory. Processor
+tests are rerun one at a time, each dumping only the WAVES_WINDOW_CYCLES cycles before the point where it failed (see
+waves.py) to sim_build/TEST.fst, or everything if that windowed rerun doesn't produce waveforms. Other designs are
+small, so their failing tests dump everything to sim_build/dump.fst.
+
+Reruns are skipped in the autograder and under the 'debug' profile, which already has waveforms. Set
+RV_RERUN_FAILURES=0 to disable them.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+import os
+import xml.etree.ElementTree as ET
+
+from cocotb.runner import get_runner
+
+import build_cache
+import cocotb_utils as cu
+import telemetry
+import waves
+
+RERUN_FAILURES = os.environ.get('RV_RERUN_FAILURES', '1') != '0'
+
+# simulator log of the windowed reruns, the others go in rerun.log
+WINDOWED_LOG = 'rerun_windowed.log'
+
+def failedTests(resultsFile):
+    """Returns a dict mapping the name of each failed test in the given cocotb results file to the simulated time,
+    in ns from the start of the test, at which it failed"""
+    return {tc.get('name'): float(tc.get('sim_time_ns', 0))
+            for tc in ET.parse(resultsFile).iter('testcase') if next(tc.iter('failure'), None) is not None}
+
+@contextmanager
+def _environ(**variables):
+    # cocotb's runner gives os.environ precedence over its extra_env argument, so set the simulator's environment here
+    saved = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+                pass
+            pass
+        pass
+    pass
+
+def test(runr, **testArgs):
+    """Like runr.test(), but reruns any failed tests with waveforms before raising SystemExit"""
+    try:
+        runr.test(**testArgs)
+    except SystemExit:
+        rerunFailures(runr, Path(runr.test_dir, cu.resultsFileName()), testArgs['hdl_toplevel'],
+                      testArgs['test_module'], seed=testArgs.get('seed'))
+        raise
+    pass
+
+def rerunFailures(runr, resultsFile, hdl_toplevel, test_module, seed=None):
+    """Rerun the failed tests in the given results file with waveforms, against the design that runr built via
+    build_cache.build()"""
+    if not RERUN_FAILURES or cu.insideAutograder() or cu.BUILD_PROFILE == 'debug' or not Path(resultsFile).is_file():
+        return
+    failed = failedTests(resultsFile)
+    if len(failed) == 0:
+        return
+
+    # the same design, with the debug profile's Verilator flags instead of the current profile's
+    buildArgs = dict(runr.cacheBuildArgs)
+    profileFlags = cu.VERILATOR_FLAGS
+    assert buildArgs['build_args'][:len(profileFlags)] == profileFlags, 'build_args must start with cu.VERILATOR_FLAGS'
+    wavesSources, wavesArgs = waves.wavesBuild(hdl_toplevel, 'debug')
+    buildDir = cu.simBuildDir('debug')
+    buildArgs.update(
+        verilog_sources=list(buildArgs['verilog_sources']) + wavesSources,
+        build_args=cu.BUILD_PROFILES['debug'] + buildArgs['build_args'][len(profileFlags):] + wavesArgs,
+        build_dir=buildDir,
+        waves=True,
+        build_profile='debug',
+    )
+    print(f'INFO: rerunning {len(failed)} failed tests with waveforms, under the debug build profile')
+    debugRunner = get_runner(cu.SIM)
+    with telemetry.phase('build', build_profile='debug') as build:
+        build['cache_hit'] = build_cache.build(debugRunner, **buildArgs)
+        pass
+
+    windowed = len(wavesSources) > 0
+    for tests in ([[t] for t in failed] if windowed else [list(failed)]):
+        dumpFile = Path(buildDir, 'dump.fst')
+        args = dict(runr=debugRunner, tests=tests, hdl_toplevel=hdl_toplevel, test_module=test_module, seed=seed,
+                    buildDir=buildDir)
+        if windowed:
+            dumpFile.unlink(missing_ok=True)
+            completed = _rerun(windowEnd=failed[tests[0]], **args)
+            if not completed or not dumpFile.is_file():
+                print(f'WARNING: windowed waveforms for {tests[0]} failed, see {Path(buildDir, WINDOWED_LOG)}, '
+                      'dumping the whole test instead')
+                _rerun(windowEnd=None, **args)
+                pass
+            if dumpFile.is_file():
+                dumpFile = dumpFile.replace(Path(buildDir, f'{tests[0]}.fst'))
+                pass
+        else:
+            _rerun(windowEnd=None, **args)
+            pass
+        print(f'INFO: waveforms for {", ".join(tests)} are in {dumpFile}')
+        pass
+    pass
+
+def _rerun(runr, tests, hdl_toplevel, test_module, seed, buildDir, windowEnd):
+    """Rerun the given tests under the debug profile. If windowEnd is given, only the cycles before that simulated
+    time (in ns from the start of the test) are dumped via the WaveWindow, and otherwise the simulator dumps
+    everything. Returns True if the simulator ran to completion."""
+    env = {cu.BUILD_PROFILE_ENV: 'debug'}
+    if windowEnd is not None:
+        env[waves.WAVES_WINDOWED_ENV] = '1'
+        env[waves.WAVES_WINDOW_END_ENV] = str(windowEnd)
+        pass
+    # cocotb's runner removes this before running the simulator, which writes it once all the tests have run
+    resultsFile = Path(buildDir, cu.resultsFileName())
+    with _environ(**env):
+        try:
+            runr.test(
+                seed=seed,
+                # a windowed run dumps via its WaveWindow instead
+                waves=windowEnd is None,
+                hdl_toplevel=hdl_toplevel,
+                hdl_toplevel_lang='verilog',
+                build_dir=buildDir,
+                test_module=test_module,
+                testcase=tests,
+                log_file=Path(buildDir, 'rerun.log' if windowEnd is None else WINDOWED_LOG),
+            )
+        except SystemExit:
+            pass # these tests failed already, we're only after their waveforms
+        pass
+    return resultsFile.is_file()
@@ -0,0 +1,417 @@
+"""A small, table-driven RV32IM assembler for the inline code used in our testbenches.
+
+This lets tests skip running the real assembler for simple snippets. It only
+accepts a subset of GNU as syntax: one insn per line (or `;`-separated),
+`label:` definitions, `#` comments, the base RV32IM insns and the `li`, `mv`,
+`nop` and `j` pseudo-insns. Anything else raises UnsupportedAssembly, and
+callers should fall back to GNU as, as riscv_binary_utils.asm() does.
+
+Output must be bit-identical to GNU as. REFERENCE_FILE holds GNU as's encodings
+of all the code in our testbenches, and `python3 riscv_assembler.py` (or
+`make asmcheck` from a homework directory) checks our output against it, and
+against GNU as and llvm-mc themselves if they are installed. After changing
+testbench code, regenerate it with `python3 riscv_assembler.py --update-reference`
+on a machine with GNU as.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# GNU as's encodings of our testbench code, keyed by codeKey()
+REFERENCE_FILE = Path(__file__).resolve().parent / 'riscv_assembler_reference.json'
+
+# another assembler to check against, which is easier to install than GNU as. Its encodings aren't a reference though.
+LLVM_MC = 'llvm-mc'
+
+class UnsupportedAssembly(Exception):
+    """Raised for code this assembler does not handle. The code may still be valid for GNU as."""
+    pass
+
+REGISTER_NUMBERS = {f'x{i}': i for i in range(32)}
+REGISTER_NUMBERS.update({name: i for i, name in enumerate([
+    'zero', 'ra', 'sp', 'gp', 'tp', 't0', 't1', 't2', 's0', 's1', 'a0', 'a1', 'a2', 'a3', 'a4', 'a5',
+    'a6', 'a7', 's2', 's3', 's4', 's5', 's6', 's7', 's8', 's9', 's10', 's11', 't3', 't4', 't5', 't6'])})
+REGISTER_NUMBERS['fp'] = 8
+
+# insn format, opcode, funct3, funct7 for each real insn we support
+INSNS = {
+    'lui':   ('U', 0b0110111, 0, 0),
+    'auipc': ('U', 0b0010111, 0, 0),
+    'jal':   ('J', 0b1101111, 0, 0),
+    'jalr':  ('L', 0b1100111, 0b000, 0),
+
+    'beq':  ('B', 0b1100011, 0b000, 0),
+    'bne':  ('B', 0b1100011, 0b001, 0),
+    'blt':  ('B', 0b1100011, 0b100, 0),
+    'bge':  ('B', 0b1100011, 0b101, 0),
+    'bltu': ('B', 0b1100011, 0b110, 0),
+    'bgeu': ('B', 0b1100011, 0b111, 0),
+
+    'lb':  ('L', 0b0000011, 0b000, 0),
+    'lh':  ('L', 0b0000011, 0b001, 0),
+    'lw':  ('L', 0b0000011, 0b010, 0),
+    'lbu': ('L', 0b0000011, 0b100, 0),
+    'lhu': ('L', 0b0000011, 0b101, 0),
+
+    'sb': ('S', 0b0100011, 0b000, 0),
+    'sh': ('S', 0b0100011, 0b001, 0),
+    'sw': ('S', 0b0100011, 0b010, 0),
+
+    'addi':  ('I', 0b0010011, 0b000, 0),
+    'slti':  ('I', 0b0010011, 0b010, 0),
+    'sltiu': ('I', 0b0010011, 0b011, 0),
+    'xori':  ('I', 0b0010011, 0b100, 0),
+    'ori':   ('I', 0b0010011, 0b110, 0),
+    'andi':  ('I', 0b0010011, 0b111, 0),
+    'slli':  ('SH', 0b0010011, 0b001, 0b0000000),
+    'srli':  ('SH', 0b0010011, 0b101, 0b0000000),
+    'srai':  ('SH', 0b0010011, 0b101, 0b0100000),
+
+    'add':  ('R', 0b0110011, 0b000, 0b0000000),
+    'sub':  ('R', 0b0110011, 0b000, 0b0100000),
+    'sll':  ('R', 0b0110011, 0b001, 0b0000000),
+    'slt':  ('R', 0b0110011, 0b010, 0b0000000),
+    'sltu': ('R', 0b0110011, 0b011, 0b0000000),
+    'xor':  ('R', 0b0110011, 0b100, 0b0000000),
+    'srl':  ('R', 0b0110011, 0b101, 0b0000000),
+    'sra':  ('R', 0b0110011, 0b101, 0b0100000),
+    'or':   ('R', 0b0110011, 0b110, 0b0000000),
+    'and':  ('R', 0b0110011, 0b111, 0b0000000),
+
+    'mul':    ('R', 0b0110011, 0b000, 0b0000001),
+    'mulh':   ('R', 0b0110011, 0b001, 0b0000001),
+    'mulhsu': ('R', 0b0110011, 0b010, 0b0000001),
+    'mulhu':  ('R', 0b0110011, 0b011, 0b0000001),
+    'div':    ('R', 0b0110011, 0b100, 0b0000001),
+    'divu':   ('R', 0b0110011, 0b101, 0b0000001),
+    'rem':    ('R', 0b0110011, 0b110, 0b0000001),
+    'remu':   ('R', 0b0110011, 0b111, 0b0000001),
+
+    'fence':  ('FENCE', 0b0001111, 0b000, 0),
+    'ecall':  ('SYS', 0b1110011, 0, 0x000),
+    'ebreak': ('SYS', 0b1110011, 0, 0x001),
+}
+
+LABEL_PATTERN = re.compile(r'^([A-Za-z_.$][\w.$]*)\s*:\s*')
+IMMEDIATE_PATTERN = re.compile(r'^[-+]?(0[xX][0-9a-fA-F]+|0[bB][01]+|0|[1-9][0-9]*)$')
+MEMORY_OPERAND_PATTERN = re.compile(r'^(.*)\((\w+)\)$')
+
+def _register(operand):
+    if operand not in REGISTER_NUMBERS:
+        raise UnsupportedAssembly(f'unknown register {operand}')
+    return REGISTER_NUMBERS[operand]
+
+def _immediate(operand, lo, hi):
+    if not IMMEDIATE_PATTERN.match(operand):
+        raise UnsupportedAssembly(f'unsupported immediate {operand}')
+    value = int(operand, 0)
+    if not lo <= value <= hi:
+        raise UnsupportedAssembly(f'immediate {operand} out of range [{lo},{hi}]')
+    return value
+
+def _memoryOperand(operand):
+    """Parse an `imm(reg)` operand into (imm, reg)"""
+    match = MEMORY_OPERAND_PATTERN.match(operand)
+    if match is None:
+        raise UnsupportedAssembly(f'expected imm(reg) but got {operand}')
+    imm = match.group(1) if match.group(1) != '' else '0'
+    return _immediate(imm, -2048, 2047), _register(match.group(2))
+
+def _fenceSet(operand):
+    if operand == '' or any(c not in 'iorw' for c in operand):
+        raise UnsupportedAssembly(f'unsupported fence operand {operand}')
+    return sum(bit for c, bit in zip('iorw', [8, 4, 2, 1]) if c in operand)
+
+def _liSequence(rd, value):
+    """The lui/addi sequence GNU as uses for `li` on RV32, as a list of (mnemonic, operands) tuples"""
+    if value >= 2**31:
+        value -= 2**32 # treat as a signed 32-bit value
+        pass
+    lo = ((value & 0xFFF) ^ 0x800) - 0x800 # sign-extended low 12 bits
+    hi = value - lo
+    if hi >= 2**31: # the upper part wraps around, like an int32_t
+        hi -= 2**32
+        pass
+    insns = []
+    upper = 'x0'
+    if hi != 0:
+        insns.append(('lui', [rd, str((hi >> 12) & 0xFFFFF)]))
+        upper = rd
+        pass
+    if (value & 0xFFF) != 0 or hi == 0:
+        insns.append(('addi', [rd, upper, str(lo)]))
+        pass
+    return insns
+
+def _expandPseudo(mnemonic, operands):
+    """Expand pseudo-insns into a list of (mnemonic, operands) tuples of real insns"""
+    if mnemonic == 'li':
+        if len(operands) != 2:
+            raise UnsupportedAssembly('li expects 2 operands')
+        _register(operands[0])
+        return _liSequence(operands[0], _immediate(operands[1], -2**31, 2**32 - 1))
+    if mnemonic == 'nop':
+        return [('addi', ['x0', 'x0', '0'])]
+    if mnemonic == 'mv':
+        return [('addi', operands + ['0'])]
+    if mnemonic == 'j':
+        return [('jal', ['x0'] + operands)]
+    if mnemonic not in INSNS:
+        raise UnsupportedAssembly(f'unsupported insn {mnemonic}')
+    return [(mnemonic, operands)]
+
+def _branchOffset(operand, labels, pc, bits):
+    if operand not in labels:
+        raise UnsupportedAssembly(f'branch/jump target must be a label, not {operand}')
+    offset = labels[operand] - pc
+    if not -(2**(bits-1)) <= offset < 2**(bits-1):
+        raise UnsupportedAssembly(f'target {operand} is out of range')
+    return offset & ((1 << bits) - 1)
+
+def _encode(mnemonic, operands, labels, pc):
+    fmt, opcode, funct3, funct7 = INSNS[mnemonic]
+    expectedOperands = {'R': 3, 'I': 3, 'SH': 3, 'L': 2, 'S': 2, 'B': 3, 'U': 2, 'J': 2, 'SYS': 0}
+    if fmt in expectedOperands and len(operands) != expectedOperands[fmt]:
+        raise UnsupportedAssembly(f'wrong number of operands for {mnemonic}')
+
+    if fmt == 'R':
+        rd, rs1, rs2 = [_register(o) for o in operands]
+        return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+    if fmt == 'I':
+        rd, rs1 = _register(operands[0]), _register(operands[1])
+        imm = _immediate(operands[2], -2048, 2047) & 0xFFF
+        return (imm << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+    if fmt == 'SH':
+        rd, rs1 = _register(operands[0]), _register(operands[1])
+        shamt = _immediate(operands[2], 0, 31)
+        return (funct7 << 25) | (shamt << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+    if fmt == 'L':
+        rd = _register(operands[0])
+        imm, rs1 = _memoryOperand(operands[1])
+        return ((imm & 0xFFF) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+    if fmt == 'S':
+        rs2 = _register(operands[0])
+        imm, rs1 = _memoryOperand(operands[1])
+        imm &= 0xFFF
+        return ((imm >> 5) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | ((imm & 0x1F) << 7) | opcode
+    if fmt == 'B':
+        rs1, rs2 = _register(operands[0]), _register(operands[1])
+        imm = _branchOffset(operands[2], labels, pc, 13)
+        return (((imm >> 12) & 1) << 31) | (((imm >> 5) & 0x3F) << 25) | (rs2 << 20) | (rs1 << 15) | \
+            (funct3 << 12) | (((imm >> 1) & 0xF) << 8) | (((imm >> 11) & 1) << 7) | opcode
+    if fmt == 'U':
+        rd = _register(operands[0])
+        imm = _immediate(operands[1], 0, 0xFFFFF)
+        return (imm << 12) | (rd << 7) | opcode
+    if fmt == 'J':
+        rd = _register(operands[0])
+        imm = _branchOffset(operands[1], labels, pc, 21)
+        return (((imm >> 20) & 1) << 31) | (((imm >> 1) & 0x3FF) << 21) | (((imm >> 11) & 1) << 20) | \
+            (((imm >> 12) & 0xFF) << 12) | (rd << 7) | opcode
+    if fmt == 'FENCE':
+        if len(operands) == 0:
+            pred, succ = 0xF, 0xF
+        elif len(operands) == 2:
+            pred, succ = _fenceSet(operands[0]), _fenceSet(operands[1])
+        else:
+            raise UnsupportedAssembly('fence expects 0 or 2 operands')
+        return (pred << 24) | (succ << 20) | opcode
+    if fmt == 'SYS':
+        return (funct7 << 20) | opcode
+    raise UnsupportedAssembly(f'unsupported insn {mnemonic}')
+
+def _parse(assemblyCode):
+    """Split the code into (labels, insns) where labels are defined at the start of the
+    corresponding insn, and insns is a list of (mnemonic, operands) tuples of real insns."""
+    insns = []
+    labels = {}
+    for line in assemblyCode.split('\n'):
+        line = line.split('#', 1)[0]
+        for statement in line.split(';'):
+            statement = statement.strip()
+            while True:
+                match = LABEL_PATTERN.match(statement)
+                if match is None:
+                    break
+                label = match.group(1)
+                if label in labels:
+                    raise UnsupportedAssembly(f'label {label} defined more than once')
+                labels[label] = 4 * len(insns)
+                statement = statement[match.end():]
+                pass
+            if statement == '':
+                continue
+            if statement.startswith('.'):
+                raise UnsupportedAssembly(f'unsupported directive {statement}')
+            parts = statement.split(None, 1)
+            mnemonic = parts[0]
+            operands = [o.strip() for o in parts[1].split(',')] if len(parts) > 1 else []
+            operands = [re.sub(r'\s+', '', o) for o in operands]
+            if '' in operands:
+                raise UnsupportedAssembly(f'missing operand in {statement}')
+            insns.extend(_expandPseudo(mnemonic, operands))
+            pass
+        pass
+    return labels, insns
+
+def assemble(assemblyCode):
+    """Assemble the given code, which is placed at address 0, returning a list of insns as 4B words"""
+    labels, insns = _parse(assemblyCode)
+    return [_encode(mnemonic, operands, labels, 4 * i) for i, (mnemonic, operands) in enumerate(insns)]
+
+def findTestbenchCode(testbenchPath):
+    """Returns the inline assembly code passed to preTestSetup() in the given testbench file"""
+    tree = ast.parse(Path(testbenchPath).read_text())
+    code = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'preTestSetup' and len(node.args) > 1:
+            if isinstance(node.args[1], ast.Constant) and isinstance(node.args[1].value, str):
+                code.append(node.args[1].value)
+                pass
+            pass
+        pass
+    return code
+
+# code that isn't written out literally in the testbenches, or that exercises corner cases of our encodings
+EXTRA_CROSS_CHECK_CODE = [
+    '\n'.join(f'addi x1,x0,{imm}' for imm in range(-2048, 2048)), # testAddiAll
+    '\n'.join(f'li x5,{v}' for v in [0, 1, -1, 2047, 2048, -2048, -2049, 0x800, 0xFFF, 0x1000, 0x7FFFF800,
+                                      0x7FFFFFFF, 0x80000000, 0xFFFFF000, 0xFFFFF0B7, 0xFFFFFFFF, 0x12345678]),
+    'back: sw t0,-4(sp)\nsh a1,2047(s0)\nsb x31,-2048(x1)\nbne x1,x2,back\nbgeu zero,ra,fwd\njal ra,back\nfwd: jalr x0,1(x1)',
+    'lb x1,0(x2); lbu x3,(x4); lh x5,-1(x6); lhu x7,8(x8)\nsrai x1,x2,31\nsrli x1,x2,0\nsltiu a0,a1,-1',
+    'mulhsu x1,x2,x3\nremu x4,x5,x6\nsub x7,x8,x9\nsra x10,x11,x12\nauipc x1,0xfffff\nfence rw,w\nebreak\nnop\nmv a0,a1\nend: j end',
+]
+
+def codeKey(assemblyCode):
+    """Returns the key of the given code in REFERENCE_FILE"""
+    return hashlib.sha256(assemblyCode.encode()).hexdigest()
+
+_reference = None
+
+def _loadReference():
+    global _reference
+    if _reference is None:
+        try:
+            with open(REFERENCE_FILE) as f:
+                _reference = json.load(f)
+        except (OSError, ValueError):
+            _reference = {}
+            pass
+        pass
+    return _reference
+
+def referenceEncoding(assemblyCode):
+    """Returns GNU as's encoding of the given code, as a list of insns, or None if it isn't in REFERENCE_FILE"""
+    words = _loadReference().get('encodings', {}).get(codeKey(assemblyCode))
+    return None if words is None else [int(w, 16) for w in words]
+
+def referenceAssemble(assemblyCode, assembler):
+    """Assembles the given code with the given assembler (GNU as or llvm-mc), returning its .text insns"""
+    import riscv_binary_utils
+    if assembler == LLVM_MC:
+        # with linker relaxation disabled, llvm-mc resolves branches to local labels as GNU as does
+        fd, objectFile = tempfile.mkstemp(prefix='.tmp.', suffix='.riscv.o')
+        os.close(fd)
+        try:
+            subprocess.run([LLVM_MC, '-triple=riscv32', '-mattr=+m,-relax', '-filetype=obj', '-o', objectFile],
+                           input=assemblyCode + '\n', text=True, capture_output=True, check=True)
+            sections = riscv_binary_utils.getSectionsToLoad(objectFile)
+        finally:
+            os.remove(objectFile)
+            pass
+    else:
+        sections = riscv_binary_utils.assemble(assemblyCode, useCache=False)
+        pass
+    return [w for name, _, words in sections if name == '.text' for w in words]
+
+def assemblerVersion(assembler):
+    return subprocess.run([assembler, '--version'], capture_output=True, text=True).stdout.strip().splitlines()[0]
+
+def updateReference(corpus):
+    """Regenerate REFERENCE_FILE from the given code, with GNU as"""
+    import riscv_binary_utils
+    assembler = riscv_binary_utils.ASSEMBLER
+    assert shutil.which(assembler) is not None, \
+        f"Couldn't find assembler program {assembler}, which produces the reference encodings"
+    encodings = {codeKey(code): [f'{w:08x}' for w in referenceAssemble(code, assembler)] for code in corpus}
+    with open(REFERENCE_FILE, 'w') as f:
+        # one piece of code per line, to keep diffs readable
+        f.write(f'{{"assembler": {json.dumps(f"{assembler}: {assemblerVersion(assembler)}")}, "encodings": {{\n')
+        f.write(',\n'.join(f'{json.dumps(key)}: {json.dumps(words)}' for key, words in sorted(encodings.items())))
+        f.write('\n}}\n')
+        pass
+    global _reference
+    _reference = None
+    print(f'[riscv_assembler] wrote encodings of {len(encodings)} pieces of code from {assembler} to {REFERENCE_FILE}')
+    pass
+
+def _compare(code, ours, theirs, theirName):
+    if ours == list(theirs):
+        return 0
+    print(f'[riscv_assembler] MISMATCH with {theirName} for code:\n{code}')
+    for i, (a, b) in enumerate(zip(ours, theirs)):
+        if a != b:
+            print(f'  insn {i}: ours 0x{a:08x} but {theirName} 0x{b:08x}')
+            pass
+        pass
+    if len(ours) != len(theirs):
+        print(f'  ours has {len(ours)} insns but {theirName} has {len(theirs)}')
+        pass
+    return 1
+
+def crossCheck(corpus):
+    """Assemble each piece of code with this assembler, and compare it against REFERENCE_FILE and, if installed, GNU
+    as and llvm-mc. Returns the number of mismatches, counting a REFERENCE_FILE not produced by GNU as as one."""
+    import riscv_binary_utils
+    gnuAs = shutil.which(riscv_binary_utils.ASSEMBLER) is not None
+    llvmMc = shutil.which(LLVM_MC) is not None
+    mismatches = 0
+    producer = _loadReference().get('assembler', '')
+    if not producer.startswith(f'{riscv_binary_utils.ASSEMBLER}:'):
+        mismatches += 1
+        print(f'[riscv_assembler] {REFERENCE_FILE.name} was produced by {producer or "an unknown assembler"}, not GNU '
+              f'as: regenerate it with --update-reference on a machine with {riscv_binary_utils.ASSEMBLER}')
+        pass
+    for code in corpus:
+        try:
+            ours = assemble(code)
+        except UnsupportedAssembly as e:
+            print(f'[riscv_assembler] skipping unsupported code ({e}):\n{code}')
+            continue
+        reference = referenceEncoding(code)
+        if reference is None:
+            mismatches += 1
+            print(f'[riscv_assembler] MISSING from {REFERENCE_FILE.name}, run with --update-reference:\n{code}')
+        else:
+            mismatches += _compare(code, ours, reference, REFERENCE_FILE.name)
+            pass
+        if gnuAs:
+            mismatches += _compare(code, ours, referenceAssemble(code, riscv_binary_utils.ASSEMBLER), 'GNU as')
+            pass
+        if llvmMc:
+            mismatches += _compare(code, ours, referenceAssemble(code, LLVM_MC), LLVM_MC)
+            pass
+        pass
+    return mismatches
+
+if __name__ == '__main__':
+    # check against the reference encodings, using the code from all testbenches (or those given on the command line)
+    updating = '--update-reference' in sys.argv[1:]
+    repoRoot = Path(__file__).resolve().parent.parent.parent
+    testbenches = [a for a in sys.argv[1:] if a != '--update-reference'] or sorted(repoRoot.glob('hw*/testbench*.py'))
+    corpus = EXTRA_CROSS_CHECK_CODE + [code for tb in testbenches for code in findTestbenchCode(tb)]
+    if updating:
+        updateReference(corpus)
+        pass
+    mismatches = crossCheck(corpus)
+    print(f'[riscv_assembler] checked {len(corpus)} pieces of code, found {mismatches} mismatches')
+    sys.exit(1 if mismatches > 0 else 0)
+    pass
@@ -1,171 +1,655 @@
 from pathlib import Path
 import subprocess
-import re
 import shutil
+import struct
+import mmap
+import hashlib
+import json
+import os
+import tempfile
 import sys
 import logging
-import cocotb, cocotbext
+import atexit
+from array import array
+import cocotb
+import riscv_assembler
+import telemetry
 
-# readelf program
-READELF = 'riscv64-unknown-elf-readelf'
+try:
+    from cocotbext.axi import AxiLiteRam
+except ImportError:
+    # cocotbext-axi is only needed to load programs into an AxiLiteRam
+    AxiLiteRam = None
+    pass
 
 # assembler program
 ASSEMBLER = 'riscv64-unknown-elf-as'
 
-# temporary file used to hold assembler output
-TEMP_MACHINE_CODE_FILE = ".tmp.riscv.o"
+# ISA we assemble inline test code for
+ASSEMBLER_MARCH = 'rv32im'
+
+# directory holding assembled inline test code, keyed by a hash of the code. Shared across homeworks and runs.
+ASM_CACHE_DIR = Path(os.environ.get('CIS5710_CACHE_DIR', Path.home() / '.cache' / 'cis5710')) / 'asm'
+
+# bump this to invalidate all cached assembler output, e.g., if the set of sections we load changes
+ASM_CACHE_VERSION = 1
 
 # offset to map from standard Linux/ELF addresses to what our processor's memory uses
 BIN_2_MEMORY_ADDRESS_OFFSET = 0x80000000
 
-assert shutil.which(ASSEMBLER) is not None, f"Couldn't find assembler program {ASSEMBLER}"
-assert shutil.which(READELF) is not None, f"Couldn't find readelf program {READELF}"
+# we store memory contents as array('I'), so it needs to hold 4B words
+assert array('I').itemsize == 4, "array('I') must have 4B items"
+
+# ELF section flag for sections that occupy memory when the program runs. These are the sections we load.
+SHF_ALLOC = 0x2
+
+# how to load binaries into a simulated memory: 'readmemh' writes a hex file and has the memory load it
+# with a single $readmemh call, 'vpi' writes each word individually, 'auto' uses readmemh when the memory
+# supports it and vpi otherwise
+MEMORY_LOAD_MODES = ['auto', 'readmemh', 'vpi']
+MEMORY_LOAD_MODE_ENV = 'RV_MEMORY_LOAD'
+MEMORY_LOAD_MODE = os.environ.get(MEMORY_LOAD_MODE_ENV, 'auto')
+
+# how to clear simulated memory between tests: 'dirty' zeroes just the words loaded or stored to since the last
+# clear, 'full' zeroes every word, and 'verify' is like 'dirty' but first checks that all other words are zero.
+# Memories without a MemoryBackdoor are always cleared in full.
+MEMORY_CLEAR_MODES = ['dirty', 'full', 'verify']
+MEMORY_CLEAR_MODE_ENV = 'RV_MEMORY_CLEAR'
+MEMORY_CLEAR_MODE = os.environ.get(MEMORY_CLEAR_MODE_ENV, 'dirty')
 
 LOG = logging.getLogger('riscv_binary_utils')
 LOG.setLevel(logging.INFO)
 
 def asm(dut, assemblyCode):
-    """Assembles the given RISC-V code, and loads it into memory via cocotb"""
+    """Assembles the given RISC-V code, and loads it into memory via cocotb. Our built-in assembler handles most test
+    code without running an external program, and GNU as handles the rest."""
+    try:
+        sections = [('.text', 0, array('I', riscv_assembler.assemble(assemblyCode)))]
+    except riscv_assembler.UnsupportedAssembly:
+        sections = assemble(assemblyCode)
+        pass
+    with telemetry.phase('load', binary='asm'):
+        loadSectionsIntoMemory(dut, sections)
+        pass
+
+def assemble(assemblyCode, march=ASSEMBLER_MARCH, useCache=True):
+    """Assembles the given RISC-V code with GNU as, returning its sections as a list of (name, address, words) tuples.
+    Results are cached on disk keyed by the code and `march`, so the assembler only runs the first time we see some code."""
 
     # avoid assembler warning about missing trailing newline
     if not assemblyCode.endswith('\n'):
         assemblyCode += '\n'
         pass
 
-    # Use subprocess to run the assembler command
-    command = [ASSEMBLER, "-march=rv32im", "-o", TEMP_MACHINE_CODE_FILE]
-    process = subprocess.run(command, input=assemblyCode, capture_output=True, text=True, check=False)
-    if process.returncode != 0:
-        LOG.error(f"Error: {process.stderr}")
-        process.check_returncode() # throws
+    key = hashlib.sha256(f'{ASM_CACHE_VERSION}\n{march}\n{assemblyCode}'.encode()).hexdigest()
+    cacheFile = ASM_CACHE_DIR / key[:2] / f'{key}.json'
+    if useCache:
+        try:
+            with open(cacheFile, 'r') as f:
+                return [(name, address, words) for name, address, words in json.load(f)]
+        except (OSError, ValueError):
+            pass # cache miss
         pass
 
-    loadBinaryIntoMemory(dut, TEMP_MACHINE_CODE_FILE)
+    assert shutil.which(ASSEMBLER) is not None, f"Couldn't find assembler program {ASSEMBLER}"
+    # use a unique object file, so that multiple test processes can assemble in the same directory
+    fd, objectFile = tempfile.mkstemp(prefix='.tmp.', suffix='.riscv.o')
+    os.close(fd)
+    try:
+        # Use subprocess to run the assembler command
+        command = [ASSEMBLER, f"-march={march}", "-o", objectFile]
+        process = subprocess.run(command, input=assemblyCode, capture_output=True, text=True, check=False)
+        if process.returncode != 0:
+            LOG.error(f"Error: {process.stderr}")
+            process.check_returncode() # throws
+            pass
+        sections = getSectionsToLoad(objectFile)
+    finally:
+        os.remove(objectFile)
+        pass
+
+    _writeFileAtomically(cacheFile, json.dumps([(name, address, list(words)) for name, address, words in sections]))
+    return sections
+
+def _writeFileAtomically(path, contents):
+    """Write `contents` to `path` such that concurrent readers see either the old file or the complete new one.
+    Failures are logged but otherwise ignored, since everything we write this way is just a cache."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+                pass
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+    except OSError as e:
+        LOG.warning(f"couldn't write cache file {path}: {e}")
+        pass
+    pass
+
+def getSectionsToLoad(binaryPath):
+    """Read the given binary's sections, returning a list of (name, address, words) tuples for each one that should
+    be loaded into memory. Addresses are in bytes, and have already been mapped into our processor's address space."""
+    return MemoryImage.fromBinary(binaryPath).sections()
 
 def loadBinaryIntoMemory(dut, binaryPath):
     """Read the given binary's sections, and load them into memory at the appropriate addresses."""
-    
-    sectionInfo = getSectionInfo(binaryPath)
-    sectionsToLoad = ['.text.init','.text','.text.startup','.data','.tohost','.rodata','.rodata.str1.4','.sbss','.bss','.tbss','.srodata','.sdata']
+    with telemetry.phase('load', binary=Path(binaryPath).name):
+        loadSectionsIntoMemory(dut, getSectionsToLoad(binaryPath))
+        pass
 
-    for sectionName in sectionsToLoad:
-        if sectionName not in sectionInfo:
+class MemoryImage:
+    """The initial memory contents of a program: a sparse map from address to 4B word, held as a list of
+    (name, address, words) segments where words is an array('I'). Use MemoryImage.fromBinary() to build one
+    from an ELF file, which is only read again if it changes. Images are shared, so treat them as read-only."""
+
+    # (path, mtime, size) => MemoryImage
+    _binaryCache = {}
+
+    def __init__(self, sections=()):
+        self.segments = [(name, address, words if isinstance(words, array) and words.typecode == 'I' else array('I', words))
+                         for name, address, words in sections]
+        pass
+
+    @classmethod
+    def fromBinary(cls, binaryPath):
+        """Returns the image for the ELF file at binaryPath, i.e., its allocated (SHF_ALLOC) sections.
+        Addresses are mapped into our processor's address space, and NOBITS sections (like .bss) are all zeroes."""
+        bp = Path(binaryPath).resolve()
+        stat = bp.stat()
+        key = (str(bp), stat.st_mtime_ns, stat.st_size)
+        if key in cls._binaryCache:
+            return cls._binaryCache[key]
+
+        contents = mapBinary(bp)
+        sections = []
+        for sectionName, info in getSectionInfo(bp).items():
+            length = info['size']
+            if 0 == info['flags'] & SHF_ALLOC or 0 == length:
+                continue
+            if info['type'] == 'NOBITS':
+                words = array('I', bytes(4 * ((length + 3) // 4)))
+            else:
+                words = bytesToWords(contents[info['offset']:info['offset'] + length])
+                pass
+            memBaseAddr = info['address']
+            if memBaseAddr >= BIN_2_MEMORY_ADDRESS_OFFSET:
+                memBaseAddr -= BIN_2_MEMORY_ADDRESS_OFFSET
+                pass
+            sections.append((sectionName, memBaseAddr, words))
+            pass
+        image = cls(sorted(sections, key=lambda s: s[1]))
+        # drop stale entries for this file
+        for oldKey in [k for k in cls._binaryCache if k[0] == key[0]]:
+            del cls._binaryCache[oldKey]
+            pass
+        cls._binaryCache[key] = image
+        return image
+
+    def sections(self):
+        """Returns this image as a list of (name, address, words) tuples"""
+        return list(self.segments)
+
+    def numWords(self):
+        return sum(len(words) for _, _, words in self.segments)
+
+    def endAddress(self):
+        """Returns the byte address just past the end of this image"""
+        return max((address + 4*len(words) for _, address, words in self.segments), default=0)
+
+    def toVpi(self, dut, mode=None):
+        """Load this image into the memory of the given top-level cocotb dut"""
+        loadSectionsIntoMemory(dut, self.segments, mode)
+        pass
+
+    def toAxiLiteRam(self, ram):
+        """Load this image into a cocotbext AxiLiteRam"""
+        loadSectionsIntoMemory(ram, self.segments)
+        pass
+
+    def toReadmemh(self, hexFile):
+        """Write this image to the given open text file in $readmemh format, using @address records for each segment"""
+        _writeReadmemhRecords(hexFile, self.segments)
+        pass
+
+    def toBytes(self, baseAddress=0, size=None):
+        """Returns the memory from baseAddress to baseAddress+size as a little-endian bytearray. Addresses not in the
+        image are zero. size defaults to the end of the image."""
+        if size is None:
+            size = max(0, self.endAddress() - baseAddress)
+            pass
+        contents = bytearray(size)
+        for _, address, words in self.segments:
+            segmentBytes = _wordsToBytes(words)
+            start, end = address - baseAddress, address - baseAddress + len(segmentBytes)
+            if end <= 0 or start >= size:
+                continue
+            contents[max(0, start):min(size, end)] = segmentBytes[max(0, -start):min(size, end) - start]
+            pass
+        return contents
+
+    def diff(self, snapshot, baseAddress=0):
+        """Compare this image against a snapshot of memory, e.g., from readMemorySnapshot(), where snapshot[i] holds
+        the word at byte address baseAddress + 4*i. Returns a list of (address, expected, actual) tuples for each
+        word of the image that doesn't match; actual is None for words outside the snapshot."""
+        if not isinstance(snapshot, array):
+            snapshot = array('I', snapshot)
+            pass
+        mismatches = []
+        for _, address, words in self.segments:
+            start = (address - baseAddress) >> 2
+            if start >= 0 and snapshot[start:start + len(words)] == words:
+                continue # fast path: whole segment matches
+            for i, expected in enumerate(words):
+                index = start + i
+                actual = snapshot[index] if 0 <= index < len(snapshot) else None
+                if actual != expected:
+                    mismatches.append((address + 4*i, expected, actual))
+                    pass
+                pass
+            pass
+        return mismatches
+
+def readMemorySnapshot(dut):
+    """Read back the entire memory of the given top-level cocotb dut, returning an array('I') of its words"""
+    return array('I', (dut.memory.mem_array[i].value.integer for i in range(dut.memory.NUM_WORDS.value)))
+
+def _wordsToBytes(words):
+    """Convert words, e.g., an array('I'), to little-endian bytes"""
+    if sys.byteorder == 'big' or not isinstance(words, array):
+        words = array('I', words)
+        pass
+    if sys.byteorder == 'big':
+        words.byteswap()
+        pass
+    return words.tobytes()
+
+def _writeReadmemhRecords(hexFile, sections, addressRecords=True):
+    """Write the given (name, address, words) sections to hexFile, an open text file, in $readmemh format.
+    Each section starts with an @address record, unless addressRecords is False."""
+    for _, memBaseAddr, words in sections:
+        if len(words) == 0:
             continue
-        offset = sectionInfo[sectionName]['offset']
-        length = sectionInfo[sectionName]['size']
-        words = extractDataFromBinary(binaryPath, offset, length + (length % 4))
-        memBaseAddr = sectionInfo[sectionName]['address']
-        if memBaseAddr >= BIN_2_MEMORY_ADDRESS_OFFSET:
-            memBaseAddr -= BIN_2_MEMORY_ADDRESS_OFFSET
+        if addressRecords:
+            hexFile.write(f'@{memBaseAddr >> 2:x}\n')
             pass
-        if isinstance(dut, cocotb.handle.HierarchyObject):
-            memBaseAddr >>= 2 # convert to word address
+        # hex-encode the words as big-endian bytes, rather than formatting each word separately
+        bigEndian = array('I', words)
+        if sys.byteorder == 'little':
+            bigEndian.byteswap()
             pass
+        hexFile.write(bigEndian.tobytes().hex('\n', 4))
+        hexFile.write('\n')
+        pass
+    pass
+
+def loadSectionsIntoMemory(dut, sections, mode=None):
+    """Load sections, a list of (name, address, words) tuples, into memory at the appropriate addresses.
+    mode is one of MEMORY_LOAD_MODES, and defaults to MEMORY_LOAD_MODE."""
+    mode = MEMORY_LOAD_MODE if mode is None else mode
+    assert mode in MEMORY_LOAD_MODES, f"unknown memory load mode {mode}, expected one of {MEMORY_LOAD_MODES}"
+    for sectionName, memBaseAddr, words in sections:
         if len(words) > 0:
             LOG.info(f"loading {sectionName} section ({len(words)} words) into memory starting at 0x{memBaseAddr:x}")
             pass
+        pass
+    if AxiLiteRam is not None and isinstance(dut, AxiLiteRam):
+        for sectionName, memBaseAddr, words in sections:
+            data = _wordsToBytes(words)
+            assert memBaseAddr + len(data) <= dut.size, f"{sectionName} section ends at 0x{memBaseAddr + len(data):x}, past the end of the {dut.size}B AxiLiteRam"
+            # a single write into the RAM's backing memory, instead of one write_dword() per word
+            dut.write(memBaseAddr, data)
+            pass
+        return
+    assert isinstance(dut, cocotb.handle.HierarchyObject), f"cannot load into memory of type {type(dut)}"
+
+    backdoor = _memoryBackdoor(dut)
+    # a pending $readmemh would overwrite what we load now, though it was loaded first
+    assert backdoor is None or backdoor.load_image_done.value.integer == _readmemhFileCount, \
+        "previous memory image hasn't been loaded yet, let the simulator run in between or use loadImagesIntoMemory()"
+    global _loadedWordRanges
+    # merged as we go, so that this stays small even if memory is never cleared
+    _loadedWordRanges = _mergeRanges(_loadedWordRanges + [(memBaseAddr >> 2, (memBaseAddr >> 2) + len(words))
+                                                          for _, memBaseAddr, words in sections],
+                                     dut.memory.NUM_WORDS.value)
+    if mode != 'vpi' and backdoor is not None:
+        _loadViaReadmemh(backdoor, sections)
+        return
+    assert mode != 'readmemh', f"memory does not support bulk loading, use {MEMORY_LOAD_MODE_ENV}=vpi"
+
+    for sectionName, memBaseAddr, words in sections:
+        memBaseAddr >>= 2 # convert to word address
         for i in range(len(words)):
-            if isinstance(dut, cocotb.handle.HierarchyObject):
-                # NB: doesn't work if we try to pass dut.memory.mem_array as an argument, need top-level dut
-                dut.memory.mem_array[memBaseAddr + i].value = words[i]
-            elif isinstance(dut, cocotbext.axi.axil_ram.AxiLiteRam):
-                dut.write_dword(memBaseAddr + (i*4), words[i])
-            else:
-                assert False, f"cannot load into memory of type {type(dut)}"
+            # NB: doesn't work if we try to pass dut.memory.mem_array as an argument, need top-level dut
+            dut.memory.mem_array[memBaseAddr + i].value = words[i]
+            pass
+        pass
+    pass
+
+def loadImagesIntoMemory(dut, images):
+    """Load several programs into memory at once, e.g., a program along with data it reads. Each image is a
+    MemoryImage or a path to an ELF file. Where images overlap, later ones win."""
+    sections = []
+    for image in images:
+        if not isinstance(image, MemoryImage):
+            image = MemoryImage.fromBinary(image)
             pass
+        sections.extend(image.sections())
         pass
+    loadSectionsIntoMemory(dut, sections)
     pass
 
+def _memoryBackdoor(dut):
+    """Returns the MemoryBackdoor bound into the given top-level dut's memory (see cocotb_utils.memoryBackdoorBuild()),
+    or None if it has none"""
+    try:
+        return dut.memory._id('backdoor', extended=False)
+    except AttributeError:
+        return None
+
+def _loadViaReadmemh(backdoor, sections):
+    """Load sections into memory with a single $readmemh call inside the simulator, by writing them to a sparse
+    hex file and triggering the backdoor's load_image_seq. The load takes effect once the simulator next evaluates,
+    which happens before the next clock edge."""
+    global _readmemhFileCount
+    # remove the files of earlier loads, now that the simulator has done them
+    _removeReadmemhFiles(upTo=backdoor.load_image_done.value.integer)
+    _readmemhFileCount += 1
+    fd, hexPath = tempfile.mkstemp(prefix=f'mem_image_{_readmemhFileCount}_', suffix='.hex')
+    _readmemhFiles.append((_readmemhFileCount, hexPath))
+    with os.fdopen(fd, 'w') as hexFile:
+        _writeReadmemhRecords(hexFile, sections)
+        pass
+
+    pathBytes = hexPath.encode()
+    assert len(pathBytes) <= len(backdoor.load_image_path) // 8, f"path to memory image is too long: {hexPath}"
+    backdoor.load_image_path.value = int.from_bytes(pathBytes, 'big')
+    # sequence numbers start at 1, so that the initial value of 0 doesn't trigger a load
+    backdoor.load_image_seq.value = _readmemhFileCount
+    pass
+
+def _removeReadmemhFiles(upTo=None):
+    """Remove the hex files of loads with sequence numbers up to the given one, or all of them"""
+    for seq, oldFile in list(_readmemhFiles):
+        if upTo is None or seq <= upTo:
+            Path(oldFile).unlink(missing_ok=True)
+            _readmemhFiles.remove((seq, oldFile))
+            pass
+        pass
+    pass
+
+# (sequence number, path) of each hex file we have written
+_readmemhFiles = []
+_readmemhFileCount = 0
+atexit.register(_removeReadmemhFiles)
+
+def clearMemory(dut, mode=None):
+    """Zero the memory of the given top-level dut, e.g., before loading the next test's code. Normally this clears
+    just the words loaded or stored to since the last call, though the first call clears all of memory. Stores are
+    tracked by the memory's MemoryBackdoor, so a memory without one is always cleared in full. mode is one of
+    MEMORY_CLEAR_MODES, and defaults to MEMORY_CLEAR_MODE."""
+    mode = MEMORY_CLEAR_MODE if mode is None else mode
+    with telemetry.phase('clear', mode=mode) as fields:
+        fields['words'] = _clearMemory(dut, mode)
+        pass
+    pass
+
+def _clearMemory(dut, mode):
+    """Does the work of clearMemory(), returning the number of words cleared"""
+    global _memoryClearedOnce
+    assert mode in MEMORY_CLEAR_MODES, f"unknown memory clear mode {mode}, expected one of {MEMORY_CLEAR_MODES}"
+    numWords = dut.memory.NUM_WORDS.value
+    backdoor = _memoryBackdoor(dut)
+
+    # without a MemoryBackdoor we can't tell where the program stored to
+    if mode == 'full' or backdoor is None or not _memoryClearedOnce:
+        dirtyRanges = [(0, numWords)]
+    else:
+        dirtyRanges = list(_loadedWordRanges)
+        if backdoor.store_min_word.value.integer <= backdoor.store_max_word.value.integer:
+            dirtyRanges.append((backdoor.store_min_word.value.integer, backdoor.store_max_word.value.integer + 1))
+            pass
+        dirtyRanges = _mergeRanges(dirtyRanges, numWords)
+        pass
+
+    if mode == 'verify':
+        # the words we aren't going to clear should already be zero
+        isDirty = bytearray(numWords)
+        for start, end in dirtyRanges:
+            isDirty[start:end] = b'\x01' * (end - start)
+            pass
+        missed = [i for i in range(numWords) if not isDirty[i] and dut.memory.mem_array[i].value.integer != 0]
+        assert len(missed) == 0, f"dirty-range memory clear missed {len(missed)} nonzero words, starting at byte addresses {[hex(i*4) for i in missed[:8]]}"
+        pass
+
+    for start, end in dirtyRanges:
+        for i in range(start, end):
+            dut.memory.mem_array[i].value = 0
+            pass
+        pass
+    if backdoor is not None:
+        backdoor.store_min_word.value = numWords
+        backdoor.store_max_word.value = 0
+        pass
+    _loadedWordRanges.clear()
+    _memoryClearedOnce = True
+    return sum(end - start for start, end in dirtyRanges)
+
+def _mergeRanges(ranges, limit):
+    """Merge overlapping [start,end) ranges, clamping them to [0,limit)"""
+    merged = []
+    for start, end in sorted((max(0, s), min(limit, e)) for s, e in ranges):
+        if start >= end:
+            continue
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+            pass
+        pass
+    return merged
+
+# [start,end) word index ranges loaded into memory since the last clearMemory() call
+_loadedWordRanges = []
+_memoryClearedOnce = False
+
 def loadBinaryIntoHexFile(binaryPath, hexfilePath, maxAddress=0):
     """Read the given binary's sections, and write them out to a file for $readmemh"""
-    
-    sectionInfo = getSectionInfo(binaryPath)
-    # print(sectionInfo)
-    sectionsToLoad = ['.start', '.text', '.rodata', '.srodata', '.sdata']
+    return writeMemoryImage(binaryPath, hexfilePath, maxAddress=maxAddress)
 
-    with open(hexfilePath,'w') as fd:
-        micByteOffset = 0
+class MemoryImageTooLarge(ValueError):
+    """Raised when a program doesn't fit in the memory we're generating an image for"""
+    pass
 
-        for sectionName in sectionsToLoad:
-            if sectionName not in sectionInfo:
-                continue
-            offset = sectionInfo[sectionName]['offset']
-            length = sectionInfo[sectionName]['size']
-            words = extractDataFromBinary(binaryPath, offset, length + (length % 4))
-            # if sectionName == '.rodata':
-            #     print(['0x%x' % w for w in words])
-            #     pass
-            memBaseAddr = sectionInfo[sectionName]['address']
-            print(f"loading {sectionName} section ({len(words)} words) into memory starting at 0x{memBaseAddr:x}")
-            if memBaseAddr + (len(words)*4) >= maxAddress:
-                print(f"code reaches address {memBaseAddr + (len(words)*4)} but we can only handle up to {maxAddress}")
-                sys.exit(1)
-
-            if memBaseAddr > 0 and memBaseAddr > micByteOffset:
-                # NB: `@40` target address syntax doesn't work in my yosys/nextpnr...
-                while micByteOffset < memBaseAddr:
-                    fd.write('00000013\n') # addi x0,x0,x0 - the official RV NOP
-                    micByteOffset += 4
-                    pass
-                pass
-            for i in range(len(words)):
-                fd.write(f'{words[i]:08x}\n')
-                micByteOffset += 4
+# memory image file formats we can write, keyed by file suffix
+MEMORY_IMAGE_FORMATS = {
+    '.hex': 'hex', # $readmemh, one word per line
+    '.mem': 'mem', # Vivado .mem, @address records followed by 8 words per line
+    '.bin': 'bin', # raw little-endian bytes starting from address 0
+}
+
+# bump this to regenerate all memory images, e.g., if the output of writeMemoryImage() changes
+MEMORY_IMAGE_VERSION = 1
+
+# the official RISC-V NOP, addi x0,x0,0, used to fill gaps in dense images
+RV_NOP = 0x00000013
+
+def writeMemoryImage(binaryPath, outputPath, format=None, maxAddress=0, sparse=False, force=False):
+    """Write the memory image of the given binary to outputPath, in one of MEMORY_IMAGE_FORMATS (by default, based on
+    outputPath's suffix). If maxAddress is nonzero, raises MemoryImageTooLarge if the image extends past it.
+
+    hex images are dense by default, with gaps filled with NOPs, since `@40` address records don't work with our
+    yosys/nextpnr. Pass sparse=True to use @address records instead; mem images are always sparse.
+
+    The output is skipped if outputPath was already generated, with the same options, from a binary with the same
+    contents; pass force=True to always write it. Returns True if outputPath was written."""
+    outputPath = Path(outputPath)
+    format = MEMORY_IMAGE_FORMATS.get(outputPath.suffix) if format is None else format
+    assert format in MEMORY_IMAGE_FORMATS.values(), f"unknown memory image format for {outputPath}, expected one of {list(MEMORY_IMAGE_FORMATS)}"
+
+    binaryHash = hashlib.sha256(mapBinary(binaryPath)).hexdigest()
+    stamp = json.dumps({'version': MEMORY_IMAGE_VERSION, 'binary': binaryHash, 'format': format, 'sparse': sparse, 'maxAddress': maxAddress})
+    stampPath = outputPath.with_name(outputPath.name + '.stamp')
+    if not force and outputPath.exists() and stampPath.exists() and stampPath.read_text() == stamp:
+        print(f"{outputPath} is up to date with {binaryPath}")
+        return False
+
+    image = MemoryImage.fromBinary(binaryPath)
+    for sectionName, memBaseAddr, words in image.sections():
+        print(f"loading {sectionName} section ({len(words)} words) into memory starting at 0x{memBaseAddr:x}")
+        pass
+    if maxAddress != 0 and image.endAddress() > maxAddress:
+        raise MemoryImageTooLarge(f"code reaches address {image.endAddress()} but we can only handle up to {maxAddress}")
+
+    # write to a temporary file first, so that an error doesn't leave a partial image behind
+    outputPath.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmpPath = tempfile.mkstemp(dir=outputPath.parent, prefix=f'.{outputPath.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if format == 'bin' else 'w') as out:
+            if format == 'bin':
+                out.write(image.toBytes())
+            elif format == 'mem':
+                _writeVivadoMemRecords(out, image.sections())
+            elif sparse:
+                image.toReadmemh(out)
+            else:
+                _writeReadmemhRecords(out, [('', 0, _denseWords(image, RV_NOP))], addressRecords=False)
                 pass
             pass
+        os.replace(tmpPath, outputPath)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+    stampPath.write_text(stamp)
+    return True
+
+def _denseWords(image, fill):
+    """Returns the image's words from address 0 to its end, as an array('I'), with gaps filled with `fill`"""
+    words = array('I', [fill]) * (image.endAddress() // 4)
+    for _, memBaseAddr, sectionWords in image.sections():
+        words[memBaseAddr >> 2:(memBaseAddr >> 2) + len(sectionWords)] = sectionWords
+        pass
+    return words
+
+def _writeVivadoMemRecords(memFile, sections):
+    """Write the given (name, address, words) sections to memFile, an open text file, in Vivado .mem format"""
+    for _, memBaseAddr, words in sections:
+        if len(words) == 0:
+            continue
+        memFile.write(f'@{memBaseAddr >> 2:08X}\n')
+        for i in range(0, len(words), 8):
+            memFile.write(' '.join(f'{w:08X}' for w in words[i:i + 8]))
+            memFile.write('\n')
+            pass
         pass
     pass
 
-def getSectionInfo(binaryPath):
-    """Returns information about the sections in the binary given at `binaryPath`. Returns a dictionary with
-     a key for each section name. The values are also dicts containing information (offset, size, etc) for that section."""
+# ELF32 file header, section header and program header layouts (little-endian)
+ELF32_HEADER = struct.Struct('<16sHHIIIIIHHHHHH')
+ELF32_SECTION_HEADER = struct.Struct('<10I')
+ELF32_PROGRAM_HEADER = struct.Struct('<8I')
+
+# section type names, as printed by readelf
+ELF_SECTION_TYPES = {
+    0: 'NULL', 1: 'PROGBITS', 2: 'SYMTAB', 3: 'STRTAB', 4: 'RELA', 5: 'HASH', 6: 'DYNAMIC', 7: 'NOTE',
+    8: 'NOBITS', 9: 'REL', 10: 'SHLIB', 11: 'DYNSYM', 14: 'INIT_ARRAY', 15: 'FINI_ARRAY',
+    16: 'PREINIT_ARRAY', 17: 'GROUP', 18: 'SYMTAB_SHNDX', 0x70000003: 'RISCV_ATTRIBUTES',
+}
+
+# segment type names, as printed by readelf
+ELF_SEGMENT_TYPES = {
+    0: 'NULL', 1: 'LOAD', 2: 'DYNAMIC', 3: 'INTERP', 4: 'NOTE', 5: 'SHLIB', 6: 'PHDR', 7: 'TLS',
+    0x6474e551: 'GNU_STACK', 0x6474e552: 'GNU_RELRO', 0x70000003: 'RISCV_ATTRIBUTES',
+}
+
+def _readElf32(binaryPath):
+    """Parse the section and program headers of the ELF32 file at `binaryPath`, without
+    running any external programs. Returns a (sections, segments) tuple, see getSectionInfo() and getProgramHeaders()."""
     bp = Path(binaryPath)
     assert bp.exists(), bp
-    cmd = [READELF,'--wide','--sections',bp]
-    process = subprocess.run(cmd, capture_output=True, check=False, text=True)
-    if process.returncode != 0:
-        print(f"Error: {process.stderr}")
-        process.check_returncode() # throws
-        pass
+    with open(bp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        assert len(mm) >= ELF32_HEADER.size, f'{bp} is too small to be an ELF file'
+        (ident, _, _, _, _, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum, shstrndx) = ELF32_HEADER.unpack_from(mm, 0)
+        assert ident[:4] == b'\x7fELF', f'{bp} is not an ELF file'
+        assert ident[4] == 1, f'{bp} is not a 32-bit ELF file'
+        assert ident[5] == 1, f'{bp} is not a little-endian ELF file'
 
-    section_headers = {}
-    header_pattern = re.compile(r'\[\s*(\d+)\]\s+([.]\S+)\s+(\S*)\s+([0-9a-fA-F]+)\s+([0-9a-fA-F]+)\s+([0-9a-fA-F]+)\s+(\S*)')
+        rawSections = [ELF32_SECTION_HEADER.unpack_from(mm, shoff + (i * shentsize)) for i in range(shnum)]
+        strtabOffset = rawSections[shstrndx][4] if shnum > 0 else 0
 
-    for line in process.stdout.splitlines():
-        match = header_pattern.search(line)
-        if match:
-            index, name, type_, addr, offset, size, es = match.groups()
-            section_headers[name] = {
+        sections = {}
+        for index, (nameOffset, type_, flags, addr, offset, size, _, _, _, es) in enumerate(rawSections):
+            nameStart = strtabOffset + nameOffset
+            name = mm[nameStart:mm.find(b'\0', nameStart)].decode('ascii')
+            if index == 0 or name == '':
+                continue
+            sections[name] = {
                 'name': name,
-                'type': type_,
-                'address': int(addr, 16),
-                'offset': int(offset, 16),
-                'size': int(size, 16),
-                'ES': int(es, 16),
-                #'flags': flags,
-                #'Lk': int(lk),
-                #'Inf': int(inf),
-                #'Al': int(al)
+                'type': ELF_SECTION_TYPES.get(type_, f'0x{type_:x}'),
+                'flags': flags,
+                'address': addr,
+                'offset': offset,
+                'size': size,
+                'ES': es,
             }
             pass
+
+        segments = []
+        for i in range(phnum):
+            (type_, offset, vaddr, paddr, filesz, memsz, flags, align) = ELF32_PROGRAM_HEADER.unpack_from(mm, phoff + (i * phentsize))
+            segments.append({
+                'type': ELF_SEGMENT_TYPES.get(type_, f'0x{type_:x}'),
+                'offset': offset,
+                'vaddr': vaddr,
+                'paddr': paddr,
+                'filesz': filesz,
+                'memsz': memsz,
+                'flags': flags,
+                'align': align,
+            })
+            pass
         pass
+    return sections, segments
 
-    return section_headers
+def getSectionInfo(binaryPath):
+    """Returns information about the sections in the binary given at `binaryPath`. Returns a dictionary with
+     a key for each section name. The values are also dicts containing information (offset, size, etc) for that section."""
+    return _readElf32(binaryPath)[0]
+
+def getProgramHeaders(binaryPath):
+    """Returns a list of the program headers (segments) in the binary given at `binaryPath`. Each element is a dict
+    containing information (offset, vaddr, filesz, etc) for that segment."""
+    return _readElf32(binaryPath)[1]
 
 def extractDataFromBinary(binaryPath, offset, length):
-    """read the given chunk of the binary, returning a list of ints (4B words)"""
-    assert 0 == length % 4, f"can only read multiples of 4B words, but section length is {length} bytes"
+    """read the given chunk of the binary, returning an array('I') of 4B words. If length isn't a multiple of 4B,
+    the last word is padded with zeroes."""
+    return bytesToWords(mapBinary(binaryPath)[offset:offset + length])
 
-    with open(binaryPath, 'rb') as file:
-        # Seek to the start of the .text section
-        file.seek(offset)
-        # read the bytes, one 4B word at a time
-        words = []
-        for _ in range(int(length / 4)):
-            insnBytes = file.read(4)
-            words.append(int.from_bytes(insnBytes, 'little'))
-            pass
-        return words
+def mapBinary(binaryPath):
+    """Returns a read-only memoryview of the entire file at binaryPath. The file is mmap'ed rather than read, so
+    slicing the view doesn't copy anything."""
+    with open(binaryPath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        # the mapping stays valid after we close the file, and is unmapped once the last view of it goes away
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def bytesToWords(data):
+    """Convert little-endian bytes (or a memoryview of them) to an array('I') of 4B words, zero-padding a partial last word"""
+    tailLength = len(data) % 4
+    words = array('I')
+    words.frombytes(data[:len(data) - tailLength])
+    if tailLength != 0:
+        words.frombytes(bytes(data[len(data) - tailLength:]) + bytes(4 - tailLength))
+        pass
+    if sys.byteorder == 'big':
+        words.byteswap()
+        pass
+    return words
 
 def binaryToHex(binPath):
     sectionInfo = getSectionInfo(binPath)
@@ -178,7 +662,7 @@ def binaryToHex(binPath):
             continue
         offset = sectionInfo[sectionName]['offset']
         length = sectionInfo[sectionName]['size']
-        words = extractDataFromBinary(binPath, offset, length + (length % 4))
+        words = extractDataFromBinary(binPath, offset, length)
         for w in words:
             print(format(w, '08x'))
             pass
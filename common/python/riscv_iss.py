@@ -0,0 +1,283 @@
+"""A simple RV32IM instruction-set simulator (ISS), used as a golden model for our processors. Cosim steps the ISS
+in lockstep with a simulated processor, once for each insn the processor completes, checking the pc and insn of
+each one and the value it writes to the register file. This provides architectural checking for any program,
+without needing a trace-*.json file for it.
+
+The ISS models the memory our processors use: NUM_WORDS 4B words, with addresses wrapping around, and binaries
+loaded (via riscv_binary_utils.MemoryImage) at address 0 where execution begins.
+
+Usage, to run a binary on the ISS by itself:
+    python3 riscv_iss.py BINARY
+"""
+
+import sys
+
+MASK32 = 0xFFFF_FFFF
+
+# size of our processors' memories, in 4B words
+NUM_WORDS = 8192
+
+OPCODE_LOAD = 0b0000011
+OPCODE_MISC_MEM = 0b0001111
+OPCODE_OP_IMM = 0b0010011
+OPCODE_AUIPC = 0b0010111
+OPCODE_STORE = 0b0100011
+OPCODE_OP = 0b0110011
+OPCODE_LUI = 0b0110111
+OPCODE_BRANCH = 0b1100011
+OPCODE_JALR = 0b1100111
+OPCODE_JAL = 0b1101111
+OPCODE_SYSTEM = 0b1110011
+
+INSN_ECALL = 0x0000_0073
+INSN_EBREAK = 0x0010_0073
+
+class IllegalInstruction(Exception):
+    pass
+
+def signed(value):
+    """Interpret a 32-bit value as two's complement"""
+    return value - (1 << 32) if value & 0x8000_0000 else value
+
+def signExtend(value, bits):
+    signBit = 1 << (bits - 1)
+    return (value & (signBit - 1)) - (value & signBit)
+
+def _div(a, b):
+    """RISC-V signed division: rounds towards zero, x/0 is -1 and overflow returns the dividend"""
+    sa, sb = signed(a), signed(b)
+    if sb == 0:
+        return MASK32
+    if sa == -(1 << 31) and sb == -1:
+        return a
+    quotient = abs(sa) // abs(sb)
+    return -quotient if (sa < 0) != (sb < 0) else quotient
+
+def _rem(a, b):
+    """RISC-V signed remainder: takes the sign of the dividend, x%0 is x and overflow returns 0"""
+    sa, sb = signed(a), signed(b)
+    if sb == 0:
+        return a
+    if sa == -(1 << 31) and sb == -1:
+        return 0
+    remainder = abs(sa) % abs(sb)
+    return -remainder if sa < 0 else remainder
+
+# register-register ALU ops, keyed by (funct7, funct3)
+ALU_OPS = {
+    (0x00, 0b000): lambda a, b: a + b,
+    (0x20, 0b000): lambda a, b: a - b,
+    (0x00, 0b001): lambda a, b: a << (b & 31),
+    (0x00, 0b010): lambda a, b: int(signed(a) < signed(b)),
+    (0x00, 0b011): lambda a, b: int(a < b),
+    (0x00, 0b100): lambda a, b: a ^ b,
+    (0x00, 0b101): lambda a, b: a >> (b & 31),
+    (0x20, 0b101): lambda a, b: signed(a) >> (b & 31),
+    (0x00, 0b110): lambda a, b: a | b,
+    (0x00, 0b111): lambda a, b: a & b,
+    (0x01, 0b000): lambda a, b: a * b,
+    (0x01, 0b001): lambda a, b: (signed(a) * signed(b)) >> 32,
+    (0x01, 0b010): lambda a, b: (signed(a) * b) >> 32,
+    (0x01, 0b011): lambda a, b: (a * b) >> 32,
+    (0x01, 0b100): _div,
+    (0x01, 0b101): lambda a, b: MASK32 if b == 0 else a // b,
+    (0x01, 0b110): _rem,
+    (0x01, 0b111): lambda a, b: a if b == 0 else a % b,
+}
+
+BRANCH_CONDITIONS = {
+    0b000: lambda a, b: a == b,
+    0b001: lambda a, b: a != b,
+    0b100: lambda a, b: signed(a) < signed(b),
+    0b101: lambda a, b: signed(a) >= signed(b),
+    0b110: lambda a, b: a < b,
+    0b111: lambda a, b: a >= b,
+}
+
+# loads, keyed by funct3: (size in bytes, sign-extend?)
+LOAD_TYPES = {0b000: (1, True), 0b001: (2, True), 0b010: (4, False), 0b100: (1, False), 0b101: (2, False)}
+
+# stores, keyed by funct3: size in bytes
+STORE_SIZES = {0b000: 1, 0b001: 2, 0b010: 4}
+
+class RiscvIss:
+    """An RV32IM hart with its own memory. Each insn is decoded once, into a function that executes it, and
+    cached by its encoding."""
+
+    def __init__(self, image=None, numWords=NUM_WORDS):
+        self.memory = bytearray(numWords * 4)
+        self.addressMask = (numWords * 4) - 1
+        self.regs = [0] * 32
+        self.pc = 0
+        self.halted = False
+        self.instret = 0
+        self._decoded = {}
+        if image is not None:
+            for _, address, words in image.sections():
+                data = _wordsToBytes(words)
+                for i in range(0, len(data), 4):
+                    start = (address + i) & self.addressMask
+                    self.memory[start:start + 4] = data[i:i + 4]
+                    pass
+                pass
+            pass
+        pass
+
+    def load(self, address, size):
+        address &= self.addressMask
+        return int.from_bytes(self.memory[address:address + size], 'little')
+
+    def store(self, address, size, value):
+        address &= self.addressMask
+        self.memory[address:address + size] = (value & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+        pass
+
+    def fetch(self):
+        return self.load(self.pc, 4)
+
+    def step(self):
+        """Execute one insn. Returns a (pc, insn, rd, value) tuple, where rd is the register written (0 if none)
+        and value is what was written to it."""
+        pc = self.pc
+        insn = self.load(pc, 4)
+        execute = self._decoded.get(insn)
+        if execute is None:
+            execute = self._decoded[insn] = self._decode(insn, pc)
+            pass
+        rd, value, nextPc = execute(pc)
+        if rd != 0:
+            value &= MASK32
+            self.regs[rd] = value
+            pass
+        self.pc = nextPc & MASK32
+        self.instret += 1
+        return pc, insn, rd, value
+
+    def run(self, maxInsns):
+        """Run until an ecall/ebreak or maxInsns have executed"""
+        for _ in range(maxInsns):
+            if self.halted:
+                break
+            self.step()
+            pass
+        pass
+
+    def _decode(self, insn, pc):
+        """Returns a function that executes the given insn: it takes the pc, and returns (rd, value, nextPc)"""
+        regs = self.regs
+        opcode = insn & 0x7F
+        rd = (insn >> 7) & 0x1F
+        funct3 = (insn >> 12) & 0x7
+        rs1 = (insn >> 15) & 0x1F
+        rs2 = (insn >> 20) & 0x1F
+        funct7 = insn >> 25
+        immI = signExtend(insn >> 20, 12)
+
+        if opcode == OPCODE_LUI:
+            immU = insn & 0xFFFF_F000
+            return lambda pc: (rd, immU, pc + 4)
+        if opcode == OPCODE_AUIPC:
+            immU = insn & 0xFFFF_F000
+            return lambda pc: (rd, pc + immU, pc + 4)
+        if opcode == OPCODE_JAL:
+            immJ = signExtend((((insn >> 31) & 1) << 20) | (((insn >> 12) & 0xFF) << 12) |
+                              (((insn >> 20) & 1) << 11) | (((insn >> 21) & 0x3FF) << 1), 21)
+            return lambda pc: (rd, pc + 4, pc + immJ)
+        if opcode == OPCODE_JALR and funct3 == 0:
+            return lambda pc: (rd, pc + 4, (regs[rs1] + immI) & ~1)
+        if opcode == OPCODE_BRANCH and funct3 in BRANCH_CONDITIONS:
+            condition = BRANCH_CONDITIONS[funct3]
+            immB = signExtend((((insn >> 31) & 1) << 12) | (((insn >> 7) & 1) << 11) |
+                              (((insn >> 25) & 0x3F) << 5) | (((insn >> 8) & 0xF) << 1), 13)
+            return lambda pc: (0, 0, pc + immB if condition(regs[rs1], regs[rs2]) else pc + 4)
+        if opcode == OPCODE_LOAD and funct3 in LOAD_TYPES:
+            size, isSigned = LOAD_TYPES[funct3]
+            if isSigned:
+                return lambda pc: (rd, signExtend(self.load(regs[rs1] + immI, size), 8 * size), pc + 4)
+            return lambda pc: (rd, self.load(regs[rs1] + immI, size), pc + 4)
+        if opcode == OPCODE_STORE and funct3 in STORE_SIZES:
+            size = STORE_SIZES[funct3]
+            immS = signExtend(((insn >> 25) << 5) | ((insn >> 7) & 0x1F), 12)
+            def store(pc):
+                self.store(regs[rs1] + immS, size, regs[rs2])
+                return 0, 0, pc + 4
+            return store
+        if opcode == OPCODE_OP_IMM:
+            if funct3 == 0b001 or funct3 == 0b101:
+                # shifts use funct7 to choose srli vs srai, and the low bits of the immediate as the shift amount
+                if (funct7, funct3) not in ALU_OPS or funct7 == 0x01:
+                    raise IllegalInstruction(f'illegal insn 0x{insn:08x} at pc 0x{pc:x}')
+                op = ALU_OPS[(funct7, funct3)]
+                return lambda pc: (rd, op(regs[rs1], rs2), pc + 4)
+            op = ALU_OPS[(0x00, funct3)]
+            immIU = immI & MASK32
+            return lambda pc: (rd, op(regs[rs1], immIU), pc + 4)
+        if opcode == OPCODE_OP and (funct7, funct3) in ALU_OPS:
+            op = ALU_OPS[(funct7, funct3)]
+            return lambda pc: (rd, op(regs[rs1], regs[rs2]), pc + 4)
+        if opcode == OPCODE_MISC_MEM:
+            # fence and fence.i have no effect, as we have no caches and only one hart
+            return lambda pc: (0, 0, pc + 4)
+        if opcode == OPCODE_SYSTEM:
+            if insn == INSN_ECALL or insn == INSN_EBREAK:
+                def halt(pc):
+                    self.halted = True
+                    return 0, 0, pc + 4
+                return halt
+            # our processors don't implement CSRs, so treat CSR insns as nops
+            return lambda pc: (0, 0, pc + 4)
+        raise IllegalInstruction(f'illegal insn 0x{insn:08x} at pc 0x{pc:x}')
+
+def _wordsToBytes(words):
+    return b''.join((w & MASK32).to_bytes(4, 'little') for w in words)
+
+class Cosim:
+    """Checks a simulated processor against the ISS, in lockstep. Call check() on every cycle with that cycle's
+    trace signals. Whenever the processor completes an insn, its pc and insn must match the ISS's next insn, which
+    the ISS then executes. The register the insn writes is checked on the following cycle, once the processor's
+    register file has been updated."""
+
+    def __init__(self, image, noStallStatus):
+        self.iss = RiscvIss(image)
+        self.noStallStatus = noStallStatus
+        # (rd, value, pc, insn) of the register write to check next cycle
+        self.pendingWrite = None
+        pass
+
+    def checkPendingWrite(self, cycle, readRegister):
+        """Check the register written by the insn completed on the previous cycle, if any"""
+        if self.pendingWrite is not None:
+            rd, expected, writerPc, writerInsn = self.pendingWrite
+            self.pendingWrite = None
+            actual = readRegister(rd)
+            assert expected == actual, f'cosim error at cycle {cycle}: insn 0x{writerInsn:08x} at pc 0x{writerPc:x} should have written 0x{expected:08x} to x{rd}, but x{rd} is 0x{actual:08x}'
+            pass
+        pass
+
+    def check(self, cycle, pc, insn, status, readRegister):
+        """Check one cycle. readRegister(r) must return the processor's current value of register r."""
+        self.checkPendingWrite(cycle, readRegister)
+        if 0 == status & self.noStallStatus:
+            return
+        expectedPc, expectedInsn = self.iss.pc, self.iss.fetch()
+        assert expectedPc == pc, f'cosim error at cycle {cycle}: expected to complete the insn at pc 0x{expectedPc:x} but completed pc 0x{pc:x}'
+        assert expectedInsn == insn, f'cosim error at cycle {cycle}: expected insn 0x{expectedInsn:08x} at pc 0x{pc:x} but was 0x{insn:08x}'
+        _, _, rd, value = self.iss.step()
+        if rd != 0:
+            self.pendingWrite = (rd, value, pc, insn)
+            pass
+        pass
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print(f'usage: {sys.argv[0]} BINARY')
+        sys.exit(1)
+    import time
+    import riscv_binary_utils
+    iss = RiscvIss(riscv_binary_utils.MemoryImage.fromBinary(sys.argv[1]))
+    start = time.perf_counter()
+    iss.run(10_000_000)
+    elapsed = time.perf_counter() - start
+    print(f'executed {iss.instret} insns in {elapsed:.2f}s ({iss.instret / elapsed / 1e6:.2f}M insns/s), halted: {iss.halted}')
+    print(' '.join(f'x{i}=0x{v:x}' for i, v in enumerate(iss.regs)))
+    pass
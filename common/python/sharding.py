@@ -0,0 +1,183 @@
+"""Run a homework's cocotb tests in several simulator processes at once. The simulator is built once, as usual, and
+then each shard runs a disjoint subset of the tests in its own directory (sim_build_shardN, alongside the build
+directory, so that relative paths to traces and riscv-tests work the same). Tests are balanced across shards by their
+durations from previous runs (see telemetry.py), longest first. The shards' results files are merged into the one
+that a single simulator process would have written, so get_results() and points.json work as before, and everything
+else the shards wrote (cycle accounting reports, converted traces, logs) is moved into the build directory too.
+
+Use `pytest --shards N` (or set RV_SHARDS=N) to run N shards, or `--shards auto` for one per two cores. The default
+is a single simulator process, exactly as before sharding.
+"""
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import os
+import shutil
+import statistics
+import xml.etree.ElementTree as ET
+
+from cocotb.decorators import test as CocotbTest
+from cocotb.runner import get_runner, get_results
+
+import cocotb_utils as cu
+import debug_rerun
+import telemetry
+from waves import windowed as wavesWindowed
+
+SHARDS_ENV = 'RV_SHARDS'
+
+# assumed duration, in seconds, of tests when we have no telemetry at all. Otherwise, tests without telemetry are
+# assumed to take the median duration of those with it.
+DEFAULT_TEST_SECONDS = 1.0
+
+def numShards(pytestconfig):
+    """Returns the number of shards requested via --shards or RV_SHARDS"""
+    shards = getattr(pytestconfig.option, 'shards', None) or os.environ.get(SHARDS_ENV, '1')
+    if shards == 'auto':
+        return max(1, os.cpu_count() // 2)
+    return max(1, int(shards))
+
+def discoverTests(testModule):
+    """Returns the names of the cocotb tests in the given module, in the order cocotb would run them, skipping the
+    ones marked skip=True"""
+    module = importlib.import_module(testModule)
+    return [name for name, thing in vars(module).items()
+            if isinstance(thing, CocotbTest) and not thing.skip]
+
+def testDurations():
+    """Returns a dict of the latest recorded duration of each test in this homework, from telemetry.jsonl"""
+    durations = {}
+    try:
+        records = telemetry.readRecords([telemetry.telemetryPath()])
+    except (OSError, ValueError):
+        return durations
+    for r in records:
+        if r.get('kind') == 'test':
+            durations[r['test']] = r['seconds']
+            pass
+        pass
+    return durations
+
+def balanceShards(tests, durations, shards):
+    """Split tests into the given number of shards, assigning the longest tests first, each to the shard with the
+    least total duration so far. Each shard keeps its tests in their original order."""
+    default = statistics.median(durations.values()) if len(durations) > 0 else DEFAULT_TEST_SECONDS
+    order = {t: i for i, t in enumerate(tests)}
+    loads = [0.0] * shards
+    assigned = [[] for _ in range(shards)]
+    for t in sorted(tests, key=lambda t: durations.get(t, default), reverse=True):
+        s = loads.index(min(loads))
+        assigned[s].append(t)
+        loads[s] += durations.get(t, default)
+        pass
+    return [sorted(a, key=order.get) for a in assigned if len(a) > 0]
+
+def mergeResults(resultsFiles, mergedFile):
+    """Merge the testsuites of the given cocotb results files into one results file"""
+    merged = ET.Element('testsuites', name='results')
+    for resultsFile in resultsFiles:
+        merged.extend(ET.parse(resultsFile).getroot().iter('testsuite'))
+        pass
+    ET.ElementTree(merged).write(mergedFile, encoding='UTF-8', xml_declaration=True)
+    pass
+
+def _moveInto(src, dst):
+    """Move the file or directory src to dst, merging directories and replacing files"""
+    if src.is_dir() and dst.is_dir():
+        for child in src.iterdir():
+            _moveInto(child, dst / child.name)
+            pass
+        src.rmdir()
+    else:
+        if dst.is_dir():
+            shutil.rmtree(dst)
+            pass
+        os.replace(src, dst)
+        pass
+    pass
+
+def collectShard(shardDir, shard):
+    """Move everything that a shard wrote, other than its results file, into SIM_BUILD_DIR, where a single simulator
+    process would have written it, and remove the shard's directory. Its sim.log becomes sim_shardN.log."""
+    for path in shardDir.iterdir():
+        if path.name == cu.resultsFileName():
+            continue # merged already
+        name = f'sim_shard{shard}.log' if path.name == 'sim.log' else path.name
+        _moveInto(path, Path(cu.SIM_BUILD_DIR, name))
+        pass
+    shutil.rmtree(shardDir, ignore_errors=True)
+    pass
+
+def runTests(runr, pytestconfig, hdl_toplevel, test_module, seed=None, waves=False):
+    """Run the cocotb tests in test_module against the simulator that runr just built in SIM_BUILD_DIR, in as many
+    shards as requested. Like runr.test(), this raises SystemExit if any test fails, after rerunning the failed tests
+    with waveforms (see debug_rerun.py)."""
+    shards = numShards(pytestconfig)
+    if wavesWindowed():
+        waves = False # only the requested windows are dumped, see waves.py
+        pass
+    if pytestconfig.option.tests != '':
+        tests = [t.strip() for t in pytestconfig.option.tests.split(',') if t.strip() != '']
+    else:
+        tests = discoverTests(test_module)
+        pass
+    if shards == 1 or len(tests) <= 1:
+        debug_rerun.test(
+            runr,
+            seed=seed,
+            waves=waves,
+            hdl_toplevel=hdl_toplevel,
+            test_module=test_module,
+            testcase=pytestconfig.option.tests, # filter tests via the `--tests` command-line flag
+        )
+        return
+
+    shardTests = balanceShards(tests, testDurations(), shards)
+    print(f'INFO: running {len(tests)} tests in {len(shardTests)} shards')
+
+    def runShard(i):
+        # a runner per shard, as runners keep the settings of the current test run
+        shardRunner = get_runner(cu.SIM)
+        testDir = Path(f'{cu.SIM_BUILD_DIR}_shard{i}')
+        testDir.mkdir(exist_ok=True)
+        logFile = testDir / 'sim.log'
+        try:
+            shardRunner.test(
+                seed=seed,
+                waves=waves,
+                hdl_toplevel=hdl_toplevel,
+                hdl_toplevel_lang='verilog',
+                build_dir=cu.SIM_BUILD_DIR,
+                test_dir=testDir,
+                test_module=test_module,
+                testcase=shardTests[i],
+                log_file=logFile,
+            )
+        except SystemExit:
+            pass # we check the results once all shards are done
+        return testDir / cu.resultsFileName(), logFile
+
+    with ThreadPoolExecutor(max_workers=len(shardTests)) as pool:
+        results = list(pool.map(runShard, range(len(shardTests))))
+        pass
+
+    for i, (_, logFile) in enumerate(results):
+        print(f'INFO: ===== shard {i}: {",".join(shardTests[i])} =====')
+        if logFile.exists():
+            print(logFile.read_text())
+            pass
+        pass
+    missing = [str(f) for f, _ in results if not f.is_file()]
+    if len(missing) > 0:
+        raise SystemExit(f'ERROR: Simulation terminated abnormally. Results files {missing} not found.')
+    mergedFile = Path(cu.SIM_BUILD_DIR, cu.resultsFileName())
+    mergeResults([f for f, _ in results], mergedFile)
+    for i, (resultsFile, _) in enumerate(results):
+        collectShard(resultsFile.parent, i)
+        pass
+    numTests, numFailed = get_results(mergedFile)
+    if numFailed:
+        debug_rerun.rerunFailures(runr, mergedFile, hdl_toplevel, test_module, seed=seed)
+        raise SystemExit(f'ERROR: Failed {numFailed} of {numTests} tests.')
+    pass
@@ -0,0 +1,183 @@
+"""Benchmarks of our simulation infrastructure, e.g., how long it takes to load a binary into memory. These
+run as cocotb tests against a homework's simulator, but live outside the testbench files so that they don't
+count towards the autograder's points.
+
+Usage, from a homework directory (e.g., hw5-pipelined) whose tests have already been built by running them:
+    python3 ../common/python/sim_benchmarks.py [benchmark ...]
+With no arguments, all benchmarks are run. The simulator that the tests built under the current build profile
+(in sim_build_fast by default, see cocotb_utils.simBuildDir()) is reused rather than rebuilt, so rerun the
+homework's tests first if the SystemVerilog code has changed.
+
+To compare the simulation speed of the build profiles (see cocotb_utils.BUILD_PROFILES) on dhrystone, which builds
+the processor under each profile and so works from a clean homework directory too:
+    python3 ../common/python/sim_benchmarks.py --profiles
+"""
+
+import cocotb
+import importlib
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from cocotb.triggers import RisingEdge, Timer
+
+import riscv_binary_utils
+import cocotb_utils as cu
+import telemetry
+
+# testbench module, in the current homework directory, whose binaries we benchmark with
+TESTBENCH_MODULE = os.environ.get('BENCHMARK_TESTBENCH', 'testbench')
+
+BENCHMARKS = ['benchmarkMemoryLoad', 'benchmarkTraceSampling']
+
+# number of cycles to sample the trace for
+TRACE_SAMPLING_CYCLES = 5000
+
+def millis(seconds):
+    return f'{seconds * 1000:8.2f}'
+
+@cocotb.test()
+async def benchmarkMemoryLoad(dut):
+    """Compare loading each riscv-tests binary into memory word-by-word via VPI versus with one $readmemh call"""
+    tb = importlib.import_module(TESTBENCH_MODULE)
+    binaries = [Path(b) for b in tb.RV_TEST_BINARIES] + [cu.RISCV_BENCHMARKS_PATH / 'dhrystone.riscv']
+
+    rows = []
+    for binaryPath in binaries:
+        sections = riscv_binary_utils.getSectionsToLoad(binaryPath)
+        numWords = sum(len(words) for _, _, words in sections)
+
+        # clear the loaded words, so we can check that the $readmemh load writes them all
+        for _, memBaseAddr, words in sections:
+            for i in range(len(words)):
+                dut.memory.mem_array[(memBaseAddr >> 2) + i].value = 0
+                pass
+            pass
+        await Timer(1, 'ns')
+
+        start = time.perf_counter()
+        riscv_binary_utils.loadSectionsIntoMemory(dut, sections, mode='readmemh')
+        await Timer(1, 'ns')
+        readmemhTime = time.perf_counter() - start
+
+        for sectionName, memBaseAddr, words in sections:
+            for i in range(len(words)):
+                cu.assertEquals(words[i], dut.memory.mem_array[(memBaseAddr >> 2) + i].value.integer,
+                                f'{binaryPath.name} {sectionName} word {i} after $readmemh load')
+                pass
+            pass
+
+        start = time.perf_counter()
+        riscv_binary_utils.loadSectionsIntoMemory(dut, sections, mode='vpi')
+        await Timer(1, 'ns')
+        vpiTime = time.perf_counter() - start
+
+        rows.append((binaryPath.name, numWords, vpiTime, readmemhTime))
+        pass
+
+    lines = [f'{"binary":<24} {"words":>6} {"vpi ms":>8} {"readmemh ms":>11} {"speedup":>8}']
+    for name, numWords, vpiTime, readmemhTime in rows:
+        lines.append(f'{name:<24} {numWords:>6} {millis(vpiTime)} {millis(readmemhTime):>11} {vpiTime / readmemhTime:>7.1f}x')
+        pass
+    totalVpi = sum(r[2] for r in rows)
+    totalReadmemh = sum(r[3] for r in rows)
+    lines.append(f'{"total":<24} {sum(r[1] for r in rows):>6} {millis(totalVpi)} {millis(totalReadmemh):>11} {totalVpi / totalReadmemh:>7.1f}x')
+    dut._log.info('memory load times\n' + '\n'.join(lines))
+    pass
+
+def processorClock(dut):
+    """hw3 and hw4 have separate processor and memory clocks, later homeworks have just one"""
+    try:
+        return dut.clock_proc
+    except AttributeError:
+        return dut.clk
+
+def sampleTraceByName(dut, statusEnum):
+    """Sample the trace signals the way handleTrace() used to, looking up each one by name and decoding the cycle status"""
+    return {
+        'cycle': dut.datapath.cycles_current.value.integer,
+        'trace_completed_pc': f'0x{dut.datapath.trace_completed_pc.value.integer:x}',
+        'trace_completed_insn': f'0x{dut.datapath.trace_completed_insn.value.integer:08x}',
+        'trace_completed_cycle_status': cu.intToEnumString(dut.datapath.trace_completed_cycle_status.value.integer, statusEnum),
+    }
+
+@cocotb.test()
+async def benchmarkTraceSampling(dut):
+    """Compare the per-cycle cost of sampling the trace signals by name versus with a TraceProbe"""
+    tb = importlib.import_module(TESTBENCH_MODULE)
+    await tb.preTestSetup(dut, cu.RISCV_TESTS_PATH / 'rv32ui-p-add')
+    clock = processorClock(dut)
+    statusEnum = cu.cycleStatusEnum()
+    probe = cu.TraceProbe(dut)
+
+    byNameTime, probeTime = 0.0, 0.0
+    start = time.perf_counter()
+    for _ in range(TRACE_SAMPLING_CYCLES):
+        await RisingEdge(clock)
+        t0 = time.perf_counter()
+        sampleTraceByName(dut, statusEnum)
+        t1 = time.perf_counter()
+        probe.sample()
+        probeTime += time.perf_counter() - t1
+        byNameTime += t1 - t0
+        pass
+    totalTime = time.perf_counter() - start
+
+    micros = lambda seconds: f'{seconds * 1e6 / TRACE_SAMPLING_CYCLES:7.2f}'
+    dut._log.info(f'trace sampling cost over {TRACE_SAMPLING_CYCLES} cycles, in microseconds per cycle\n'
+                  f'by name, decoding status: {micros(byNameTime)}\n'
+                  f'TraceProbe:               {micros(probeTime)} ({byNameTime / probeTime:.1f}x faster)\n'
+                  f'entire cycle:             {micros(totalTime)}')
+    pass
+
+def runBenchmarks(benchmarks, toplevel='Processor'):
+    """Run the given benchmarks against the simulator already built in the current homework's cu.SIM_BUILD_DIR"""
+    from cocotb.runner import get_runner
+    assert Path(cu.SIM_BUILD_DIR, toplevel).exists(), f'no simulator found in {cu.SIM_BUILD_DIR}, run the tests first'
+    # so the benchmarks can import the homework's testbench
+    sys.path.append(str(Path.cwd()))
+    runr = get_runner(cu.SIM)
+    runr.test(
+        test_module=Path(__file__).stem,
+        hdl_toplevel=toplevel,
+        hdl_toplevel_lang='verilog',
+        build_dir=cu.SIM_BUILD_DIR,
+        testcase=benchmarks,
+        results_xml='benchmarks.xml',
+    )
+    pass
+
+def compareBuildProfiles(profiles=('debug', 'fast'), test='dhrystone'):
+    """Run the given processor test under each build profile, and compare the cycles simulated per second that
+    each run recorded in telemetry.jsonl"""
+    if not telemetry.enabled():
+        raise SystemExit('build profiles are compared via telemetry, unset RV_TELEMETRY=0')
+    rates = {}
+    for profile in profiles:
+        start = time.time()
+        subprocess.run([sys.executable, '-m', 'pytest', '-q', 'testbench.py::runCocotbTestsProcessor',
+                        '--tests', test, '--build-profile', profile])
+        runs = [r for r in telemetry.readRecords([telemetry.telemetryPath()])
+                if r['kind'] == 'phase' and r.get('phase') == 'run' and r.get('test') == test
+                and r.get('build_profile') == profile and r['timestamp'] >= start]
+        if len(runs) == 0:
+            print(f'no {test} run recorded for the {profile} profile, see the pytest output above')
+            continue
+        rates[profile] = runs[-1]
+        pass
+    print(f'{"profile":<8} {"cycles":>10} {"seconds":>9} {"cycles/sec":>11} {"speedup":>8}')
+    baseline = next(iter(rates.values()), None)
+    for profile, r in rates.items():
+        print(f'{profile:<8} {r["cycles"]:>10} {r["seconds"]:>9.2f} {r["cycles_per_sec"]:>11.0f} '
+              f'{r["cycles_per_sec"] / baseline["cycles_per_sec"]:>7.2f}x')
+        pass
+    pass
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--profiles']:
+        compareBuildProfiles()
+    else:
+        runBenchmarks(sys.argv[1:] if len(sys.argv) > 1 else BENCHMARKS)
+        pass
+    pass
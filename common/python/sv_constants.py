@@ -0,0 +1,226 @@
+"""Extract constants from SystemVerilog source files, so that testbenches can use the values in the RTL instead of
+duplicating them. We understand:
+    typedef enums, with explicit or implicit (previous value + 1) member values
+    parameters and localparams, e.g., `localparam int AddrLsb = 2;`
+    `defines with a constant value, e.g., `define DIVIDER_STAGES 8
+Values may be decimal, sized or unsized based literals (8'hFF, 'b1010, 32'd7, with _ separators), references to
+earlier constants, and simple arithmetic over these, including $clog2(). Anything else (e.g., `define REG_SIZE 31:0)
+is skipped. This is just a lexical scan of one file: `ifdefs are ignored and included files aren't followed.
+
+Parsing results are cached on disk, keyed by the file's path and modification time, and in memory.
+"""
+
+from pathlib import Path
+import ast
+import hashlib
+import json
+import operator
+import os
+import re
+
+SV_CACHE_DIR = Path(os.environ.get('CIS5710_CACHE_DIR', Path.home() / '.cache' / 'cis5710')) / 'sv'
+
+# bump this to invalidate all cached results, e.g., if parseConstants() changes
+SV_CACHE_VERSION = 1
+
+_COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+_ENUM = re.compile(r'typedef\s+enum\b[^{]*\{(.*?)\}\s*(\w+)\s*;', re.DOTALL)
+_ENUM_MEMBER = re.compile(r'^\s*(\w+)\s*(?:=\s*(.+?))?\s*$', re.DOTALL)
+_PARAM = re.compile(r'\b(?:localparam|parameter)\b')
+_PARAM_ASSIGN = re.compile(r'(\w+)\s*=\s*(.+)', re.DOTALL)
+_DEFINE = re.compile(r'^\s*`define\s+(\w+)[ \t]+([^\n]*?)\s*$', re.MULTILINE)
+_LITERAL = re.compile(r"(\d[\d_]*)?\s*'\s*[sS]?([bBoOdDhH])\s*([0-9a-fA-F_]+)|\b\d[\d_]*\b")
+_CLOG2 = re.compile(r'\$clog2\b')
+_IDENTIFIER = re.compile(r'`?\b([A-Za-z_]\w*)\b')
+
+_BASES = {'b': 2, 'o': 8, 'd': 10, 'h': 16}
+
+def parseLiteral(text):
+    """Returns the int value of a SystemVerilog integer literal such as 42, 8'hFF or 'b1010, or None"""
+    m = _LITERAL.fullmatch(text.strip())
+    if m is None:
+        return None
+    if m.group(2) is None:
+        return int(m.group(0).replace('_', ''))
+    value = int(m.group(3).replace('_', ''), _BASES[m.group(2).lower()])
+    if m.group(1) is not None:
+        value &= (1 << int(m.group(1).replace('_', ''))) - 1
+        pass
+    return value
+
+def _clog2(value):
+    return max(0, (value - 1).bit_length())
+
+_BINARY_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod, ast.Pow: operator.pow, ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_, ast.BitAnd: operator.and_, ast.BitXor: operator.xor,
+}
+_UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert}
+
+def _evalNode(node, known):
+    if isinstance(node, ast.Expression):
+        return _evalNode(node.body, known)
+    if isinstance(node, ast.Constant) and isinstance(node.value, int):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in known:
+        return known[node.id]
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+        return _BINARY_OPS[type(node.op)](_evalNode(node.left, known), _evalNode(node.right, known))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        return _UNARY_OPS[type(node.op)](_evalNode(node.operand, known))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == '_clog2' and len(node.args) == 1:
+        return _clog2(_evalNode(node.args[0], known))
+    raise ValueError(f'unsupported expression {ast.dump(node)}')
+
+def evaluate(expression, known):
+    """Returns the int value of a constant SystemVerilog expression, where known maps the names of constants (and
+    `defines, with their backtick) to values, or None if we can't evaluate it"""
+    expression = _COMMENT.sub(' ', expression).strip()
+    value = parseLiteral(expression)
+    if value is not None:
+        return value
+    # turn the expression into Python, replacing literals and references to constants with their values
+    names = {}
+    def literal(m):
+        return str(parseLiteral(m.group(0)))
+    def identifier(m):
+        name = m.group(0)
+        if name not in known:
+            return name
+        names[f'_c{len(names)}'] = known[name]
+        return f'_c{len(names) - 1}'
+    python = _LITERAL.sub(literal, expression)
+    python = _CLOG2.sub('_clog2', python)
+    python = _IDENTIFIER.sub(identifier, python).replace('/', '//')
+    try:
+        return _evalNode(ast.parse(python, mode='eval'), names)
+    except (SyntaxError, ValueError, TypeError, ZeroDivisionError):
+        return None
+
+def _splitDeclaration(text, start):
+    """Returns the comma-separated parts of the declaration starting at text[start], which ends with a ; or with
+    the ) closing a parameter port list"""
+    parts = []
+    depth = 0
+    partStart = start
+    i = start
+    for i in range(start, len(text)):
+        c = text[i]
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            if depth == 0:
+                break
+            depth -= 1
+        elif c == ';' and depth == 0:
+            break
+        elif c == ',' and depth == 0:
+            parts.append(text[partStart:i])
+            partStart = i + 1
+            pass
+        pass
+    parts.append(text[partStart:i])
+    return parts
+
+def parseConstants(text):
+    """Returns the enums, params and defines in the given SystemVerilog source, as a dict with those three keys. enums
+    maps each enum type name to a dict of member names to values, and the others map names to values."""
+    text = _COMMENT.sub(lambda m: '\n' * m.group(0).count('\n'), text)
+    # constants are evaluated in source order, so that later ones can refer to earlier ones
+    items = [(m.start(), 'define', m) for m in _DEFINE.finditer(text)]
+    items += [(m.start(), 'enum', m) for m in _ENUM.finditer(text)]
+    items += [(m.start(), 'param', m) for m in _PARAM.finditer(text)]
+    result = {'enums': {}, 'params': {}, 'defines': {}}
+    known = {}
+    for _, kind, m in sorted(items, key=lambda item: item[0]):
+        if kind == 'define':
+            value = evaluate(m.group(2), known)
+            if value is not None:
+                result['defines'][m.group(1)] = value
+                known['`' + m.group(1)] = value
+                pass
+        elif kind == 'enum':
+            members = {}
+            nextValue = 0
+            for member in m.group(1).split(','):
+                mm = _ENUM_MEMBER.match(member)
+                if mm is None or mm.group(1) == '':
+                    continue
+                value = nextValue if mm.group(2) is None else evaluate(mm.group(2), known)
+                if value is None:
+                    break
+                members[mm.group(1)] = value
+                known[mm.group(1)] = value
+                nextValue = value + 1
+                pass
+            result['enums'][m.group(2)] = members
+        else:
+            for part in _splitDeclaration(text, m.end()):
+                assign = _PARAM_ASSIGN.search(part)
+                if assign is None:
+                    continue
+                name, expression = assign.groups()
+                value = evaluate(expression, known)
+                if value is not None:
+                    result['params'][name] = value
+                    known[name] = value
+                    pass
+                pass
+            pass
+        pass
+    return result
+
+# resolved path => (mtime_ns, size, constants)
+_memoryCache = {}
+
+def svConstants(path):
+    """Returns parseConstants() of the given file, from the in-memory or on-disk cache if the file hasn't changed"""
+    path = Path(path).resolve()
+    stat = path.stat()
+    cached = _memoryCache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    key = hashlib.sha256(f'{SV_CACHE_VERSION}\n{path}\n{stat.st_mtime_ns}\n{stat.st_size}'.encode()).hexdigest()
+    cacheFile = SV_CACHE_DIR / f'{key}.json'
+    try:
+        with open(cacheFile, 'r') as f:
+            constants = json.load(f)
+            pass
+    except (OSError, ValueError):
+        constants = parseConstants(path.read_text())
+        try:
+            SV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # write atomically, in case several test processes miss at the same time
+            tmpFile = cacheFile.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmpFile, 'w') as f:
+                json.dump(constants, f)
+                pass
+            os.replace(tmpFile, cacheFile)
+        except OSError:
+            pass # the cache is just an optimization
+        pass
+    _memoryCache[path] = (stat.st_mtime_ns, stat.st_size, constants)
+    return constants
+
+def svEnum(path, name):
+    """Returns the given enum from the given file as a dict mapping member names to values"""
+    enums = svConstants(path)['enums']
+    if name not in enums:
+        raise ValueError(f'Enum {name} not found in {path}')
+    return enums[name]
+
+def svParam(path, name):
+    """Returns the value of the given parameter or localparam from the given file"""
+    params = svConstants(path)['params']
+    if name not in params:
+        raise ValueError(f'Parameter {name} not found in {path}')
+    return params[name]
+
+def svDefine(path, name):
+    """Returns the value of the given `define from the given file"""
+    defines = svConstants(path)['defines']
+    if name not in defines:
+        raise ValueError(f'`define {name} not found in {path}')
+    return defines[name]
@@ -0,0 +1,139 @@
+"""Performance telemetry for our tests: how long each phase of each test takes. Records are appended, one JSON object
+per line, to telemetry.jsonl next to points.json in each homework directory. There are four kinds of record:
+    phase:  the wall-clock seconds of one phase of a test (build, clear, load or run). Run phases also record the
+            simulated cycles, simulated time and cycles simulated per host second.
+    test:   the wall-clock seconds and simulated time of each cocotb test, from the cocotb results file.
+    runner: the wall-clock seconds of each pytest runner function, which builds the simulator and runs its tests.
+Telemetry is off in the autograder. Set RV_TELEMETRY=0 to disable it elsewhere, or RV_TELEMETRY=1 to enable it in
+the autograder. Once telemetry.jsonl grows past TELEMETRY_MAX_BYTES it is moved to telemetry.jsonl.1, replacing the
+previous one, so at most two files' worth of records are kept.
+
+Usage, to rank the slowest tests and phases across all homeworks (from the repo root, or any homework directory):
+    python3 common/python/telemetry.py [TELEMETRY_FILE ...]
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+TELEMETRY_MAX_BYTES = 8 * 1024 * 1024
+# the simulator runs in the sim_build directory, so the homework directory is passed down via the environment.
+# conftest.py sets it to the directory of each testbench that pytest runs. Tools that run the simulator themselves,
+# outside pytest, are run from the homework directory.
+TELEMETRY_DIR_ENV = 'RV_TELEMETRY_DIR'
+os.environ.setdefault(TELEMETRY_DIR_ENV, str(Path.cwd()))
+
+_enabled = None
+
+def enabled():
+    """Returns True if telemetry is on: by default everywhere but the autograder, or as set by RV_TELEMETRY"""
+    global _enabled
+    if _enabled is None:
+        import cocotb_utils as cu # not at the top, since cocotb_utils imports this module
+        _enabled = os.environ.get('RV_TELEMETRY', '0' if cu.insideAutograder() else '1') != '0'
+        pass
+    return _enabled
+
+def telemetryPath():
+    return Path(os.environ[TELEMETRY_DIR_ENV]) / TELEMETRY_FILE
+
+def currentTest():
+    """Returns the name of the running cocotb test, or None outside of a test"""
+    try:
+        import cocotb
+        return cocotb.regression_manager._test.__qualname__
+    except AttributeError:
+        return None
+
+def write(record):
+    """Append one record to the telemetry file"""
+    if not enabled():
+        return
+    record = dict(record, homework=Path(os.environ[TELEMETRY_DIR_ENV]).name, timestamp=round(time.time(), 3))
+    record.setdefault('build_profile', os.environ.get('RV_BUILD_PROFILE')) # see cocotb_utils.buildProfile()
+    path = telemetryPath()
+    try:
+        if path.stat().st_size > TELEMETRY_MAX_BYTES:
+            os.replace(path, path.with_name(f'{path.name}.1'))
+            pass
+    except OSError:
+        pass # no file yet, or another process rotated it first
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        pass
+    pass
+
+@contextmanager
+def phase(name, **fields):
+    """Time the enclosed code as the given phase of the current test. The yielded dict may be updated with more
+    fields to record."""
+    fields = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        seconds = time.perf_counter() - start
+        write(dict(kind='phase', test=currentTest(), phase=name, seconds=round(seconds, 6), **fields))
+        pass
+    pass
+
+def recordRun(seconds, cycles, simTimeNs, **fields):
+    """Record the run phase of a test, which simulated the given number of cycles"""
+    write(dict(kind='phase', test=currentTest(), phase='run', seconds=round(seconds, 6), cycles=cycles,
+               sim_time_ns=simTimeNs, cycles_per_sec=round(cycles / seconds, 1) if seconds > 0 else None, **fields))
+    pass
+
+def recordResults(resultsXml):
+    """Record the wall-clock and simulated time of each test in the given cocotb results file"""
+    if not enabled() or not Path(resultsXml).is_file():
+        return
+    for tc in ET.parse(resultsXml).iter('testcase'):
+        write(dict(kind='test', test=tc.get('name'), seconds=float(tc.get('time', 0)),
+                   sim_time_ns=float(tc.get('sim_time_ns', 0)), passed=next(tc.iter('failure'), None) is None))
+        pass
+    pass
+
+def readRecords(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+            pass
+        pass
+    return records
+
+def rank(records, top=20):
+    """Returns a report of the slowest tests and phases, using the latest record of each"""
+    latest = {}
+    for r in records:
+        latest[(r['kind'], r['homework'], r.get('test'), r.get('phase'), r.get('binary'), r.get('build_profile'))] = r
+        pass
+    lines = []
+    for kind, title in [('runner', 'slowest runners'), ('test', 'slowest tests'), ('phase', 'slowest phases')]:
+        rows = sorted((r for r in latest.values() if r['kind'] == kind), key=lambda r: r['seconds'], reverse=True)
+        lines.append(f'{title} (of {len(rows)})')
+        lines.append(f'{"seconds":>9}  {"homework":<16} {"test":<24} {"phase":<6} {"profile":<7} {"cycles/sec":>10}')
+        for r in rows[:top]:
+            rate = f'{r["cycles_per_sec"]:>10.0f}' if r.get('cycles_per_sec') else f'{"":>10}'
+            lines.append(f'{r["seconds"]:>9.3f}  {r["homework"]:<16} {str(r.get("test")):<24} {r.get("phase", ""):<6} {str(r.get("build_profile") or ""):<7} {rate}')
+            pass
+        lines.append('')
+        pass
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        paths = sys.argv[1:]
+    else:
+        paths = sorted(Path('.').glob(f'hw*/{TELEMETRY_FILE}')) + sorted(Path('..').glob(f'hw*/{TELEMETRY_FILE}'))
+        pass
+    if len(paths) == 0:
+        print(f'no {TELEMETRY_FILE} files found, run some tests first')
+        sys.exit(1)
+    print(rank(readRecords(paths)))
+    pass
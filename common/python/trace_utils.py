@@ -0,0 +1,475 @@
+"""Reading, writing and converting processor traces. A trace has one record per cycle, holding the cycle number and
+the pc, insn and cycle status (a cycle_status_e bitmask) of the insn that completed in that cycle.
+
+Traces are stored either as JSON (the trace-*.json files, which are easy to read) or in a compact binary format
+(.rvtrace files) that is memory-mapped for comparison. The binary format is an 8B magic string, a 4B little-endian
+length of the JSON header that follows, 4B of padding, the header (which records the cycle_status_e names and
+values), padded with spaces to a multiple of 16B, and then one little-endian (cycle, pc, insn, status) record of
+four 4B ints per cycle. The number of records is determined by the file size.
+
+Long traces (dhrystone runs for ~260k cycles) are written with a TraceWriter, which flushes records to disk in
+chunks as the simulation runs, and read lazily with iterTrace(). Neither holds the whole trace in memory.
+
+Usage, to convert between the two formats losslessly:
+    python3 trace_utils.py to-binary trace-rv32ui-p-lw.json [...]
+    python3 trace_utils.py to-json trace-rv32ui-p-lw.rvtrace [...]
+"""
+
+from array import array
+from pathlib import Path
+import json
+import mmap
+import os
+import struct
+import sys
+import weakref
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy makes compareTraces() faster, but isn't required
+    np = None
+    pass
+
+TRACE_MAGIC = b'RVTRACE1'
+TRACE_PREAMBLE = struct.Struct('<8sII')
+TRACE_RECORD = struct.Struct('<IIII')
+TRACE_RECORD_WORDS = 4
+BINARY_TRACE_SUFFIX = '.rvtrace'
+
+# keys of each record in JSON traces
+JSON_FIELDS = ['cycle', 'trace_completed_pc', 'trace_completed_insn', 'trace_completed_cycle_status']
+
+# a JSON trace record, formatted like json.dump(records, f, indent=2) does
+JSON_RECORD_FORMAT = '''  {{
+    "cycle": {0},
+    "trace_completed_pc": "0x{1:x}",
+    "trace_completed_insn": "0x{2:08x}",
+    "trace_completed_cycle_status": "{3}"
+  }}'''
+
+class Trace:
+    """A trace, held as a flat buffer of 4B ints with TRACE_RECORD_WORDS per record. trace[i] returns the
+    (cycle, pc, insn, status) tuple for the i-th record. Binary traces are memory-mapped rather than read."""
+
+    def __init__(self, words, statusEnum):
+        self.words = words
+        self.statusEnum = statusEnum
+        self.statusMask = statusMask(statusEnum)
+        pass
+
+    def __len__(self):
+        return len(self.words) // TRACE_RECORD_WORDS
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(f'trace has {len(self)} records, no record {index}')
+        start = index * TRACE_RECORD_WORDS
+        return tuple(self.words[start:start + TRACE_RECORD_WORDS])
+
+    def statusString(self, status):
+        """Returns the comma-separated cycle_status_e names for the given status bitmask"""
+        return statusToString(status, self.statusEnum)
+
+    def toJsonRecords(self):
+        """Returns this trace in the trace-*.json format, i.e., a list of dicts with hex strings"""
+        return [intsToJsonRecord(self[i], self.statusEnum) for i in range(len(self))]
+
+def statusMask(statusEnum):
+    """Returns the cycle status bits in the given enum. Traces are compared on just these bits, since a processor may
+    set others that the expected trace's enum doesn't have."""
+    mask = 0
+    for value in statusEnum.values():
+        mask |= value
+        pass
+    return mask
+
+def recordsMatch(expected, actual, mask):
+    """Returns True if the given (pc, insn, status) records match, ignoring status bits outside mask"""
+    return expected[0] == actual[0] and expected[1] == actual[1] and (expected[2] & mask) == (actual[2] & mask)
+
+def statusToString(status, statusEnum):
+    return ','.join(name for name, value in statusEnum.items() if status & value)
+
+def statusFromString(statusString, statusEnum):
+    if statusString == '':
+        return 0
+    value = 0
+    for name in statusString.split(','):
+        if name not in statusEnum:
+            raise ValueError(f'Invalid enum name: {name}')
+        value |= statusEnum[name]
+        pass
+    return value
+
+def jsonRecordToInts(record, statusEnum):
+    if list(record.keys()) != JSON_FIELDS:
+        raise ValueError(f'unexpected trace record fields {list(record.keys())}, expected {JSON_FIELDS}')
+    return (record['cycle'],
+            int(record['trace_completed_pc'], 16),
+            int(record['trace_completed_insn'], 16),
+            statusFromString(record['trace_completed_cycle_status'], statusEnum))
+
+def intsToJsonRecord(values, statusEnum):
+    cycle, pc, insn, status = values
+    return {
+        'cycle': cycle,
+        'trace_completed_pc': f'0x{pc:x}',
+        'trace_completed_insn': f'0x{insn:08x}',
+        'trace_completed_cycle_status': statusToString(status, statusEnum),
+    }
+
+def fromJsonRecords(records, statusEnum):
+    """Convert a list of trace-*.json records into a Trace. Raises ValueError if the conversion would lose
+    information, e.g., if a record's pc isn't formatted the way we would format it."""
+    words = array('I')
+    for record in records:
+        words.extend(jsonRecordToInts(record, statusEnum))
+        pass
+    trace = Trace(words, statusEnum)
+    for i, (record, converted) in enumerate(zip(records, trace.toJsonRecords())):
+        if record != converted:
+            raise ValueError(f'trace record {i} cannot be converted losslessly: {record} would become {converted}')
+        pass
+    return trace
+
+def readJsonTrace(jsonPath, statusEnum):
+    with open(jsonPath, 'r', encoding='utf-8') as f:
+        return fromJsonRecords(json.load(f), statusEnum)
+
+def iterJsonRecords(jsonPath, chunkSize=1 << 16):
+    """Lazily yield the records (dicts) of a trace-*.json file, reading it chunkSize characters at a time. A file that
+    was cut short, e.g., by a crash while generating it, yields all of its complete records."""
+    decoder = json.JSONDecoder()
+    with open(jsonPath, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunkSize)
+        pos = _skipSeparators(buffer, 0)
+        if pos < len(buffer) and buffer[pos] == '[':
+            pos += 1
+        else:
+            assert buffer.strip() == '', f'{jsonPath} is not a JSON list'
+            return
+        eof = False
+        while True:
+            # skip whitespace and the commas between records
+            pos = _skipSeparators(buffer, pos)
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # probably a partial record, read some more
+                if eof:
+                    if buffer[pos:].strip() != '':
+                        print(f'[trace_utils.py] WARNING: {jsonPath} is incomplete, ignoring its last {len(buffer) - pos} characters')
+                        pass
+                    return
+                chunk = f.read(chunkSize)
+                eof = chunk == ''
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+            pass
+        pass
+    pass
+
+def _skipSeparators(text, pos):
+    while pos < len(text) and text[pos] in ' \t\r\n,':
+        pos += 1
+        pass
+    return pos
+
+def iterTrace(tracePath, statusEnum=None):
+    """Lazily yield the (cycle, pc, insn, status) records of a JSON or binary trace file. statusEnum is needed only
+    for JSON traces."""
+    if Path(tracePath).suffix == BINARY_TRACE_SUFFIX:
+        trace = readBinaryTrace(tracePath)
+        for i in range(len(trace)):
+            yield trace[i]
+            pass
+        return
+    for i, record in enumerate(iterJsonRecords(tracePath)):
+        values = jsonRecordToInts(record, statusEnum)
+        converted = intsToJsonRecord(values, statusEnum)
+        if record != converted:
+            raise ValueError(f'trace record {i} cannot be converted losslessly: {record} would become {converted}')
+        yield values
+        pass
+    pass
+
+class TraceWriter:
+    """Writes a trace one record at a time, in JSON (formatted the same as json.dump(records, f, indent=2)) or binary
+    format depending on the suffix of tracePath. Records are buffered and written out every chunkRecords records,
+    so memory use doesn't grow with the length of the trace. They go to a temporary file next to tracePath, which
+    close() moves into place, so tracePath only ever holds a complete trace. A writer that is discarded, or never
+    closed (e.g., because its test failed), leaves no file behind."""
+
+    def __init__(self, tracePath, statusEnum, chunkRecords=4096):
+        self.tracePath = Path(tracePath)
+        self.tmpPath = self.tracePath.with_name(f'.{self.tracePath.name}.{os.getpid()}.tmp')
+        self.statusEnum = statusEnum
+        self.binary = self.tracePath.suffix == BINARY_TRACE_SUFFIX
+        self.chunkRecords = chunkRecords
+        self.numRecords = 0
+        self.buffer = array('I')
+        self.statusStrings = {}
+        if self.binary:
+            self.file = open(self.tmpPath, 'wb')
+            header = _binaryHeader(statusEnum)
+            self.file.write(header)
+        else:
+            self.file = open(self.tmpPath, 'w', encoding='utf-8')
+            self.file.write('[')
+            pass
+        # remove the temporary file if we are never closed
+        self.removeTmp = weakref.finalize(self, _removeFile, self.tmpPath)
+        pass
+
+    def append(self, cycle, pc, insn, status):
+        self.buffer.extend((cycle, pc, insn, status))
+        if len(self.buffer) >= self.chunkRecords * TRACE_RECORD_WORDS:
+            self.flush()
+            pass
+        pass
+
+    def flush(self):
+        if self.binary:
+            if sys.byteorder == 'big':
+                self.buffer.byteswap()
+                pass
+            self.file.write(self.buffer.tobytes())
+        else:
+            # format records directly rather than via json.dumps(), which is much slower. Enum names never need escaping.
+            chunk = []
+            for i in range(0, len(self.buffer), TRACE_RECORD_WORDS):
+                cycle, pc, insn, status = self.buffer[i:i + TRACE_RECORD_WORDS]
+                if status not in self.statusStrings:
+                    self.statusStrings[status] = statusToString(status, self.statusEnum)
+                    pass
+                chunk.append('\n' if self.numRecords == 0 and i == 0 else ',\n')
+                chunk.append(JSON_RECORD_FORMAT.format(cycle, pc, insn, self.statusStrings[status]))
+                pass
+            self.numRecords += len(self.buffer) // TRACE_RECORD_WORDS
+            self.file.write(''.join(chunk))
+            pass
+        self.buffer = array('I')
+        self.file.flush()
+        pass
+
+    def close(self):
+        """Finish the trace and move it into place at tracePath"""
+        if self.file.closed:
+            return
+        self.flush()
+        if not self.binary:
+            self.file.write('\n]' if self.numRecords > 0 else ']')
+            pass
+        self.file.close()
+        os.replace(self.tmpPath, self.tracePath)
+        self.removeTmp.detach()
+        pass
+
+    def discard(self):
+        """Drop the trace written so far, leaving tracePath as it was"""
+        if self.file.closed:
+            return
+        self.file.close()
+        self.removeTmp()
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args):
+        if excType is None:
+            self.close()
+        else:
+            self.discard()
+            pass
+        pass
+
+def _removeFile(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    pass
+
+def writeJsonTrace(jsonPath, trace):
+    with open(jsonPath, 'w', encoding='utf-8') as f:
+        json.dump(trace.toJsonRecords(), f, indent=2)
+        pass
+    pass
+
+def readBinaryTrace(binaryPath):
+    """Memory-map the given .rvtrace file, returning a Trace"""
+    with open(binaryPath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pass
+    magic, headerLength, _ = TRACE_PREAMBLE.unpack_from(mm, 0)
+    assert magic == TRACE_MAGIC, f'{binaryPath} is not a binary trace file'
+    header = json.loads(mm[TRACE_PREAMBLE.size:TRACE_PREAMBLE.size + headerLength])
+    recordsStart = _recordsOffset(headerLength)
+    assert (len(mm) - recordsStart) % TRACE_RECORD.size == 0, f'{binaryPath} is truncated'
+    if sys.byteorder == 'little':
+        words = memoryview(mm)[recordsStart:].cast('I')
+    else:
+        words = array('I', mm[recordsStart:])
+        words.byteswap()
+        pass
+    return Trace(words, header['status_enum'])
+
+def writeBinaryTrace(binaryPath, trace):
+    """Write the given Trace to a .rvtrace file"""
+    words = array('I', trace.words)
+    if sys.byteorder == 'big':
+        words.byteswap()
+        pass
+    tmpPath = Path(f'{binaryPath}.{os.getpid()}.tmp')
+    with open(tmpPath, 'wb') as f:
+        f.write(_binaryHeader(trace.statusEnum))
+        f.write(words.tobytes())
+        pass
+    os.replace(tmpPath, binaryPath)
+    pass
+
+class TraceRecorder:
+    """Records a trace into a preallocated buffer as fast as possible, without checking anything. Call close()
+    once the test is done, which compares the recorded trace against the expected one all at once."""
+
+    def __init__(self, expected, capacity=None):
+        self.expected = expected
+        capacity = len(expected) + 1 if capacity is None else capacity
+        self.words = array('I', bytes(4 * TRACE_RECORD_WORDS * capacity))
+        self.numRecords = 0
+        pass
+
+    def append(self, cycle, pc, insn, status):
+        start = self.numRecords * TRACE_RECORD_WORDS
+        if start == len(self.words):
+            # out of space, double the buffer
+            self.words.extend(array('I', bytes(4 * len(self.words))))
+            pass
+        words = self.words
+        words[start] = cycle
+        words[start + 1] = pc
+        words[start + 2] = insn
+        words[start + 3] = status
+        self.numRecords += 1
+        pass
+
+    def trace(self):
+        """Returns the trace recorded so far"""
+        return Trace(memoryview(self.words)[:self.numRecords * TRACE_RECORD_WORDS], self.expected.statusEnum)
+
+    def close(self):
+        """Compare the recorded trace against the expected one, raising an AssertionError describing the first
+        difference, if there is one"""
+        mismatch = compareTraces(self.expected, self.trace())
+        assert mismatch is None, mismatch
+        pass
+
+def compareTraces(expected, actual, window=5):
+    """Compare two Traces by their pc, insn and status, ignoring cycle status bits that aren't in the expected
+    trace's status enum. Returns None if they match, otherwise a description of the first divergent record, along
+    with the `window` records on either side of it. Uses NumPy if it is available."""
+    mask = expected.statusMask
+    length = min(len(expected), len(actual))
+    if np is not None:
+        e = np.frombuffer(expected.words, dtype=np.uint32, count=length * TRACE_RECORD_WORDS).reshape(-1, TRACE_RECORD_WORDS)
+        a = np.frombuffer(actual.words, dtype=np.uint32, count=length * TRACE_RECORD_WORDS).reshape(-1, TRACE_RECORD_WORDS)
+        differs = (e[:, 1] != a[:, 1]) | (e[:, 2] != a[:, 2]) | ((e[:, 3] & mask) != (a[:, 3] & mask))
+        differing = np.flatnonzero(differs)
+        first = int(differing[0]) if len(differing) > 0 else None
+    else:
+        first = None
+        for i in range(length):
+            if not recordsMatch(expected[i][1:], actual[i][1:], mask):
+                first = i
+                break
+            pass
+        pass
+
+    if first is None:
+        if len(expected) == len(actual):
+            return None
+        first = length
+        reason = f'expected trace has {len(expected)} records, but recorded trace has {len(actual)}'
+    else:
+        reason = f'trace validation error at cycle {expected[first][0]}'
+        pass
+
+    lines = [reason, f'  {"record":>7}  {"expected pc":>11} {"insn":>10} {"status":<28} {"actual pc":>11} {"insn":>10} status']
+    for i in range(max(0, first - window), min(max(len(expected), len(actual)), first + window + 1)):
+        columns = []
+        for t in [expected, actual]:
+            if i < len(t):
+                _, pc, insn, status = t[i]
+                columns.append(f'{pc:>#11x} {insn:#010x} {statusToString(status, expected.statusEnum):<28}')
+            else:
+                columns.append(f'{"-":>11} {"-":>10} {"":<28}')
+                pass
+            pass
+        lines.append(f'{">" if i == first else " "} {i:>7}  {columns[0]} {columns[1]}'.rstrip())
+        pass
+    return '\n'.join(lines)
+
+def _binaryHeader(statusEnum):
+    """Returns the bytes of a .rvtrace file that precede its records"""
+    header = json.dumps({'fields': ['cycle', 'pc', 'insn', 'status'], 'status_enum': statusEnum}).encode()
+    preamble = TRACE_PREAMBLE.pack(TRACE_MAGIC, len(header), 0)
+    return preamble + header.ljust(_recordsOffset(len(header)) - TRACE_PREAMBLE.size, b' ')
+
+def _recordsOffset(headerLength):
+    """records start at the first 16B boundary after the header"""
+    return (TRACE_PREAMBLE.size + headerLength + 15) & ~15
+
+def loadTrace(traceDir, name, statusEnum, cacheDir=None):
+    """Load the trace for the given test name from traceDir, i.e., trace-NAME.rvtrace or trace-NAME.json. A JSON trace
+    is converted to a binary trace in cacheDir the first time it is loaded, and that is memory-mapped from then on."""
+    binaryPath = Path(traceDir, f'trace-{name}{BINARY_TRACE_SUFFIX}')
+    if binaryPath.exists():
+        return readBinaryTrace(binaryPath)
+    jsonPath = Path(traceDir, f'trace-{name}.json')
+    if cacheDir is None:
+        return readJsonTrace(jsonPath, statusEnum)
+
+    cachePath = Path(cacheDir, binaryPath.name)
+    if cachePath.exists() and cachePath.stat().st_mtime_ns >= jsonPath.stat().st_mtime_ns:
+        trace = readBinaryTrace(cachePath)
+        if trace.statusEnum == statusEnum:
+            return trace
+        pass
+    # convert one record at a time, so that long traces never need to fit in memory
+    with TraceWriter(cachePath, statusEnum) as writer:
+        for values in iterTrace(jsonPath, statusEnum):
+            writer.append(*values)
+            pass
+        pass
+    return readBinaryTrace(cachePath)
+
+def _cycleStatusEnum():
+    import cocotb_utils
+    return cocotb_utils.cycleStatusEnum()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ['to-binary', 'to-json']:
+        print(f'usage: {sys.argv[0]} to-binary|to-json TRACE_FILE...')
+        sys.exit(1)
+    for tracePath in map(Path, sys.argv[2:]):
+        if sys.argv[1] == 'to-binary':
+            outputPath = tracePath.with_suffix(BINARY_TRACE_SUFFIX)
+            statusEnum = _cycleStatusEnum()
+        else:
+            outputPath = tracePath.with_suffix('.json')
+            statusEnum = readBinaryTrace(tracePath).statusEnum
+            pass
+        with TraceWriter(outputPath, statusEnum) as writer:
+            for values in iterTrace(tracePath, statusEnum):
+                writer.append(*values)
+                pass
+            pass
+        print(f'wrote {outputPath}')
+        pass
+    pass
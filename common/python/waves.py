@@ -0,0 +1,127 @@
+"""Waveforms for just windows of cycles. Dumping all of dhrystone produces a multi-hundred-MB FST, but to debug a
+test we usually only need a few hundred cycles, e.g., those leading up to a failure. Under the 'debug' build profile
+our processors have a WaveWindow (see common/sv/WaveWindow.sv), which lets cocotb switch dumping on and off.
+
+Windowed dumping is used when RV_WAVES_WINDOWED=1 is set, in which case the simulator runs without --trace and only
+dumps what is requested here. setupWindows(), which each testbench's preTestSetup() calls at the start of every
+test, requests:
+    everything from the cycle given by RV_WAVES_FROM, for every test, or else
+    the WAVES_WINDOW_CYCLES cycles before the point where the test failed on its previous run, if it did.
+Tests (riscvTest, dhrystone and the inline tests alike) may also call dumpFrom() or dumpBefore() themselves.
+Cycles are those of the processor clock, counted from the start of the test. debug_rerun.py uses this to rerun
+failed tests automatically. By hand, e.g.:
+    RV_WAVES_WINDOWED=1 RV_WAVES_FROM=250000 pytest --build-profile debug --tests dhrystone testbench.py
+Waveforms go in sim_build/dump.fst.
+
+NB: a window always extends to the end of the simulation, as Verilator (as of 5.032) ignores $dumpoff. So when
+several tests run in one simulation, everything after the first window is dumped, which is why debug_rerun.py reruns
+failed tests one at a time.
+"""
+
+from pathlib import Path
+import os
+
+import cocotb
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time, get_time_from_sim_steps
+
+import cocotb_utils as cu
+import telemetry
+
+WAVE_WINDOW_SV = Path(__file__).resolve().parent / '..' / 'sv' / 'WaveWindow.sv'
+
+WAVES_WINDOWED_ENV = 'RV_WAVES_WINDOWED'
+# the cycle to start dumping from in every test
+WAVES_FROM_ENV = 'RV_WAVES_FROM'
+# the simulated time, in ns from the start of the test, at which the test failed on its previous run. By default we
+# find this in telemetry.jsonl.
+WAVES_WINDOW_END_ENV = 'RV_WAVES_WINDOW_END_NS'
+# the number of cycles before a failure to dump
+WAVES_WINDOW_CYCLES = int(os.environ.get('RV_WAVES_WINDOW_CYCLES', '1000'))
+
+def wavesBuild(hdl_toplevel, profile=None):
+    """Returns the extra (sources, build args) to build the given toplevel under the given build profile (default:
+    the current one). Only our processors, under the 'debug' profile, get a WaveWindow."""
+    if hdl_toplevel != 'Processor' or (profile or cu.BUILD_PROFILE) != 'debug':
+        return [], []
+    return [WAVE_WINDOW_SV], ['-DWAVE_WINDOW']
+
+def windowed():
+    """Returns True if waveforms are dumped only for the requested windows of cycles"""
+    return os.environ.get(WAVES_WINDOWED_ENV, '0') != '0'
+
+def simulatorWaves():
+    """Returns the `waves` argument for runr.test(): whether the simulator itself dumps the whole run, i.e., under the
+    'debug' profile unless the WaveWindow dumps just windows of it instead"""
+    return cu.shouldGenerateWaveforms() and not windowed()
+
+class _Windows:
+    """The WaveWindow of the running test"""
+    def __init__(self, dut, clock):
+        self.dut = dut
+        self.periodNs = get_time_from_sim_steps(clock.period, 'ns')
+        self.startNs = get_sim_time('ns')
+        pass
+
+    async def until(self, cycle):
+        delayNs = self.startNs + cycle * self.periodNs - get_sim_time('ns')
+        if delayNs > 0:
+            await Timer(delayNs, 'ns', round_mode='round')
+            pass
+        pass
+
+_windows = None
+
+def setupWindows(dut, clock):
+    """Call at the start of each test, with the processor clock, to dump the windows requested via the environment
+    or the WAVES_WINDOW_CYCLES cycles before this test's previous failure"""
+    global _windows
+    _windows = None
+    if not windowed() or not hasattr(dut, 'wave_window'):
+        return
+    _windows = _Windows(dut, clock)
+
+    if os.environ.get(WAVES_FROM_ENV):
+        dumpFrom(int(os.environ[WAVES_FROM_ENV]))
+        return
+    failedNs = os.environ.get(WAVES_WINDOW_END_ENV)
+    if failedNs is None:
+        failedNs = previousFailure(telemetry.currentTest())
+        pass
+    if failedNs is not None:
+        dumpBefore(float(failedNs) / _windows.periodNs, WAVES_WINDOW_CYCLES)
+        pass
+    pass
+
+def previousFailure(test):
+    """Returns the simulated time, in ns from the start of the test, at which the given test failed on its latest
+    run, from telemetry.jsonl, or None if it passed"""
+    try:
+        records = telemetry.readRecords([telemetry.telemetryPath()])
+    except (OSError, ValueError):
+        return None
+    latest = None
+    for r in records:
+        if r.get('kind') == 'test' and r.get('test') == test:
+            latest = r
+            pass
+        pass
+    if latest is None or latest['passed']:
+        return None
+    return latest['sim_time_ns']
+
+def dumpFrom(startCycle):
+    """Dump the waveforms of everything from startCycle on. Does nothing unless dumping is windowed."""
+    if _windows is None:
+        return None
+    windows = _windows
+    async def window():
+        await windows.until(startCycle)
+        windows.dut.wave_window.dump.value = 1
+        pass
+    return cocotb.start_soon(window())
+
+def dumpBefore(cycle, cycles=WAVES_WINDOW_CYCLES):
+    """Dump the given number of cycles before the given cycle (e.g., where an assertion failed on a previous run),
+    and everything after it"""
+    return dumpFrom(max(0, int(cycle) - cycles))
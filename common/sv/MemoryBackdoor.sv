@@ -0,0 +1,77 @@
+`timescale 1ns / 1ns
+
+/**
+ * Testbench-only access to a processor's memory, bound into the memory module so that the students' code doesn't
+ * need any of it (see loadSectionsIntoMemory() and clearMemory() in riscv_binary_utils.py).
+ *
+ * Bulk loading: the testbench writes the path of a $readmemh file to load_image_path and then changes load_image_seq,
+ * which loads the whole file into memory at once instead of needing one simulator call per word. load_image_done is
+ * set to load_image_seq once the file has been loaded, and only then may the testbench delete it.
+ *
+ * Store tracking: store_min_word and store_max_word hold the range of word indices stored to since the testbench last
+ * reset them, so it can clear just those words between tests. Stores are sampled on the edge of clk that the memory
+ * writes on: the rising edge, or the falling edge if NEGEDGE is set.
+ */
+module MemoryBackdoor #(
+    parameter int NUM_WORDS = 1,
+    parameter bit NEGEDGE = 0
+) (
+    input wire        clk,
+    input wire        rst,
+    input wire        store,
+    input wire [31:0] store_word
+);
+
+  // written by cocotb
+  logic [(8*256)-1:0] load_image_path;
+  int unsigned load_image_seq = 0;
+  int unsigned load_image_done = 0;
+
+  always @(load_image_seq) begin
+    if (load_image_seq != 0) begin
+      // the memory's instance name is `memory` in every Processor
+      $readmemh(load_image_path, memory.mem_array);
+      load_image_done <= load_image_seq;
+    end
+  end
+
+  wire store_edge = NEGEDGE ? !clk : clk;
+  int unsigned store_min_word = NUM_WORDS;
+  int unsigned store_max_word = 0;
+
+  always @(posedge store_edge) begin
+    if (!rst && store) begin
+      if (store_word < store_min_word) begin
+        store_min_word <= store_word;
+      end
+      if (store_word > store_max_word) begin
+        store_max_word <= store_word;
+      end
+    end
+  end
+
+endmodule
+
+// MEMORY_BACKDOOR_CLOCK, MEMORY_BACKDOOR_NEGEDGE and MEMORY_BACKDOOR_AXIL are set by
+// cocotb_utils.memoryBackdoorBuild()
+`ifdef MEMORY_BACKDOOR_AXIL
+bind EasyAxilMemory MemoryBackdoor #(
+    .NUM_WORDS(NUM_WORDS),
+    .NEGEDGE  (`MEMORY_BACKDOOR_NEGEDGE)
+) backdoor (
+    .clk       (`MEMORY_BACKDOOR_CLOCK),
+    .rst       (i_reset),
+    .store     (axil_write_ready && |wskd_strb),
+    .store_word(32'(awskd_addr[AddrMsb-2:AddrLsb-2]))
+);
+`elsif MEMORY_BACKDOOR_CLOCK
+bind MemorySingleCycle MemoryBackdoor #(
+    .NUM_WORDS(NUM_WORDS),
+    .NEGEDGE  (`MEMORY_BACKDOOR_NEGEDGE)
+) backdoor (
+    .clk       (`MEMORY_BACKDOOR_CLOCK),
+    .rst       (rst),
+    .store     (store_we_to_dmem != 4'd0),
+    .store_word(32'(addr_to_dmem[AddrMsb:AddrLsb]))
+);
+`endif
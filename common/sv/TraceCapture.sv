@@ -0,0 +1,55 @@
+`timescale 1ns / 1ns
+
+/**
+ * Testbench-only circular buffer of trace records, so that cocotb can read the trace in bulk every few hundred
+ * cycles instead of sampling the trace signals every cycle (see TraceCapture in cocotb_utils.py). Each record is
+ * {status, insn, pc, cycle}, with the cycle in the low 32 bits.
+ *
+ * The trace signals are sampled on the rising edge of sample_edge, which must come after the processor clock's
+ * rising edge but before the trace signals next change: the falling edge of the processor clock for hw5 and hw6,
+ * and the rising edge of the memory clock for hw3 and hw4. Each record thus holds the same values that cocotb
+ * sees right after the processor clock's rising edge.
+ */
+module TraceCapture #(
+    parameter int DEPTH = 512,
+    parameter bit NEGEDGE = 0
+) (
+    input wire        sample_clk,
+    input wire        rst,
+    input wire [31:0] cycle,
+    input wire [31:0] pc,
+    input wire [31:0] insn,
+    input wire [31:0] status
+);
+
+  // cocotb waits on this to make sure the latest cycle has been captured
+  wire sample_edge = NEGEDGE ? !sample_clk : sample_clk;
+
+  logic [DEPTH-1:0][127:0] records;
+  // total number of records captured since reset, cocotb uses this to find the new ones
+  logic [31:0] count;
+
+  always_ff @(posedge sample_edge) begin
+    if (rst) begin
+      count <= 0;
+    end else begin
+      records[count[$clog2(DEPTH)-1:0]] <= {status, insn, pc, cycle};
+      count <= count + 1;
+    end
+  end
+
+endmodule
+
+// TRACE_CAPTURE_CLOCK and TRACE_CAPTURE_NEGEDGE are set by cocotb_utils.traceCaptureBuild()
+`ifdef TRACE_CAPTURE_CLOCK
+bind Processor TraceCapture #(
+    .NEGEDGE(`TRACE_CAPTURE_NEGEDGE)
+) trace_capture (
+    .sample_clk(`TRACE_CAPTURE_CLOCK),
+    .rst       (rst),
+    .cycle     (datapath.cycles_current),
+    .pc        (trace_completed_pc),
+    .insn      (trace_completed_insn),
+    .status    (trace_completed_cycle_status)
+);
+`endif
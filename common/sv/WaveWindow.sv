@@ -0,0 +1,33 @@
+`timescale 1ns / 1ns
+
+/**
+ * Testbench-only control of waveform dumping, so that a debug run can dump just the end of a test instead of the
+ * whole test (see waves.py). The simulator is run without --trace, so nothing is dumped until cocotb raises `dump`,
+ * which opens dump.fst and dumps the whole design from then until the simulation ends. There is no way to stop
+ * dumping, as Verilator ignores $dumpoff.
+ */
+module WaveWindow;
+
+  // written by cocotb
+  logic dump = 0;
+  logic opened = 0;
+
+`ifdef VERILATOR
+  // $dumpvars needs tracing enabled, which cocotb's Verilator main() only does when run with --trace
+  initial $c("Verilated::traceEverOn(true);");
+`endif
+
+  always @(posedge dump) begin
+    if (!opened) begin
+      $dumpfile("dump.fst");
+      $dumpvars;
+      opened <= 1;
+    end
+  end
+
+endmodule
+
+// WAVE_WINDOW is set by waves.wavesBuild()
+`ifdef WAVE_WINDOW
+bind Processor WaveWindow wave_window ();
+`endif
@@ -2,13 +2,59 @@
 # the set of cocotb tests to run. We place this file here in the root directory
 # so that the flag is integrated into the test suites for all homeworks.
 
+import os
+import sys
+import time
+from pathlib import Path
 import pytest
 
+sys.path.append(str(Path(__file__).resolve().parent / 'common' / 'python'))
+import telemetry
+
 def pytest_addoption(parser):
     parser.addoption("--tests", action="store", default="", 
                      help="Comma-separated list of cocotb tests to run. Default: run all tests")
+    parser.addoption("--shards", action="store", default=None,
+                     help="Number of simulator processes to run the processor tests in, or 'auto' for one per two cores. Default: $RV_SHARDS, or 1")
+    parser.addoption("--build-profile", action="store", default=None, choices=["fast", "debug"],
+                     help="Build the simulator without tracing code ('fast') or with waveform support ('debug'). Default: $RV_BUILD_PROFILE, or 'fast', with failing tests rerun under 'debug' for their waveforms")
+
+def pytest_configure(config):
+    # the testbenches read the profile when they import cocotb_utils, which happens after this
+    if config.getoption("--build-profile") is not None:
+        os.environ["RV_BUILD_PROFILE"] = config.getoption("--build-profile")
+        pass
 
 def pytest_assertrepr_compare(config, op, left, right):
     # TODO: not working, perhaps because it only intercepts pytest tests, not cocotb tests?
     print(f'pytest_assertrepr_compare hook running:: ${left} ${op} ${right}')
     return ['my custom explanation']
+
+# Record how long each cocotb runner takes, along with the per-test times from its cocotb results file, in each
+# homework's telemetry.jsonl (see common/python/telemetry.py).
+_SESSION_START = time.time()
+
+def pytest_runtest_setup(item):
+    # telemetry goes next to the testbench being run, wherever pytest was started from
+    os.environ[telemetry.TELEMETRY_DIR_ENV] = str(Path(str(item.fspath)).parent)
+    pass
+
+def pytest_runtest_logreport(report):
+    if report.when == 'call':
+        telemetry.write(dict(kind='runner', test=report.nodeid.split('::')[-1], seconds=round(report.duration, 6),
+                             passed=report.passed))
+        pass
+    pass
+
+def pytest_sessionfinish(session, exitstatus):
+    # imported here, as cocotb_utils reads the build profile on import, after pytest_configure() has set it
+    import cocotb_utils as cu
+    for item in session.items:
+        # the results file of each runner, see cu.resultsFileName(), if this session wrote it
+        resultsXml = Path(cu.SIM_BUILD_DIR, f'{item.name}.None')
+        if resultsXml.is_file() and resultsXml.stat().st_mtime >= _SESSION_START:
+            pytest_runtest_setup(item)
+            telemetry.recordResults(resultsXml)
+            pass
+        pass
+    pass
@@ -10,6 +10,8 @@ PROJECT_PATH = Path(__file__).resolve().parent
 p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import cocotb_utils as cu
+import build_cache
+import debug_rerun
 from cocotb_utils import assertEquals
 
 # for deterministic random numbers
@@ -22,7 +24,8 @@ def runCocotbTestsHalfAdder(pytestconfig):
     toplevel_module = "halfadder"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         vhdl_sources=[],
         hdl_toplevel=toplevel_module,
@@ -32,7 +35,8 @@ def runCocotbTestsHalfAdder(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     )
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -48,7 +52,8 @@ def runCocotbTestsFullAdder1(pytestconfig):
     toplevel_module = "fulladder1"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         vhdl_sources=[],
         hdl_toplevel=toplevel_module,
@@ -58,7 +63,8 @@ def runCocotbTestsFullAdder1(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     )
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -74,7 +80,8 @@ def runCocotbTestsFullAdder2(pytestconfig):
     toplevel_module = "fulladder2"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         vhdl_sources=[],
         hdl_toplevel=toplevel_module,
@@ -84,7 +91,8 @@ def runCocotbTestsFullAdder2(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     )
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -100,7 +108,8 @@ def runCocotbTestsRca4(pytestconfig):
     toplevel_module = "rca4"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         vhdl_sources=[],
         hdl_toplevel=toplevel_module,
@@ -110,7 +119,8 @@ def runCocotbTestsRca4(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     )
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
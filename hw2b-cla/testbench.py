@@ -7,6 +7,8 @@ from cocotb.triggers import Timer
 p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import cocotb_utils as cu
+import build_cache
+import debug_rerun
 from cocotb_utils import assertEquals
 
 PROJECT_PATH = Path(__file__).resolve().parent
@@ -21,7 +23,8 @@ def runCocotbTestsGp4(pytestconfig):
     toplevel_module = "gp4"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         hdl_toplevel=toplevel_module,
         includes=[PROJECT_PATH],
@@ -30,7 +33,8 @@ def runCocotbTestsGp4(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     ),
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -46,7 +50,8 @@ def runCocotbTestsCla(pytestconfig):
     toplevel_module = "CarryLookaheadAdder"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         hdl_toplevel=toplevel_module,
         includes=[PROJECT_PATH],
@@ -55,7 +60,8 @@ def runCocotbTestsCla(pytestconfig):
         build_args=cu.VERILATOR_FLAGS,
     ),
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -5,9 +5,13 @@ p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import riscv_binary_utils
 
-riscv_binary_utils.loadBinaryIntoHexFile(
-    #'ledrop-rust/target/riscv32im-unknown-none-elf/release/ledrop', # Rust version
-    'ledrop-c/ledrop.bin', # C version
-    'mem_initial_contents.hex',
-    maxAddress=1024*4
-)
+try:
+    riscv_binary_utils.writeMemoryImage(
+        #'ledrop-rust/target/riscv32im-unknown-none-elf/release/ledrop', # Rust version
+        'ledrop-c/ledrop.bin', # C version
+        'mem_initial_contents.hex',
+        maxAddress=1024*4
+    )
+except riscv_binary_utils.MemoryImageTooLarge as e:
+    print(e)
+    sys.exit(1)
@@ -16,6 +16,11 @@ p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import riscv_binary_utils
 import cocotb_utils as cu
+import build_cache
+import debug_rerun
+import waves
+import telemetry
+import sharding
 from cocotb_utils import assertEquals
 
 # directory for this homework
@@ -26,6 +31,8 @@ TIMEOUT_CYCLES = 1_000
 TRACING_MODE = 'compare' # compare against the solution trace
 #TRACING_MODE = None # don't compare against or generate a trace
 #TRACING_MODE = 'generate' # generate a new trace (for staff only)
+#TRACING_MODE = 'record' # record the trace, and compare against the solution trace at the end
+#TRACING_MODE = 'cosim' # check against our RV32IM golden model, no trace file needed
 
 import testbench_divider_pipelined
 
@@ -36,7 +43,8 @@ def runCocotbTestsDivider(pytestconfig):
     toplevel_module = "DividerUnsignedPipelined"
 
     runr = get_runner(cu.SIM)
-    runr.build(
+    build_cache.build(
+        runr,
         verilog_sources=verilog_sources,
         hdl_toplevel=toplevel_module,
         includes=[PROJECT_PATH],
@@ -45,7 +53,8 @@ def runCocotbTestsDivider(pytestconfig):
         build_args=cu.VERILATOR_FLAGS+[f'-DDIVIDER_STAGES={testbench_divider_pipelined.DIVIDER_STAGES}'],
     ),
 
-    runr.test(
+    debug_rerun.test(
+        runr,
         seed=12345,
         waves=cu.shouldGenerateWaveforms(),
         hdl_toplevel=toplevel_module, 
@@ -59,24 +68,32 @@ def runCocotbTestsProcessor(pytestconfig):
 
     verilog_sources = [ PROJECT_PATH / "DatapathMultiCycle.sv" ]
     toplevel_module = "Processor"
+    captureSources, captureArgs = cu.traceCaptureBuild('clock_mem')
+    wavesSources, wavesArgs = waves.wavesBuild(toplevel_module)
+    backdoorSources, backdoorArgs = cu.memoryBackdoorBuild('clock_mem', negedge=True)
 
     runr = get_runner(cu.SIM)
-    runr.build(
-        verilog_sources=verilog_sources,
-        vhdl_sources=[],
-        hdl_toplevel=toplevel_module,
-        includes=[PROJECT_PATH],
-        build_dir=cu.SIM_BUILD_DIR,
-        waves=cu.shouldGenerateWaveforms(),
-        build_args=cu.VERILATOR_FLAGS+[f'-DDIVIDER_STAGES={testbench_divider_pipelined.DIVIDER_STAGES}'],
-    )
+    with telemetry.phase('build') as build:
+        build['cache_hit'] = build_cache.build(
+            runr,
+            verilog_sources=verilog_sources + captureSources + wavesSources + backdoorSources,
+            vhdl_sources=[],
+            hdl_toplevel=toplevel_module,
+            includes=[PROJECT_PATH],
+            build_dir=cu.SIM_BUILD_DIR,
+            waves=cu.shouldGenerateWaveforms(),
+            build_args=cu.VERILATOR_FLAGS+[f'-DDIVIDER_STAGES={testbench_divider_pipelined.DIVIDER_STAGES}']+captureArgs + wavesArgs + backdoorArgs,
+        )
+        pass
 
-    runr.test(
+    # run the tests, in parallel if requested via the `--shards` command-line flag
+    sharding.runTests(
+        runr,
+        pytestconfig, # filter tests via the `--tests` command-line flag
         seed=12345,
-        waves=cu.shouldGenerateWaveforms(),
-        hdl_toplevel=toplevel_module, 
+        waves=waves.simulatorWaves(),
+        hdl_toplevel=toplevel_module,
         test_module=Path(__file__).stem, # use tests from this file
-        testcase=pytestconfig.option.tests, # filter tests via the `--tests` command-line flag
     )
     pass
 
@@ -116,6 +133,8 @@ async def preTestSetup(dut, insns_or_path):
     # Start the clocks
     cocotb.start_soon(proc_clock.start(start_high=True))
     cocotb.start_soon(memClock(dut))
+    # dump just the requested windows of cycles, if any, see waves.py
+    waves.setupWindows(dut, proc_clock)
     # wait for first rising edge
     await RisingEdge(dut.clock_proc)
 
@@ -240,38 +259,29 @@ async def testTraceRvRemu(dut):
     "Use the REMU riscv-test with trace comparison"
     await riscvTest(dut, cu.RISCV_TESTS_PATH / 'rv32um-p-remu', TRACING_MODE)
 
-# tracingMode argument is one of `generate`, `compare` or None
+# tracingMode argument is one of `generate`, `compare`, `record`, `cosim` or None, see cu.makeTrace()
 async def riscvTest(dut, binaryPath=None, tracingMode=None):
     "Run the official RISC-V test whose binary lives at `binaryPath`"
     assert binaryPath is not None
     assert binaryPath.exists(), f'Could not find RV test binary {binaryPath}, have you built riscv-tests?'
     await preTestSetup(dut, binaryPath)
 
-    trace = []
-    if tracingMode == 'compare':
-        # use ../ since we run from the sim_build directory
-        with open(f'../trace-{binaryPath.name}.json', 'r', encoding='utf-8') as f:
-            trace = json.load(f)
-            pass
-        pass
+    trace = cu.makeTrace(binaryPath, tracingMode)
+    trace = cu.traceCapture(dut, trace, tracingMode)
 
     dut._log.info(f'Running RISC-V test at {binaryPath} with tracingMode == {tracingMode}')
-    for cycles in range(TIMEOUT_CYCLES):
-        await RisingEdge(dut.clock_proc)
-
-        cu.handleTrace(dut, trace, cycles, tracingMode)
-        if dut.halt.value == 1:
-            # see RVTEST_PASS and RVTEST_FAIL macros in riscv-tests/env/p/riscv_test.h
-            assertEquals(93, dut.datapath.rf.regs[17].value.integer) # magic value from pass/fail functions
-            resultCode = dut.datapath.rf.regs[10].value.integer
-            assert 0 == resultCode, f'failed test {resultCode >> 1} at cycle {dut.datapath.cycles_current.value.integer}'
-            if tracingMode == 'generate':
-                with open(f'trace-{binaryPath.name}.json', 'w', encoding='utf-8') as f:
-                    json.dump(trace, f, indent=2)
-                    pass
-            return
+    cycles = await cu.runUntilHalt(dut, dut.clock_proc, TIMEOUT_CYCLES, trace, tracingMode, accounting=cu.cycleAccounting(binaryPath.name))
+    await cu.finishTrace(dut, dut.clock_proc, trace, tracingMode)
+    if cycles is None:
+        raise SimTimeoutError()
+
+    # see RVTEST_PASS and RVTEST_FAIL macros in riscv-tests/env/p/riscv_test.h
+    assertEquals(93, dut.datapath.rf.regs[17].value.integer) # magic value from pass/fail functions
+    resultCode = dut.datapath.rf.regs[10].value.integer
+    assert 0 == resultCode, f'failed test {resultCode >> 1} at cycle {dut.datapath.cycles_current.value.integer}'
+    if tracingMode == 'generate':
+        trace.close()
         pass
-    raise SimTimeoutError()
 
 RV_TEST_BINARIES = [
     cu.RISCV_TESTS_PATH / 'rv32ui-p-simple', # 1
@@ -342,6 +352,7 @@ if 'RVTEST_ALUBR' in os.environ:
     RV_TEST_BINARIES = RV_TEST_BINARIES[:27]
     pass
 rvTestFactory.add_option(name='binaryPath', optionlist=RV_TEST_BINARIES)
+rvTestFactory.add_option(name='tracingMode', optionlist=[cu.RISCV_TESTS_TRACING_MODE])
 rvTestFactory.generate_tests()
 
 @cocotb.test()
@@ -351,34 +362,22 @@ async def dhrystone(dut, tracingMode=TRACING_MODE):
     assert dsBinary.exists(), f'Could not find Dhrystone binary {dsBinary}, have you built riscv-tests?'
     await preTestSetup(dut, dsBinary)
 
-    trace = []
-    if tracingMode == 'compare':
-        # use ../ since we run from the sim_build directory
-        with open(f'../trace-{dsBinary.name}.json', 'r', encoding='utf-8') as f:
-            trace = json.load(f)
-            pass
-        pass
+    trace = cu.makeTrace(dsBinary, tracingMode)
+    trace = cu.traceCapture(dut, trace, tracingMode)
 
     dut._log.info(f'Running Dhrystone benchmark (takes 197k cycles)... with tracingMode == {tracingMode}')
-    for cycles in range(210_000):
-        await RisingEdge(dut.clock_proc)
-
-        cu.handleTrace(dut, trace, cycles, tracingMode)
-        if cycles > 0 and 0 == cycles % 10_000:
-            dut._log.info(f'ran {int(cycles/1000)}k cycles...')
-            pass
-        if dut.halt.value == 1:
-            # there are 22 output checks, each sets 1 bit
-            expectedValue = (1<<22) - 1
-            assertEquals(expectedValue, dut.datapath.rf.regs[5].value.integer)
-            latency_millis = (cycles / 15_000_000) * 1000
-            dut._log.info(f'dhrystone passed after {cycles} cycles, {latency_millis} milliseconds with 15MHz clock')
-            
-            if tracingMode == 'generate':
-                with open(f'trace-{dsBinary.name}.json', 'w', encoding='utf-8') as f:
-                    json.dump(trace, f, indent=2)
-                    pass
-            
-            return
+    cycles = await cu.runUntilHalt(dut, dut.clock_proc, 210_000, trace, tracingMode, progressCycles=10_000,
+                                   accounting=cu.cycleAccounting(dsBinary.name))
+    await cu.finishTrace(dut, dut.clock_proc, trace, tracingMode)
+    if cycles is None:
+        raise SimTimeoutError()
+
+    # there are 22 output checks, each sets 1 bit
+    expectedValue = (1<<22) - 1
+    assertEquals(expectedValue, dut.datapath.rf.regs[5].value.integer)
+    latency_millis = (cycles / 15_000_000) * 1000
+    dut._log.info(f'dhrystone passed after {cycles} cycles, {latency_millis} milliseconds with 15MHz clock')
+
+    if tracingMode == 'generate':
+        trace.close()
         pass
-    raise SimTimeoutError()
@@ -5,8 +5,12 @@ p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import riscv_binary_utils
 
-riscv_binary_utils.loadBinaryIntoHexFile(
-    'mystery-signal/mystery.bin', # C version
-    'mem_initial_contents.hex',
-    maxAddress=4096
-)
+try:
+    riscv_binary_utils.writeMemoryImage(
+        'mystery-signal/mystery.bin', # C version
+        'mem_initial_contents.hex',
+        maxAddress=4096
+    )
+except riscv_binary_utils.MemoryImageTooLarge as e:
+    print(e)
+    sys.exit(1)
@@ -5,8 +5,13 @@ p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import riscv_binary_utils
 
-riscv_binary_utils.loadBinaryIntoHexFile(
-    sys.argv[1],    
-    'mem_initial_contents.hex',
-    maxAddress=8192*4
-)
+# usage: python3 make-mem-contents.py BINARY [OUTPUT], where OUTPUT ends in .hex (the default), .mem or .bin
+try:
+    riscv_binary_utils.writeMemoryImage(
+        sys.argv[1],
+        sys.argv[2] if len(sys.argv) > 2 else 'mem_initial_contents.hex',
+        maxAddress=8192*4
+    )
+except riscv_binary_utils.MemoryImageTooLarge as e:
+    print(e)
+    sys.exit(1)
@@ -16,19 +16,26 @@ p = Path.cwd() / '..' / 'common' / 'python'
 sys.path.append(str(p))
 import riscv_binary_utils
 import cocotb_utils as cu
+import build_cache
+import waves
+import telemetry
+import sharding
+import sv_constants
 from cocotb_utils import assertEquals
 
-# the number of stages the divider is split into
-DIVIDER_STAGES = 8
-
 # directory for this homework
 PROJECT_PATH = Path(__file__).resolve().parent
 
+# the number of stages the divider is split into, from the `define in the RTL
+DIVIDER_STAGES = sv_constants.svDefine(PROJECT_PATH / "DatapathPipelinedAxil.sv", 'DIVIDER_STAGES')
+
 TIMEOUT_CYCLES = 4_500
 
 TRACING_MODE = 'compare' # compare against the solution trace
 #TRACING_MODE = None # don't compare against or generate a trace
 #TRACING_MODE = 'generate' # generate a new trace (for staff only)
+#TRACING_MODE = 'record' # record the trace, and compare against the solution trace at the end
+#TRACING_MODE = 'cosim' # check against our RV32IM golden model, no trace file needed
 
 async def preTestSetup(dut, insns_or_path):
     """Setup the DUT. MUST be called at the start of EACH test."""
@@ -36,11 +43,11 @@ async def preTestSetup(dut, insns_or_path):
     proc_clock = Clock(dut.clk, 4, units="ns")
     # Start the clocks
     cocotb.start_soon(proc_clock.start(start_high=True))
+    # dump just the requested windows of cycles, if any, see waves.py
+    waves.setupWindows(dut, proc_clock)
 
     # empty memory before each test
-    for i in range (dut.memory.NUM_WORDS.value):
-        dut.memory.mem_array[i].value = 0
-        pass
+    riscv_binary_utils.clearMemory(dut)
 
     # wait for first rising edge
     await RisingEdge(dut.clk)
@@ -71,23 +78,31 @@ def runCocotbTestsProcessor(pytestconfig):
 
     verilog_sources = [ PROJECT_PATH / "DatapathPipelinedAxil.sv" ]
     toplevel_module = "Processor"
+    captureSources, captureArgs = cu.traceCaptureBuild('clk', negedge=True)
+    wavesSources, wavesArgs = waves.wavesBuild(toplevel_module)
+    backdoorSources, backdoorArgs = cu.memoryBackdoorBuild('ACLK', axil=True)
 
     runr = get_runner(cu.SIM)
-    runr.build(
-        verilog_sources=verilog_sources,
-        vhdl_sources=[],
-        hdl_toplevel=toplevel_module,
-        waves=cu.shouldGenerateWaveforms(),
-        includes=[PROJECT_PATH],
-        build_dir=cu.SIM_BUILD_DIR,
-        build_args=cu.VERILATOR_FLAGS+[f'-DDIVIDER_STAGES={DIVIDER_STAGES}'],
-    )
-    runr.test(
+    with telemetry.phase('build') as build:
+        build['cache_hit'] = build_cache.build(
+            runr,
+            verilog_sources=verilog_sources + captureSources + wavesSources + backdoorSources,
+            vhdl_sources=[],
+            hdl_toplevel=toplevel_module,
+            waves=cu.shouldGenerateWaveforms(),
+            includes=[PROJECT_PATH],
+            build_dir=cu.SIM_BUILD_DIR,
+            build_args=cu.VERILATOR_FLAGS+[f'-DDIVIDER_STAGES={DIVIDER_STAGES}']+captureArgs + wavesArgs + backdoorArgs,
+        )
+        pass
+    # run the tests, in parallel if requested via the `--shards` command-line flag
+    sharding.runTests(
+        runr,
+        pytestconfig, # filter tests via the `--tests` command-line flag
         seed=12345,
-        waves=cu.shouldGenerateWaveforms(),
-        hdl_toplevel=toplevel_module, 
+        waves=waves.simulatorWaves(),
+        hdl_toplevel=toplevel_module,
         test_module=Path(__file__).stem, # use tests from this file
-        testcase=pytestconfig.option.tests, # filter tests via the `--tests` command-line flag
     )
     pass
 
@@ -602,39 +617,29 @@ async def testTraceRvLw(dut):
     "Use the LW riscv-test with trace comparison"
     await riscvTest(dut, cu.RISCV_TESTS_PATH / 'rv32ui-p-lw', TRACING_MODE)
 
-# tracingMode argument is one of `generate`, `compare` or None
+# tracingMode argument is one of `generate`, `compare`, `record`, `cosim` or None, see cu.makeTrace()
 async def riscvTest(dut, binaryPath=None, tracingMode=None):
     "Run the official RISC-V test whose binary lives at `binaryPath`"
     assert binaryPath is not None
     assert binaryPath.exists(), f'Could not find RV test binary {binaryPath}, have you built riscv-tests?'
     await preTestSetup(dut, binaryPath)
 
-    trace = []
-    traceFile = Path(f'trace-{binaryPath.name}.json')
-    if tracingMode == 'compare':
-        # use ../ since we run from the sim_build directory
-        with open(Path('..') / traceFile, 'r', encoding='utf-8') as f:
-            trace = json.load(f)
-            pass
-        pass
+    trace = cu.makeTrace(binaryPath, tracingMode)
+    trace = cu.traceCapture(dut, trace, tracingMode)
 
     dut._log.info(f'Running RISC-V test at {binaryPath} with tracingMode == {tracingMode}')
-    for cycles in range(TIMEOUT_CYCLES):
-        await RisingEdge(dut.clk)
-
-        cu.handleTrace(dut, trace, cycles, tracingMode)
-        if dut.halt.value == 1:
-            # see RVTEST_PASS and RVTEST_FAIL macros in riscv-tests/env/p/riscv_test.h
-            assertEquals(93, dut.datapath.rf.regs[17].value.integer) # magic value from pass/fail functions
-            resultCode = dut.datapath.rf.regs[10].value.integer
-            assert 0 == resultCode, f'failed test {resultCode >> 1} at cycle {dut.datapath.cycles_current.value.integer}'
-            if tracingMode == 'generate':
-                with open(traceFile, 'w', encoding='utf-8') as f:
-                    json.dump(trace, f, indent=2)
-                    pass
-            return
+    cycles = await cu.runUntilHalt(dut, dut.clk, TIMEOUT_CYCLES, trace, tracingMode, accounting=cu.cycleAccounting(binaryPath.name))
+    await cu.finishTrace(dut, dut.clk, trace, tracingMode)
+    if cycles is None:
+        raise SimTimeoutError()
+
+    # see RVTEST_PASS and RVTEST_FAIL macros in riscv-tests/env/p/riscv_test.h
+    assertEquals(93, dut.datapath.rf.regs[17].value.integer) # magic value from pass/fail functions
+    resultCode = dut.datapath.rf.regs[10].value.integer
+    assert 0 == resultCode, f'failed test {resultCode >> 1} at cycle {dut.datapath.cycles_current.value.integer}'
+    if tracingMode == 'generate':
+        trace.close()
         pass
-    raise SimTimeoutError()
 
 RV_TEST_BINARIES = [
     cu.RISCV_TESTS_PATH / 'rv32ui-p-simple', # riscvTest_001
@@ -704,6 +709,7 @@ if 'RVTEST_ALUBR' in os.environ:
     RV_TEST_BINARIES = RV_TEST_BINARIES[:27]
     pass
 rvTestFactory.add_option(name='binaryPath', optionlist=RV_TEST_BINARIES)
+rvTestFactory.add_option(name='tracingMode', optionlist=[cu.RISCV_TESTS_TRACING_MODE])
 rvTestFactory.generate_tests()
 
 @cocotb.test(skip='RVTEST_ALUBR' in os.environ)
@@ -713,36 +719,23 @@ async def dhrystone(dut, tracingMode=TRACING_MODE):
     assert dsBinary.exists(), f'Could not find Dhrystone binary {dsBinary}, have you built riscv-tests?'
     await preTestSetup(dut, dsBinary)
 
-    trace = []
-    traceFile = Path(f'trace-{dsBinary.name}.json')
-    if tracingMode == 'compare':
-        # use ../ since we run from the sim_build directory
-        with open(Path('..') / traceFile, 'r', encoding='utf-8') as f:
-            trace = json.load(f)
-            pass
-        pass
+    trace = cu.makeTrace(dsBinary, tracingMode)
+    trace = cu.traceCapture(dut, trace, tracingMode)
 
     dhrystone_cycles = '288k' # with EasyAxilMemory
     dut._log.info(f'Running Dhrystone benchmark (takes {dhrystone_cycles} cycles)... with tracingMode == {tracingMode}')
-    for cycles in range(300_000):
-        await RisingEdge(dut.clk)
-
-        cu.handleTrace(dut, trace, cycles, tracingMode)
-        if cycles > 0 and 0 == cycles % 10_000:
-            dut._log.info(f'ran {int(cycles/1000)}k cycles...')
-            pass
-        if dut.halt.value == 1:
-            # there are 22 output checks, each sets 1 bit
-            expectedValue = (1<<22) - 1
-            assertEquals(expectedValue, dut.datapath.rf.regs[5].value.integer)
-            latency_millis = (cycles / 15_000_000) * 1000
-            dut._log.info(f'dhrystone passed after {cycles} cycles, {latency_millis} milliseconds with 15MHz clock')
-            
-            if tracingMode == 'generate':
-                with open(f'trace-{dsBinary.name}.json', 'w', encoding='utf-8') as f:
-                    json.dump(trace, f, indent=2)
-                    pass
-            
-            return
+    cycles = await cu.runUntilHalt(dut, dut.clk, 300_000, trace, tracingMode, progressCycles=10_000,
+                                   accounting=cu.cycleAccounting(dsBinary.name))
+    await cu.finishTrace(dut, dut.clk, trace, tracingMode)
+    if cycles is None:
+        raise SimTimeoutError()
+
+    # there are 22 output checks, each sets 1 bit
+    expectedValue = (1<<22) - 1
+    assertEquals(expectedValue, dut.datapath.rf.regs[5].value.integer)
+    latency_millis = (cycles / 15_000_000) * 1000
+    dut._log.info(f'dhrystone passed after {cycles} cycles, {latency_millis} milliseconds with 15MHz clock')
+
+    if tracingMode == 'generate':
+        trace.close()
         pass
-    raise SimTimeoutError()